@@ -7,10 +7,10 @@
 # 8 February 2018: Added DT4b function to better calculate continuum removal features between green-NIR and NIR-SWIR2 + code updates
 # 8 February 2018: Updated help info in input parser
 
-import os, sys, glob, shutil, argparse, datetime, numexpr, ieo
+import os, sys, glob, shutil, argparse, datetime, functools, multiprocessing, sqlite3, numexpr, ieo
 from ieo import ENVIfile
 from pkg_resources import resource_filename, Requirement
-from osgeo import gdal, ogr, osr
+from osgeo import gdal, gdal_array, ogr, osr
 import numpy as np
 
 
@@ -60,6 +60,24 @@ parser.add_argument('--endyear', type = int, default = datetime.datetime.now().y
 parser.add_argument('--startday', type = int, default = 82, help = 'Day of year for which to start the analysis.')
 parser.add_argument('--endday', type = int, default = 283, help = 'Day of year for which to end the analysis.')
 parser.add_argument('--minpixels', type = int, default = 1000, help = 'Minimum number of clear land pixels in a Landsat scene required for DT4, DT4a, or DT4b classification.')
+parser.add_argument('--windowsize', type = int, default = 4194304, help = 'Maximum number of pixels per block window read when classifying Landsat scenes, 0 = read whole scenes (default = 4194304).')
+parser.add_argument('--nofmaskindex', dest = 'usefmaskindex', action = "store_false", help = 'Do not use the Fmask index to skip scenes with too few clear land pixels before classification.')
+parser.add_argument('--workers', type = int, default = 1, help = 'Number of worker processes used to classify scenes and to process tiles (default = 1).')
+parser.add_argument('--splityears', action = "store_true", help = 'Distribute the yearly probability stage of each tile across worker processes by year, then calculate change per tile.')
+parser.add_argument('--querypoints', type = str, default = None, help = 'Query the forestry class and scene classification histories of the points in this ITM CSV (ID, X, Y columns) or point shapefile instead of making maps.')
+parser.add_argument('--queryoutput', type = str, default = None, help = 'Output CSV file for --querypoints (default = input file name with the suffix "_query.csv").')
+parser.add_argument('--usescenes', action = "store_true", help = 'Read scene classifications directly, mosaicking same-date scenes in memory, instead of the VRTs built by ifordeovrt.')
+parser.add_argument('--stream', action = "store_true", help = 'Classify scenes into memory and add them straight to per-tile class counts, then make the tile maps, without writing scene classifications or VRTs.')
+parser.add_argument('--writescenes', action = "store_true", help = 'Also write the scene classifications in --stream mode.')
+parser.add_argument('--streamtiles', type = int, default = 0, help = 'Maximum number of tiles accumulated per pass over the scenes of a year in --stream mode, each taking about 25 MB per foresttograss value, 0 = all tiles (default = 0).')
+parser.add_argument('--minoverlap', type = float, default = 0.0, help = 'Skip scenes or VRTs that cover less than this fraction of a tile according to the tile overlap table of the scene catalog database (default = 0.0).')
+parser.add_argument('--scenetiles', type = str, default = None, help = 'List the tiles fed by this Landsat scene ID according to the scene catalog database instead of making maps.')
+parser.add_argument('--nocube', dest = 'usecube', action = "store_false", help = 'Do not keep the yearly forestry classes of each tile in a memory mappable time-series cube, read the yearly rasters for change detection instead.')
+parser.add_argument('--multibandpct', action = "store_true", help = 'Write the class probabilities of each tile-year to a single multi-band pct file instead of one file per class.')
+parser.add_argument('--incremental', action = "store_true", help = 'Only rebuild tile-years and tile change maps whose inputs have changed since they were last built.')
+parser.add_argument('--maskprobability', action = "store_true", help = 'Only count scene classes of pixels inside the national forestry mask in the probability stage, all other pixels get class 0 (no data).')
+parser.add_argument('--maskcachesize', type = int, default = 4, help = 'Number of tile forestry mask windows kept in memory by each process (default = 4).')
+parser.add_argument('--changeengine', type = str, default = 'array', choices = ['array', 'pixel'], help = 'Change detection engine: "array" processes whole tile stacks at once, "pixel" uses the original per-pixel loop for validation (default = array).')
 margs = parser.parse_args()
 
 
@@ -88,19 +106,32 @@ margs = parser.parse_args()
     
 errorfile = os.path.join(ieo.logdir, config['DEFAULT']['errorlogfile'])
 
+# Output format for all rasters written by writedata(): 'ENVI' (.dat/.hdr pairs), 'GTiff' (tiled, compressed GeoTIFF), or 'COG' (Cloud Optimized GeoTIFF with overviews)
+outputformat = config['DEFAULT'].get('outputformat', 'ENVI')
+outputcompression = config['DEFAULT'].get('outputcompression', 'DEFLATE') # DEFLATE or ZSTD, GeoTIFF outputs only
+if outputformat == 'ENVI':
+    outputext = '.dat'
+else:
+    outputext = '.tif'
+
+loglock = multiprocessing.Lock() # serialises writes to the error log and ESPA reprocessing list between worker processes
+cubelock = multiprocessing.Lock() # serialises updates of the forestry class time-series cubes between worker processes
+
 def logerror(f, message):
-    if not os.path.exists(errorfile):
-        with open(errorfile, 'w') as output:
-            output.write('Time, File, Error\n')
-    now = datetime.datetime.now()
-    with open(errorfile, 'a') as output:
-        output.write('{}, {}, {}\n'.format(now.strftime('%Y-%m-%d %H:%M:%S'), f, message))
+    with loglock:
+        if not os.path.exists(errorfile):
+            with open(errorfile, 'w') as output:
+                output.write('Time, File, Error\n')
+        now = datetime.datetime.now()
+        with open(errorfile, 'a') as output:
+            output.write('{}, {}, {}\n'.format(now.strftime('%Y-%m-%d %H:%M:%S'), f, message))
 
 
 def ESPAreprocess(SceneID, listfile):
     print('Adding scene {} for ESPA reprocessing to: {}'.format(SceneID, listfile))
-    with open(listfile, 'a') as output:
-        output.write('{}\n'.format(SceneID))
+    with loglock:
+        with open(listfile, 'a') as output:
+            output.write('{}\n'.format(SceneID))
 
 ## ENVI file related
 
@@ -144,6 +175,7 @@ dtype_to_envi = {
 
 
 headerfields = 'acquisition time,band names,bands,bbl,byte order,class lookup,class names,classes,cloud cover,complex function,coordinate system string,data gain values,data ignore value,data offset values,data reflectance gain values,data reflectance offset values,data type,default bands,default stretch,dem band,dem file,description,file type,fwhm,geo points,header offset,interleave,lines,map info, pixel size, product type, projection info,read procedures,reflectance scale factor,rpc info,samples,security tag,sensor type,solar irradiance,spectra names,sun azimuth,sun elevation,wavelength,wavelength units,x start,y start,z plot average,z plot range,z plot titles,defaultbasefilename'.split(',')
+pctclassnames = ['forestry', 'cropgrass', 'bogheath', 'heathforest', 'urban', 'water', 'bogforest', 'cropforest', 'cropbog', 'forestcrop', 'forestcropheath'] # band order of multi-band pct files, the last two are only used by DT4a and DT4b
 
 def getheaderdict(*args, **kwargs):
     rastertype = kwargs.get('rastertype', None)
@@ -159,6 +191,7 @@ def getheaderdict(*args, **kwargs):
     maxforesttograss = kwargs.get('maxforesttograss', None)
     classname = kwargs.get('classname', None) # Not the same as classnames!
     observationtype = kwargs.get('observationtype', None) # Not the same as classnames!
+    bandnames = kwargs.get('bandnames', None)
     parentrasters = kwargs.get('parentrasters', None)
     
     headerdict = dict.fromkeys(headerfields)
@@ -307,6 +340,14 @@ def getheaderdict(*args, **kwargs):
             headerdict['description'] = '{} class probability for {}'.format(classname, year)
         headerdict['band names'] = ['{} {}'.format(classname, year)]
         
+    elif rastertype == 'pctstack': # multi-band version of 'pct', uses 'bandnames'
+        headerdict['defaultbasefilename'] = 'pct_{}_{}.dat'.format(year, tilename)
+        if foresttograss:
+            headerdict['description'] = 'Class probabilities for {}, foresttograss = {}'.format(year, foresttograss)
+        else:
+            headerdict['description'] = 'Class probabilities for {}'.format(year)
+        headerdict['band names'] = bandnames
+        
     elif rastertype == 'denominator':
         headerdict['defaultbasefilename'] = 'Obs_{}_{}.dat'.format(year, tilename)
         if foresttograss:
@@ -418,6 +459,7 @@ def writedata(data, rastertype, geoTrans, *args, **kwargs):
     maxforesttograss = kwargs.get('maxforesttograss', None)
     classname = kwargs.get('classname', None) # Not the same as classnames!
     observationtype = kwargs.get('observationtype', None) # Not the same as classnames!
+    bandnames = kwargs.get('bandnames', None)
     rasters = kwargs.get('rasters', None) # List of rasters that were used to create these data.
     
     if rasters:
@@ -431,8 +473,60 @@ def writedata(data, rastertype, geoTrans, *args, **kwargs):
     else:
         parentrasters = None
     
-    headerdict = getheaderdict(rastertype = rastertype, outdir = outdir, tilename = tilename, year = year, startyear = startyear, endyear = endyear, foresttograss = foresttograss, minforesttograss = minforesttograss, maxforesttograss = maxforesttograss, classname = classname, observationtype = observationtype, SceneID = SceneID, parentrasters = parentrasters)
-    ENVIfile(data, rastertype, geoTrans = geoTrans, headerdict = headerdict, acqtime = acqtime, outdir = outdir).Save()
+    headerdict = getheaderdict(rastertype = rastertype, outdir = outdir, tilename = tilename, year = year, startyear = startyear, endyear = endyear, foresttograss = foresttograss, minforesttograss = minforesttograss, maxforesttograss = maxforesttograss, classname = classname, observationtype = observationtype, bandnames = bandnames, SceneID = SceneID, parentrasters = parentrasters)
+    if outputformat == 'ENVI' and len(data.shape) == 2:
+        ENVIfile(data, rastertype, geoTrans = geoTrans, headerdict = headerdict, acqtime = acqtime, outdir = outdir).Save()
+    else: # ENVIfile takes multi-band arrays as (lines, samples, bands), so (bands, rows, cols) stacks are written through GDAL in every format
+        writegdalraster(data, productpath(outdir, headerdict['defaultbasefilename']), geoTrans, headerdict, acqtime = acqtime)
+
+def productpath(dirname, filename):
+    # Returns the path of a product file in the configured output format. filename uses the ENVI '.dat' extension, as in getheaderdict().
+    if filename.endswith('.dat'):
+        filename = filename[:-4] + outputext
+    return os.path.join(dirname, filename)
+
+def writegdalraster(data, outfile, geoTrans, headerdict, *args, **kwargs):
+    # Writes a 2D or (bands, rows, cols) array to a band sequential ENVI file, or an internally tiled, compressed GeoTIFF or COG, carrying the description, band names, class names, colour table and parent rasters from getheaderdict().
+    acqtime = kwargs.get('acqtime', None)
+    if len(data.shape) == 2:
+        data = data.reshape((1,) + data.shape)
+    bands, rows, cols = data.shape
+    print('Writing: {}'.format(outfile))
+    ds = gdal.GetDriverByName('MEM').Create('', cols, rows, bands, gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype))
+    ds.SetGeoTransform(geoTrans)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(2157) # Irish Transverse Mercator
+    ds.SetProjection(srs.ExportToWkt())
+    if headerdict['description']:
+        ds.SetMetadataItem('DESCRIPTION', headerdict['description'])
+    if headerdict.get('parentrasters', None): # 'parent rasters = { a, b}' line built by writedata()
+        line = headerdict['parentrasters']
+        ds.SetMetadataItem('PARENT_RASTERS', line[line.find('{') + 1:line.find('}')].strip())
+    if acqtime:
+        ds.SetMetadataItem('ACQUISITION_TIME', acqtime.split('=')[-1].strip())
+    for i in range(bands):
+        band = ds.GetRasterBand(i + 1)
+        band.WriteArray(data[i])
+        if headerdict['band names'] and len(headerdict['band names']) > i:
+            band.SetDescription(headerdict['band names'][i])
+        if headerdict['class names']:
+            band.SetCategoryNames(headerdict['class names'])
+        if headerdict['class lookup']:
+            colors = gdal.ColorTable()
+            for j, rgb in enumerate(headerdict['class lookup']):
+                colors.SetColorEntry(j, tuple(rgb) + (255,))
+            band.SetRasterColorTable(colors)
+            band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
+    if outputformat == 'ENVI':
+        options = ['INTERLEAVE=BSQ']
+    elif outputformat == 'COG':
+        options = ['COMPRESS={}'.format(outputcompression), 'OVERVIEWS=AUTO', 'RESAMPLING=NEAREST', 'BLOCKSIZE=256']
+    else:
+        options = ['COMPRESS={}'.format(outputcompression), 'TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256']
+        if bands > 1:
+            options.append('INTERLEAVE=BAND')
+    gdal.GetDriverByName(outputformat).CreateCopy(outfile, ds, options = options)
+    ds = None
     
 ## General functions
 
@@ -468,6 +562,38 @@ def pixel2world(geoMatrix, pixel, line):
   y = yDist * float(line) + ulY
   return (x, y)
 
+def tilewindow(tilegt, tilecols, tilerows, srcgt, srccols, srcrows):
+    # Calculates the overlap between a tile grid and a raster on the same pixel grid, without reprojection.
+    # Returns (xoff, yoff, xsize, ysize), the source window to read, and (rowslice, colslice), the matching destination slices in the tile.
+    # Returns None if they do not overlap. Raises ValueError if the pixel sizes differ.
+    if abs(tilegt[1] - srcgt[1]) > 1e-6 * abs(tilegt[1]) or abs(tilegt[5] - srcgt[5]) > 1e-6 * abs(tilegt[5]):
+        raise ValueError('Raster pixel size ({}, {}) does not match tile pixel size ({}, {}).'.format(srcgt[1], srcgt[5], tilegt[1], tilegt[5]))
+    colshift = int(round((srcgt[0] - tilegt[0]) / tilegt[1])) # tile column of source column 0
+    rowshift = int(round((srcgt[3] - tilegt[3]) / tilegt[5])) # tile row of source row 0
+    c0 = max(0, colshift)
+    c1 = min(tilecols, colshift + srccols)
+    r0 = max(0, rowshift)
+    r1 = min(tilerows, rowshift + srcrows)
+    if c1 <= c0 or r1 <= r0:
+        return None
+    return (c0 - colshift, r0 - rowshift, c1 - c0, r1 - r0), (slice(r0, r1), slice(c0, c1))
+
+def accumulateclasses(counts, data, dst, pixelindex, *args, **kwargs):
+    # Adds one observation per pixel of a class raster window to a (classes, rows, cols) count cube in a single scatter pass.
+    # data is the window read into the tile slices dst, pixelindex is np.arange(rows * cols).reshape(rows, cols).
+    # Values outside 1 to counts.shape[0] - 1 are counted in plane 0 (no data). If a boolean tile mask is given, only pixels inside it are counted.
+    tilemask = kwargs.get('tilemask', None)
+    numclasses = counts.shape[0]
+    indices = pixelindex[dst]
+    if tilemask is not None:
+        keep = tilemask[dst]
+        classes = data[keep].astype(np.intp)
+        indices = indices[keep]
+    else:
+        classes = data.astype(np.intp)
+    classes[classes >= numclasses] = 0
+    counts.reshape(-1)[classes * pixelindex.size + indices] += 1 # each pixel gets exactly one class per scene, so no indices repeat
+
 def getval(img, x, y):
     
     geoTrans = img.GetGeoTransform()
@@ -576,6 +702,100 @@ def cleansignal(signal): # This assigns either a forestry/not forestry value to
     locs = None
     return signal
 
+def removespikes(signals):
+    # Array version of the spike removal in cleansignal() for a (years, pixels) array, modified in place. Spikes are located before any are removed and then removed in year order, as cleansignal() does.
+    numyears = signals.shape[0]
+    if numyears < 3:
+        return signals
+    in13 = numexpr.evaluate("(signals == 1) | (signals == 3)")
+    spikes = np.zeros(signals.shape, dtype = bool)
+    spikes[1:-1] = in13[1:-1] & in13[:-2] & (signals[1:-1] != signals[:-2]) & (signals[:-2] == signals[2:])
+    in13 = None
+    for i in range(1, numyears - 1):
+        m = spikes[i]
+        if not m.any():
+            continue
+        if i == 1:
+            if numyears > 3:
+                signals[1, m] = np.where(signals[2, m] == signals[3, m], signals[2, m], 3)
+            else:
+                signals[1, m] = 3
+        elif i < numyears - 2:
+            a = signals[i - 2, m]
+            b = signals[i - 1, m]
+            c = signals[i + 1, m]
+            d = signals[i + 2, m]
+            val = np.where((a == b) | (c == d), b, signals[i, m])
+            val[~((a == b) | (c == d)) & ((a == 1) | (a == 3) | (d == 1) | (d == 3))] = 3
+            signals[i, m] = val
+        else:
+            signals[i, m] = np.where(signals[i - 1, m] == signals[i - 2, m], signals[i - 1, m], 3)
+    return signals
+
+def fillgaps(signals):
+    # Array version of the gap filling in cleansignal() for a (years, pixels) array, modified in place. Each pass fills no data (0) and possible forest (2) values from their neighbours in year order, and passes are repeated until no gaps remain or no more can be filled.
+    numyears = signals.shape[0]
+    gaps = numexpr.evaluate("(signals == 0) | (signals == 2)")
+    cols = np.where(gaps.any(axis = 0))[0]
+    numgaps = np.sum(gaps)
+    gaps = None
+    while len(cols) > 0 and numyears > 1:
+        sub = signals[:, cols]
+        gaps = numexpr.evaluate("(sub == 0) | (sub == 2)")
+        for i in range(numyears):
+            m = gaps[i]
+            if not m.any():
+                continue
+            val = sub[i, m]
+            if i == 0:
+                nxt = sub[1, m]
+                fill = (nxt == 1) | (nxt == 3)
+                val[fill] = nxt[fill]
+            elif i == 1:
+                prv = sub[0, m]
+                fill = (prv == 1) | (prv == 3)
+                val[fill] = prv[fill]
+                if numyears > 2:
+                    nxt = sub[2, m]
+                    fill2 = ~fill & ((nxt == 1) | (nxt == 3))
+                    val[fill2] = nxt[fill2]
+            elif i < numyears - 2:
+                prv = sub[i - 1, m]
+                nxt = sub[i + 1, m]
+                fill = (prv == nxt) & ((prv == 1) | (prv == 3))
+                val[fill] = prv[fill]
+                fill3 = ~fill & ((prv == 3) | (nxt == 3))
+                val[fill3] = 3
+                val[~fill & ~fill3 & ((prv == 1) | (nxt == 1))] = 1
+            elif i == numyears - 2:
+                prv = sub[i - 1, m]
+                nxt = sub[i + 1, m]
+                fill3 = (prv == 3) | (nxt == 3)
+                val[fill3] = 3
+                val[~fill3 & ((prv == 1) | (nxt == 1))] = 1
+            else:
+                prv = sub[i - 1, m]
+                fill = (prv == 1) | (prv == 3)
+                val[fill] = prv[fill]
+            sub[i, m] = val
+        signals[:, cols] = sub
+        gaps = numexpr.evaluate("(sub == 0) | (sub == 2)")
+        if np.sum(gaps) == numgaps: # signals without any forest or not forest values cannot be filled, cleansignal() would loop forever on these
+            break
+        numgaps = np.sum(gaps)
+        cols = cols[gaps.any(axis = 0)]
+        sub = None
+    gaps = None
+    return signals
+
+def cleansignalstack(signals):
+    # Array version of cleansignal() for a (years, pixels) array of forestry class signals, modified in place. As with cleansignal(), this should only be applied to signals that contain both forest or not forest (1, 3) and no data or possible forest (0, 2) values.
+    signals[numexpr.evaluate("(signals == 15)")] = 1
+    removespikes(signals)
+    fillgaps(signals)
+    removespikes(signals)
+    return signals
+
 def lcchange(signal, years, endyear):
     # This function takes a signal containing no data/ not forest/ possible forest/ forest values and determines afforestation, reforestation, and clearcut years. It takes code that was originally in the calcyearlychange() function, and was created so that yearly time-series data from CSVs could also be analysed.
     startclassval = 0
@@ -597,7 +817,6 @@ def lcchange(signal, years, endyear):
         if signal[0] == 1:
             afforestedval = years[signal.index(next(i for i in signal[1:] if i == 3))]
         for i in range(len(years) - 1, 0,-1):
-            print(i)
             if signal[i] == 3 and signal[i - 1] == 1:
                 year = years[i]
                 if year > afforestedval and (afforestedval > 0 or signal[0] == 3) and not refor:
@@ -635,6 +854,72 @@ def lcchange(signal, years, endyear):
         status = 1
     return startclassval, endclassval, afforestedval, clearcutval, reforestedval, status, statusyear
 
+def lcchangestack(signals, years, endyear):
+    # Array version of lcchange(). signals is a (years, pixels) array of cleaned forestry class values, and the outputs are one value per pixel. The results match those of the per-pixel loop in calcyearlychange().
+    numyears, numpixels = signals.shape
+    yeararr = np.array(years, dtype = np.uint16)
+    startclass = signals[0].copy()
+    endclass = signals[-1].copy()
+    afforested = np.zeros(numpixels, dtype = np.uint16)
+    clearcut = np.zeros(numpixels, dtype = np.uint16)
+    reforested = np.zeros(numpixels, dtype = np.uint16)
+    status = np.zeros(numpixels, dtype = np.uint8)
+    statusyear = np.zeros(numpixels, dtype = np.uint16)
+
+    isforest = (signals == 3)
+    has3 = isforest.any(axis = 0)
+    has1 = (signals == 1).any(axis = 0)
+    has0 = (signals == 0).any(axis = 0)
+    change = has3 & has1
+
+    # afforestation year is the first forest observation of pixels that start as not forest
+    afforest = change & (signals[0] == 1)
+    afforested[afforest] = yeararr[np.argmax(isforest, axis = 0)][afforest]
+
+    if numyears > 1:
+        prev = signals[:-1]
+        cur = signals[1:]
+        yeararr1 = yeararr[1:]
+        ind = np.arange(numyears - 1)[:, np.newaxis]
+
+        # reforestation is the latest not forest -> forest transition that comes after afforestation
+        refor = (cur == 3) & (prev == 1) & (yeararr1[:, np.newaxis] > afforested) & ((afforested > 0) | (signals[0] == 3))
+        hasrefor = refor.any(axis = 0)
+        lastrefor = numyears - 2 - np.argmax(refor[::-1], axis = 0)
+        reforested[change & hasrefor] = yeararr1[lastrefor][change & hasrefor]
+
+        # the per-pixel loop scans backwards and stops once both a reforestation and a clearcut have been found, so the clearcut year is the earliest forest -> not forest transition after the last reforestation, or the latest one before it
+        cut = (cur == 1) & (prev == 3)
+        hascut = cut.any(axis = 0)
+        lastcut = numyears - 2 - np.argmax(cut[::-1], axis = 0)
+        cutafter = cut & (ind > np.where(hasrefor, lastrefor, -1))
+        hascutafter = cutafter.any(axis = 0)
+        cutind = np.where(hascutafter, np.argmax(cutafter, axis = 0), lastcut)
+        clearcut[change & hascut] = yeararr1[cutind][change & hascut]
+
+        prev = None
+        cur = None
+        refor = None
+        cut = None
+        cutafter = None
+
+    lastforest = np.maximum(reforested, afforested)
+    iscut = change & (clearcut > lastforest)
+    diffyear = endyear - clearcut.astype(np.int32)
+    status[iscut & (diffyear < 5)] = 5 # recent clearcut
+    status[iscut & (diffyear >= 5) & (diffyear < 10)] = 4 # possible deforestation
+    status[iscut & (diffyear >= 10)] = 3 # deforested
+    statusyear[iscut] = clearcut[iscut]
+    isrefor = change & ~iscut & (reforested > afforested)
+    status[isrefor] = 6 # reforested
+    statusyear[isrefor] = reforested[isrefor]
+    isafor = change & ~iscut & ~isrefor & (afforested > 0)
+    status[isafor] = 7 # afforested
+    statusyear[isafor] = afforested[isafor]
+    status[~change & has3 & ~has0] = 2
+    status[~change & ~has3 & has1 & ~has0] = 1
+    return startclass, endclass, afforested, clearcut, reforested, status, statusyear
+
 def drawProgressBar(percent, pixnum,numpixels, barLen = 40):
     sys.stdout.write("\r")
     progress = ""
@@ -646,19 +931,65 @@ def drawProgressBar(percent, pixnum,numpixels, barLen = 40):
     sys.stdout.write("[ {} ] {:.2f}% ({}/{})".format(progress, percent * 100, pixnum, numpixels))
     sys.stdout.flush()
 
+def makedir(dirname):
+    # Creates a directory if it is missing. Another worker process may create it at the same time.
+    if not os.path.isdir(dirname):
+        try:
+            os.mkdir(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+
+badlistcache = {} # bad scene lists keyed by file, with the mtime they were read at
+
 def getbadlist(*args, **kwargs):
+    # Returns the YYYYDOY date strings of bad scenes. The file is only read again when it has changed.
     badlistfile = kwargs.get('badlist', ieo.badlandsat)
     badlist = []
     if os.path.isfile(badlistfile):
+        mtime = os.path.getmtime(badlistfile)
+        if badlistfile in badlistcache.keys() and badlistcache[badlistfile][0] == mtime:
+            return list(badlistcache[badlistfile][1])
         with open(badlistfile, 'r') as lines:
             for line in lines:
                 if len(line) >= 7:
                     badlist.append(line.rstrip())
+        badlistcache[badlistfile] = [mtime, list(badlist)]
     else:
         print('ERROR: file not found: {}'.format(badlistfile))
         logerror(badlistfile, 'File not found.')
     return badlist
 
+def getparentrasters(hdr):
+    # Returns the basenames of the parent rasters recorded by writedata(), in an ENVI header or in GeoTIFF metadata.
+    parents = []
+    if hdr.endswith('.tif'):
+        if os.path.isfile(hdr):
+            ds = gdal.Open(hdr)
+            item = ds.GetMetadataItem('PARENT_RASTERS')
+            ds = None
+            if item:
+                parents = [x.strip() for x in item.split(',') if len(x.strip()) > 0]
+    elif os.path.isfile(hdr):
+        with open(hdr, 'r') as lines:
+            for line in lines:
+                if line.startswith('parent rasters'):
+                    i = line.find('{') + 1
+                    j = line.find('}')
+                    parents = [x.strip() for x in line[i:j].split(',') if len(x.strip()) > 0]
+                    break
+    return parents
+
+def isstale(outfile, parents):
+    # Returns True if outfile is missing or older than any of its existing parent files.
+    if not os.path.isfile(outfile):
+        return True
+    mtime = os.path.getmtime(outfile)
+    for parent in parents:
+        if os.path.isfile(parent) and os.path.getmtime(parent) > mtime:
+            return True
+    return False
+
 def makereproctiledict(*args, **kwargs):
     if margs.dt4a:
         outsubdir = 'dt4a'
@@ -671,36 +1002,99 @@ def makereproctiledict(*args, **kwargs):
     badlistfile = kwargs.get('badlist', ieo.badlandsat)
     foresttograss = kwargs.get('foresttograss', outsubdir)
     if isinstance(foresttograss, int):
-        foresttograss = int(foresttograss)
+        foresttograss = str(foresttograss)
     probdir = os.path.join(os.path.join(config['DEFAULT']['baseoutputdir'], foresttograss), 'Probability')
     badlist = getbadlist()
     tiledict = {}
     year = startyear
     while year <= endyear:
-        flist = glob.glob(os.path.join(probdir, 'Obs_{}_*.hdr'.format(year)))
+        if outputformat == 'ENVI':
+            flist = glob.glob(os.path.join(probdir, 'Obs_{}_*.hdr'.format(year)))
+        else:
+            flist = glob.glob(os.path.join(probdir, 'Obs_{}_*.tif'.format(year)))
         if len(flist) > 0:
             for f in flist:
                 tilename = os.path.basename(f)[-7:-4]
-                with open(f, 'r') as lines:
-                    for line in lines:
-                        if line.startswith('parent rasters'):
-                            i = line.find('{') + 1
-                            j = line.find('}')
-                            fs = line.replace(' ','').split(',')
-                            for fs1 in fs:
-                                if fs1[9:16] in badlist:
-                                    if not year in tiledict.keys():
-                                        tiledict[year] = []
-                                    if not tilename in tiledict[year]:
-                                        tiledict[year].append(tilename)
+                for fs1 in getparentrasters(f):
+                    if fs1[9:16] in badlist:
+                        if not year in tiledict.keys():
+                            tiledict[year] = []
+                        if not tilename in tiledict[year]:
+                            tiledict[year].append(tilename)
         year += 1
     return tiledict
 
+def makeincrementalplan(tiles, foresttograss, *args, **kwargs):
+    # This function determines which tile-years and which tile change maps need to be rebuilt.
+    # A tile-year is stale if:
+    # 1. its Obs raster is missing,
+    # 2. the scenes or VRTs now selected by makeproclists() differ from the parent rasters recorded in its header (new, removed, or bad scenes),
+    # 3. any of those scenes or VRTs is newer than the Obs raster, or
+    # 4. its DT4_class or forestryclass raster is missing or older than the rasters it was built from.
+    # Tile-years written by streammaps() record the reflectance scenes they were streamed from, which makeproclists() does not list, so only rule 4 applies to them.
+    # A tile change map is stale if any of its years are stale or any forestryclass raster is newer than forestrystatus.
+    # Returns tiledict = {year: [tilenames]} and changetiles = [tilenames].
+    startyear = kwargs.get('startyear', margs.startyear)
+    endyear = kwargs.get('endyear', margs.endyear)
+    usecatfile = kwargs.get('usecatfile', not margs.usescenes)
+    badlistfile = kwargs.get('badlist', ieo.badlandsat)
+    if margs.dt4a:
+        outsubdir = 'dt4a'
+    elif margs.dt4b:
+        outsubdir = 'dt4b'
+    else:
+        outsubdir = str(foresttograss)
+    probdir = os.path.join(os.path.join(config['DEFAULT']['baseoutputdir'], outsubdir), 'Probability')
+    forestrydir = os.path.join(probdir, 'Forestry')
+    changedir = os.path.join(forestrydir, 'Change')
+    classnames = ['bogheath', 'heathforest', 'bogforest', 'forestry', 'cropgrass', 'urban', 'water']
+    tiledict = {}
+    changetiles = []
+    for tile in tiles:
+        tilename, tilegeom = gettile(tile)
+        tilestale = False
+        fclist = []
+        proclists = makeproclists(tilegeom, foresttograss, usecatfile, years = list(range(startyear, endyear + 1)), badlistfile = badlistfile, tilename = tilename)
+        for year in range(startyear, endyear + 1):
+            scenelist = [scene for scene in proclists[year] if str(year) in scene]
+            obsfile = productpath(probdir, 'Obs_{}_{}.dat'.format(year, tilename))
+            if len(scenelist) == 0 and not os.path.isfile(obsfile):
+                continue # nothing to build for this year
+            pctlist = [productpath(probdir, 'pct_{}_{}.dat'.format(year, tilename))] # multi-band pct file
+            if not os.path.isfile(pctlist[0]):
+                pctlist = [productpath(probdir, '{}_pct_{}_{}.dat'.format(classname, year, tilename)) for classname in classnames]
+            dt4classfile = productpath(probdir, 'DT4_class_{}_{}.dat'.format(year, tilename))
+            fcfile = productpath(forestrydir, 'forestryclass_{}_{}.dat'.format(year, tilename))
+            fclist.append(fcfile)
+            parents = getparentrasters(obsfile.replace('.dat', '.hdr'))
+            if len(parents) > 0 and all([parent.endswith('_ref_ITM.dat') for parent in parents]): # streamed
+                stale = isstale(dt4classfile, pctlist) or isstale(fcfile, [dt4classfile])
+            elif sorted(parents) != sorted([os.path.basename(scene) for scene in scenelist]):
+                stale = True
+            elif isstale(obsfile, scenelist) or isstale(dt4classfile, pctlist) or isstale(fcfile, [dt4classfile]):
+                stale = True
+            else:
+                stale = False
+            if stale:
+                if not year in tiledict.keys():
+                    tiledict[year] = []
+                tiledict[year].append(tilename)
+                tilestale = True
+        forestrystatusfile = productpath(changedir, 'forestrystatus_{}.dat'.format(tilename))
+        if len(fclist) > 0 and (tilestale or isstale(forestrystatusfile, fclist)):
+            changetiles.append(tilename)
+    return tiledict, changetiles
+
 ## Vector routines
 
-def makeproclist(tilegeom, foresttograss, usecatfile, *args, **kwargs):
-    # this function determines which processed DT4/a/b VRT files or scenes get used in calcprobabilityraster()
-    year = kwargs.get('year', None) # limit to a specific year
+def getcatalogdb(outsubdir):
+    # Returns the path of the scene catalog database written by ifordeovrt for a DT4/a/b output subdirectory.
+    return os.path.join(config['DEFAULT']['catdir'], '{}_proc.sqlite'.format(outsubdir))
+
+def makeproclists(tilegeom, foresttograss, usecatfile, *args, **kwargs):
+    # this function determines which processed DT4/a/b VRT files or scenes get used in calcprobabilityraster() for all years of a tile at once
+    # Returns a dict of lists of files keyed by year. If usecatfile is True and ifordeovrt has built the scene catalog database, candidates are taken from its tile overlap table when tilename is given and the table is current, else found through its R-tree. Otherwise the catalog shapefile or ieo.landsatshp is scanned once.
+    years = kwargs.get('years', None) # limit to a list of years
     dt4a = kwargs.get('dt4a', margs.dt4a)
     dt4b = kwargs.get('dt4b', margs.dt4b)
     if margs.dt4a:
@@ -710,13 +1104,46 @@ def makeproclist(tilegeom, foresttograss, usecatfile, *args, **kwargs):
     else:
         outsubdir = str(foresttograss)
     badlist = getbadlist()
-    proclist = []
+    proclists = {}
+    if years:
+        for year in years:
+            proclists[year] = []
 #    if foresttograss:
     dirname = kwargs.get('dirname', os.path.join(config['DEFAULT']['baseoutputdir'], '{}'.format(outsubdir)))
 #    else:
 #        dirname = kwargs.get('dirname', os.path.join(config['DEFAULT']['baseoutputdir'], outsubdir))
+    catdb = kwargs.get('catdb', getcatalogdb(outsubdir))
+    tilename = kwargs.get('tilename', None) # use the tile overlap table of the catalog database if it is current
+    shp = kwargs.get('shp', margs.shp)
+    minoverlap = kwargs.get('minoverlap', margs.minoverlap)
     
-    if not margs.usecatfile:
+    if usecatfile and os.path.isfile(catdb):
+        try:
+            conn = sqlite3.connect(catdb)
+            if tilename and overlapscurrent(conn, shp):
+                sql = 'SELECT s.VRT, s.Year, s.YearDOY, NULL FROM tileoverlaps o JOIN scenes s ON o.id = s.id WHERE o.Tile = ? AND o.Fraction >= ?'
+                params = [tilename, minoverlap]
+            else:
+                minX, maxX, minY, maxY = tilegeom.GetEnvelope()
+                sql = 'SELECT s.VRT, s.Year, s.YearDOY, s.WKT FROM scenes s JOIN scenes_rtree r ON s.id = r.id WHERE r.maxX >= ? AND r.minX <= ? AND r.maxY >= ? AND r.minY <= ?'
+                params = [minX, maxX, minY, maxY]
+            if years:
+                sql += ' AND s.Year IN ({})'.format(','.join(['?'] * len(years)))
+                params += list(years)
+            rows = conn.execute(sql + ' ORDER BY s.YearDOY', params).fetchall()
+            conn.close()
+        except sqlite3.Error as e:
+            print('ERROR: {}: {}'.format(os.path.basename(catdb), e))
+            logerror(catdb, e)
+            rows = []
+        for f, fyear, datestr, wkt in rows:
+            if not datestr in badlist and os.path.isfile(f) and (not wkt or tilegeom.Intersect(ogr.CreateGeometryFromWkt(wkt))):
+                if not fyear in proclists.keys():
+                    proclists[fyear] = []
+                proclists[fyear].append(f)
+        return proclists
+    
+    if not usecatfile or not margs.usecatfile:
         sceneshp = kwargs.get('sceneshp', ieo.landsatshp)
     else:
         catshpdir = os.path.join(config['DEFAULT']['catdir'], 'shp')
@@ -738,22 +1165,199 @@ def makeproclist(tilegeom, foresttograss, usecatfile, *args, **kwargs):
             else:
                 sceneid = feature.GetField('sceneID')
                 if foresttograss: 
-                    f = os.path.join(dirname, '{}_DT4class.dat'.format(sceneid))
+                    f = productpath(dirname, '{}_DT4class.dat'.format(sceneid))
                 else:
-                    f = os.path.join(dirname, '{}_{}class.dat'.format(sceneid, outsubdir))
+                    f = productpath(dirname, '{}_{}class.dat'.format(sceneid, outsubdir.replace('dt4', 'DT4')))
                 fyear = int(feature.GetField('acqDate')[:4])
             
             datestr = os.path.basename(f)[9:16]
-            if (year == fyear or not year) and os.path.isfile(f):
+            if (not years or fyear in years) and os.path.isfile(f):
                 geom = feature.GetGeometryRef()
                 if tilegeom.Intersect(geom) and not datestr in badlist:
-                    proclist.append(f)
+                    if not fyear in proclists.keys():
+                        proclists[fyear] = []
+                    proclists[fyear].append(f)
         except Exception as e:
             print('ERROR: {}: {}'.format(os.path.basename(sceneshp), e))
             logerror(sceneshp, e)
     layer = None
+    return proclists
+
+def makeproclist(tilegeom, foresttograss, usecatfile, *args, **kwargs):
+    # this function determines which processed DT4/a/b VRT files or scenes get used in calcprobabilityraster(), see makeproclists()
+    year = kwargs.get('year', None) # limit to a specific year
+    if year:
+        kwargs['years'] = [year]
+    proclists = makeproclists(tilegeom, foresttograss, usecatfile, **kwargs)
+    proclist = []
+    for fyear in sorted(proclists.keys()):
+        proclist.extend(proclists[fyear])
     return proclist
 
+def opentileoverlaps(conn):
+    # Creates the tile overlap tables of a scene catalog database if missing. 'tileoverlaps' holds the source window (xoff, yoff, xsize, ysize), its tile offset (col, row) and the fraction of the tile area covered by the footprint for each tile and catalog row that overlap, 'overlapstate' the catalog rows already processed and 'overlapgrid' the tile grid used.
+    conn.execute('CREATE TABLE IF NOT EXISTS tileoverlaps (id INTEGER, Tile TEXT, xoff INTEGER, yoff INTEGER, xsize INTEGER, ysize INTEGER, col INTEGER, row INTEGER, Fraction REAL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS overlapstate (id INTEGER PRIMARY KEY, VRT TEXT, WKT TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS overlapgrid (shp TEXT, mtime REAL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tileoverlaps_Tile ON tileoverlaps (Tile)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tileoverlaps_id ON tileoverlaps (id)')
+    conn.commit()
+
+def getgridmtime(shp):
+    # Returns the modification time of a tile grid shapefile, or 0 for a geodatabase layer.
+    if os.path.isfile(shp):
+        return os.path.getmtime(shp)
+    return 0.0
+
+def overlapscurrent(conn, shp):
+    # Returns True if the tile overlap table of a scene catalog database was built for tile grid shp and covers every catalog row as it is now.
+    try:
+        grid = conn.execute('SELECT shp, mtime FROM overlapgrid').fetchone()
+        if not grid or grid[0] != shp or grid[1] != getgridmtime(shp):
+            return False
+        missing = conn.execute('SELECT COUNT(*) FROM scenes s LEFT JOIN overlapstate o ON s.id = o.id AND s.VRT = o.VRT AND s.WKT = o.WKT WHERE o.id IS NULL').fetchone()[0]
+    except sqlite3.OperationalError: # no overlap tables yet
+        return False
+    return missing == 0
+
+def updatetileoverlaps(foresttograss, *args, **kwargs):
+    # Adds the tile overlaps of new or changed catalog rows to the tile overlap table of a scene catalog database. The whole table is rebuilt if the tile grid has changed.
+    shp = kwargs.get('shp', margs.shp)
+    if margs.dt4a:
+        outsubdir = 'dt4a'
+    elif margs.dt4b:
+        outsubdir = 'dt4b'
+    else:
+        outsubdir = str(foresttograss)
+    catdb = kwargs.get('catdb', getcatalogdb(outsubdir))
+    if not os.path.isfile(catdb):
+        return
+    conn = sqlite3.connect(catdb)
+    opentileoverlaps(conn)
+    grid = conn.execute('SELECT shp, mtime FROM overlapgrid').fetchone()
+    if not grid or grid[0] != shp or grid[1] != getgridmtime(shp):
+        print('Tile grid has changed, rebuilding tile overlap table of: {}'.format(os.path.basename(catdb)))
+        for table in ['tileoverlaps', 'overlapstate', 'overlapgrid']:
+            conn.execute('DELETE FROM {}'.format(table))
+        conn.execute('INSERT INTO overlapgrid VALUES (?, ?)', (shp, getgridmtime(shp)))
+    stale = conn.execute('SELECT o.id FROM overlapstate o LEFT JOIN scenes s ON s.id = o.id AND s.VRT = o.VRT AND s.WKT = o.WKT WHERE s.id IS NULL').fetchall()
+    for row in stale: # catalog rows that were removed or replaced
+        conn.execute('DELETE FROM tileoverlaps WHERE id = ?', row)
+        conn.execute('DELETE FROM overlapstate WHERE id = ?', row)
+    entries = conn.execute('SELECT s.id, s.VRT, s.WKT FROM scenes s LEFT JOIN overlapstate o ON s.id = o.id WHERE o.id IS NULL').fetchall()
+    if len(entries) == 0:
+        conn.commit()
+        conn.close()
+        return
+    print('Calculating tile overlaps for {} catalog entries in: {}'.format(len(entries), os.path.basename(catdb)))
+    tiles = []
+    for tile in readtiles(shp):
+        tilename, tilegeom = gettile(tile)
+        geoTrans, tilecols, tilerows = tilegrid(tile)
+        tiles.append([tilename, tilegeom, tilegeom.GetEnvelope(), tilegeom.GetArea(), geoTrans, tilecols, tilerows])
+    for rowid, vrt, wkt in entries:
+        geom = ogr.CreateGeometryFromWkt(wkt)
+        minX, maxX, minY, maxY = geom.GetEnvelope()
+        src = None
+        complete = True
+        for tilename, tilegeom, envelope, area, geoTrans, tilecols, tilerows in tiles:
+            if envelope[1] < minX or envelope[0] > maxX or envelope[3] < minY or envelope[2] > maxY or not tilegeom.Intersect(geom):
+                continue
+            if src is None: # only the geotransform and size are needed
+                ds = gdal.Open(vrt)
+                if not ds:
+                    print('ERROR: unable to open: {}'.format(vrt))
+                    logerror(vrt, 'Unable to open file.')
+                    complete = False
+                    break
+                src = (ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize)
+                ds = None
+            try:
+                window = tilewindow(geoTrans, tilecols, tilerows, *src)
+            except ValueError as e:
+                print('ERROR: {}: {}'.format(os.path.basename(vrt), e))
+                logerror(vrt, e)
+                complete = False
+                break
+            if window:
+                (xoff, yoff, xsize, ysize), (rowslice, colslice) = window
+                conn.execute('INSERT INTO tileoverlaps VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (rowid, tilename, xoff, yoff, xsize, ysize, colslice.start, rowslice.start, tilegeom.Intersection(geom).GetArea() / area))
+        if complete:
+            conn.execute('INSERT INTO overlapstate VALUES (?, ?, ?)', (rowid, vrt, wkt))
+        else: # left out of overlapstate, so that the table is not current and the row is retried by the next update
+            conn.execute('DELETE FROM tileoverlaps WHERE id = ?', (rowid,))
+    conn.commit()
+    conn.close()
+
+def gettileoverlaps(tilename, foresttograss, *args, **kwargs):
+    # Returns the source windows and tile slices of the catalog rows overlapping a tile as a dict keyed by VRT, in the form returned by tilewindow(). The dict is empty if the tile overlap table is missing or not current.
+    shp = kwargs.get('shp', margs.shp)
+    if margs.dt4a:
+        outsubdir = 'dt4a'
+    elif margs.dt4b:
+        outsubdir = 'dt4b'
+    else:
+        outsubdir = str(foresttograss)
+    catdb = kwargs.get('catdb', getcatalogdb(outsubdir))
+    overlaps = {}
+    if os.path.isfile(catdb):
+        conn = sqlite3.connect(catdb)
+        if overlapscurrent(conn, shp):
+            for vrt, xoff, yoff, xsize, ysize, col, row in conn.execute('SELECT s.VRT, o.xoff, o.yoff, o.xsize, o.ysize, o.col, o.row FROM tileoverlaps o JOIN scenes s ON o.id = s.id WHERE o.Tile = ?', (tilename,)):
+                overlaps[vrt] = ((xoff, yoff, xsize, ysize), (slice(row, row + ysize), slice(col, col + xsize)))
+        conn.close()
+    return overlaps
+
+def getscenetiles(sceneID, foresttograss, *args, **kwargs):
+    # Returns the names of the tiles fed by a Landsat scene through the VRTs in the scene catalog database.
+    shp = kwargs.get('shp', margs.shp)
+    if margs.dt4a:
+        outsubdir = 'dt4a'
+    elif margs.dt4b:
+        outsubdir = 'dt4b'
+    else:
+        outsubdir = str(foresttograss)
+    catdb = kwargs.get('catdb', getcatalogdb(outsubdir))
+    if not os.path.isfile(catdb):
+        print('ERROR: scene catalog database not found: {}'.format(catdb))
+        logerror(catdb, 'File not found.')
+        return []
+    conn = sqlite3.connect(catdb)
+    rows = conn.execute('SELECT s.WKT FROM scenes s JOIN scenerows m ON s.id = m.id WHERE m.sceneID = ?', (sceneID[:21],)).fetchall()
+    conn.close()
+    tilenames = []
+    for tilename, wkt in readtiles(shp):
+        tilegeom = ogr.CreateGeometryFromWkt(wkt)
+        for row in rows:
+            if tilegeom.Intersect(ogr.CreateGeometryFromWkt(row[0])):
+                tilenames.append(tilename)
+                break
+    return tilenames
+
+def gettile(tile):
+    # Returns the tile name and geometry of either an OGR tile feature or a [tilename, WKT] pair. The latter is used to pass tiles to worker processes.
+    if isinstance(tile, (list, tuple)):
+        return tile[0], ogr.CreateGeometryFromWkt(tile[1])
+    return tile.GetField('Tile'), tile.GetGeometryRef()
+
+def readtiles(shp):
+    # Returns the tiles of a tile grid shapefile or IEO geodatabase layer as a list of [tilename, WKT] pairs.
+    if shp.endswith('shp'): # Enable use of tiles now available in IEO 1.1.0
+        driver1 = ogr.GetDriverByName("ESRI Shapefile")
+        ds = driver1.Open(shp, 0)
+        layer = ds.GetLayer()
+    else:
+        driver1 = ogr.GetDriverByName("FileGDB")
+        gdb, lname = os.path.split(shp)
+        ds = driver1.Open(gdb, 0)
+        layer = ds.GetLayer(lname)
+    tiles = []
+    for tile in layer:
+        tiles.append([tile.GetField('Tile'), tile.GetGeometryRef().ExportToWkt()])
+    layer = None
+    ds = None
+    return tiles
+
 def makegrid(*args, **kwargs): # function deprecated: Further development will now occur as part of IEO 1.1.0 and higher
     import string
     minX = kwargs.get('minX', 418500.0)
@@ -843,6 +1447,542 @@ def checkintersect(tilegeom, extent):
     return rasterGeometry.Intersect(tilegeom)
     
 
+## Fmask index
+
+fmaskindexfile = os.path.join(config['DEFAULT']['catdir'], 'Fmask_index.csv')
+fmaskindexfields = ['SceneID', 'Fmask', 'mtime', 'Valid', 'Clear', 'Water', 'Shadow', 'Snow', 'Cloud', 'Tiles'] # 'Tiles' holds clear land pixel counts per tile as Tile:count pairs separated by semicolons
+
+def fmaskstats(fmaskfile, tiles, *args, **kwargs):
+    # Counts the Fmask/ cfmask classes of a scene (0 = clear land, 1 = water, 2 = cloud shadow, 3 = snow, 4 = cloud, 255 = fill) and the clear land pixels in each tile, a list of [tilename, WKT] pairs, that it overlaps. Returns an index entry as a dict.
+    # Returns None, and logs the error, if the file cannot be read.
+    windowsize = kwargs.get('windowsize', margs.windowsize)
+    try:
+        ds = gdal.Open(fmaskfile)
+        if not ds:
+            raise IOError('GDAL could not open the file.')
+        if ds.GetRasterBand(1).DataType != gdal.GDT_Byte:
+            raise ValueError('Fmask data type is {}, not Byte.'.format(gdal.GetDataTypeName(ds.GetRasterBand(1).DataType)))
+        gt = ds.GetGeoTransform()
+        ns = ds.RasterXSize
+        nl = ds.RasterYSize
+        counts = np.zeros(256, dtype = np.int64)
+        for window in blockwindows(ds, windowsize):
+            data = ds.GetRasterBand(1).ReadAsArray(*window)
+            counts += np.bincount(data.ravel(), minlength = 256)[:256]
+        tilecounts = []
+        for tilename, wkt in tiles:
+            minX, maxX, minY, maxY = ogr.CreateGeometryFromWkt(wkt).GetEnvelope()
+            px, py = world2Pixel(gt, minX, maxY)
+            plx, ply = world2Pixel(gt, maxX, minY)
+            px, py = max(px, 0), max(py, 0)
+            plx, ply = min(plx, ns), min(ply, nl)
+            if plx > px and ply > py:
+                data = ds.GetRasterBand(1).ReadAsArray(px, py, plx - px, ply - py)
+                clear = np.sum(numexpr.evaluate("(data == 0)"))
+                if clear > 0:
+                    tilecounts.append('{}:{}'.format(tilename, clear))
+    except Exception as e:
+        print('ERROR: There was an error reading Fmask file {}, skipping it: {}'.format(os.path.basename(fmaskfile), e))
+        logerror(fmaskfile, e)
+        return None
+    data = None
+    ds = None
+    return {'SceneID': os.path.basename(fmaskfile)[:21], 'Fmask': fmaskfile, 'mtime': int(os.path.getmtime(fmaskfile)), 'Valid': int(counts[:255].sum()), 'Clear': int(counts[0]), 'Water': int(counts[1]), 'Shadow': int(counts[2]), 'Snow': int(counts[3]), 'Cloud': int(counts[4]), 'Tiles': ';'.join(tilecounts)}
+
+def fmaskstatsworker(task):
+    fmaskfile, tiles, windowsize = task
+    return [fmaskfile, fmaskstats(fmaskfile, tiles, windowsize = windowsize)]
+
+def readfmaskindex(*args, **kwargs):
+    # Reads the Fmask index into a dict of entries keyed by SceneID.
+    indexfile = kwargs.get('indexfile', fmaskindexfile)
+    index = {}
+    if os.path.isfile(indexfile):
+        with open(indexfile, 'r') as lines:
+            for line in lines:
+                if not line.startswith('SceneID'):
+                    linelist = line.rstrip('\n').split(',')
+                    entry = dict(zip(fmaskindexfields, linelist))
+                    for key in ['mtime', 'Valid', 'Clear', 'Water', 'Shadow', 'Snow', 'Cloud']:
+                        entry[key] = int(entry[key])
+                    index[entry['SceneID']] = entry
+    return index
+
+def writefmaskindex(index, *args, **kwargs):
+    indexfile = kwargs.get('indexfile', fmaskindexfile)
+    makedir(os.path.dirname(indexfile))
+    with open(indexfile, 'w') as output:
+        output.write('{}\n'.format(','.join(fmaskindexfields)))
+        for SceneID in sorted(index.keys()):
+            output.write('{}\n'.format(','.join([str(index[SceneID][key]) for key in fmaskindexfields])))
+
+def appendfmaskindex(entry, *args, **kwargs):
+    # Appends a single entry to the Fmask index file as soon as it has been computed. readfmaskindex() keeps the last entry of a SceneID.
+    indexfile = kwargs.get('indexfile', fmaskindexfile)
+    with open(indexfile, 'a') as output:
+        output.write('{}\n'.format(','.join([str(entry[key]) for key in fmaskindexfields])))
+
+def makefmaskindex(*args, **kwargs):
+    # Builds or updates the persistent Fmask index. Only Fmask files that are new or have been modified since they were indexed are read. Returns the index.
+    fmaskdir = kwargs.get('fmaskdir', ieo.fmaskdir)
+    fmasklist = kwargs.get('fmasklist', None)
+    indexfile = kwargs.get('indexfile', fmaskindexfile)
+    shp = kwargs.get('shp', margs.shp)
+    workers = kwargs.get('workers', margs.workers)
+    windowsize = kwargs.get('windowsize', margs.windowsize)
+    overwrite = kwargs.get('overwrite', False)
+
+    if fmasklist is None:
+        fmasklist = glob.glob(os.path.join(fmaskdir, 'L*_cfmask.dat')) + glob.glob(os.path.join(fmaskdir, 'L*_fmask.dat'))
+    if overwrite:
+        index = {}
+    else:
+        index = readfmaskindex(indexfile = indexfile)
+    newlist = []
+    for f in fmasklist:
+        SceneID = os.path.basename(f)[:21]
+        if not SceneID in index.keys() or index[SceneID]['Fmask'] != f or index[SceneID]['mtime'] != int(os.path.getmtime(f)):
+            newlist.append(f)
+    if len(newlist) == 0:
+        return index
+
+    print('Adding {} Fmask files to the Fmask index: {}'.format(len(newlist), indexfile))
+    if overwrite or not os.path.isfile(indexfile):
+        writefmaskindex(index, indexfile = indexfile)
+    tiles = readtiles(shp)
+    tasks = [[f, tiles, windowsize] for f in newlist]
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initdt4worker, (loglock,))
+        entries = pool.imap_unordered(fmaskstatsworker, tasks)
+    else:
+        entries = map(fmaskstatsworker, tasks)
+    for fmaskfile, entry in entries: # entries are written as they arrive, so that an interrupted run keeps them
+        if entry:
+            index[entry['SceneID']] = entry
+            appendfmaskindex(entry, indexfile = indexfile)
+        elif os.path.basename(fmaskfile)[:21] in index.keys(): # the counts of a file that can no longer be read are not used
+            del index[os.path.basename(fmaskfile)[:21]]
+            writefmaskindex(index, indexfile = indexfile)
+    if workers > 1:
+        pool.close()
+        pool.join()
+    writefmaskindex(index, indexfile = indexfile) # drops superseded entries
+    return index
+
+def queryfmaskindex(index, minpixels, *args, **kwargs):
+    # Returns the SceneIDs in the Fmask index with at least minpixels clear land pixels, either in the whole scene or in tile 'tilename'. Scenes may also be limited by maximum cloud and cloud shadow fraction of valid pixels.
+    tilename = kwargs.get('tilename', None)
+    maxcloud = kwargs.get('maxcloud', None)
+    scenelist = []
+    for SceneID in sorted(index.keys()):
+        entry = index[SceneID]
+        if tilename:
+            clear = 0
+            for tilecount in entry['Tiles'].split(';'):
+                if tilecount.startswith('{}:'.format(tilename)):
+                    clear = int(tilecount.split(':')[1])
+        else:
+            clear = entry['Clear']
+        if clear < minpixels:
+            continue
+        if maxcloud != None and entry['Valid'] > 0 and float(entry['Cloud'] + entry['Shadow']) / entry['Valid'] > maxcloud:
+            continue
+        scenelist.append(SceneID)
+    return scenelist
+
+## Forestry mask index
+
+# The pixels of the national forestry mask that fall in each tile are stored once as sorted flat offsets (row * cols + col) into the tile grid in a single compressed NumPy archive, so that the change stage need neither read the whole mask nor search it for every tile. The archive holds 'maskfile' and 'maskmtime' entries and, per tile, 'grid_{tile}' = [ULx, ULy, pixel size, cols, rows] and 'offsets_{tile}'.
+maskindexfile = os.path.join(config['DEFAULT']['catdir'], 'forestrymask_index.npz')
+
+def tilegrid(tile):
+    # Returns the geotransform, columns and rows of the 30 m grid of a tile, as used for its probability and forestry class rasters.
+    tilename, tilegeom = gettile(tile)
+    minX, maxX, minY, maxY = tilegeom.GetEnvelope()
+    return (minX, 30, 0.0, maxY, 0.0, -30), int((maxX - minX) / 30), int((maxY - minY) / 30)
+
+def maskoffsets(ds, grids, *args, **kwargs):
+    # Scans forestry mask dataset ds once, window by window, and returns a dict of sorted int64 offsets of the masked pixels (value 1) for each tile grid in grids, a dict of (geoTrans, cols, rows) tuples keyed by tile name. Mask pixels are assigned to tile pixels by their upper left corner, as in the per-pixel change engine.
+    windowsize = kwargs.get('windowsize', margs.windowsize)
+    mask_gt = ds.GetGeoTransform()
+    offsets = {}
+    for tilename in grids.keys():
+        offsets[tilename] = []
+    for xoff, yoff, xsize, ysize in blockwindows(ds, windowsize):
+        data = ds.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize)
+        my, mx = np.nonzero(numexpr.evaluate('(data == 1)'))
+        data = None
+        if len(mx) == 0:
+            continue
+        mX = mask_gt[1] * (mx + xoff).astype(np.float64) + mask_gt[0]
+        mY = mask_gt[5] * (my + yoff).astype(np.float64) + mask_gt[3]
+        mx = None
+        my = None
+        wminX, wmaxX = mX.min(), mX.max()
+        wminY, wmaxY = mY.min(), mY.max()
+        for tilename in grids.keys():
+            geoTrans, ns, nl = grids[tilename]
+            if wmaxX < geoTrans[0] or wminX >= geoTrans[0] + ns * geoTrans[1] or wminY > geoTrans[3] or wmaxY <= geoTrans[3] - nl * geoTrans[1]:
+                continue
+            xs = np.trunc((mX - geoTrans[0]) / geoTrans[1]).astype(np.int64)
+            ys = np.trunc((geoTrans[3] - mY) / geoTrans[1]).astype(np.int64)
+            intile = numexpr.evaluate('(xs >= 0) & (xs < ns) & (ys >= 0) & (ys < nl)')
+            if intile.any():
+                offsets[tilename].append(ys[intile] * ns + xs[intile])
+    for tilename in grids.keys():
+        if len(offsets[tilename]) > 0:
+            offsets[tilename] = np.unique(np.concatenate(offsets[tilename]))
+        else:
+            offsets[tilename] = np.zeros(0, dtype = np.int64)
+    return offsets
+
+def makemaskindex(*args, **kwargs):
+    # Builds the forestry mask index for all tiles in a single pass over the national forestry mask. The index is only rebuilt if it is missing, was built from another mask file or is older than the mask, unless overwrite = True.
+    shp = kwargs.get('shp', margs.shp)
+    maskfile = kwargs.get('maskfile', margs.forestrymaskfile)
+    indexfile = kwargs.get('indexfile', maskindexfile)
+    windowsize = kwargs.get('windowsize', margs.windowsize)
+    overwrite = kwargs.get('overwrite', False)
+    if not os.path.isfile(maskfile):
+        print('ERROR: forestry mask file is missing: {}'.format(maskfile))
+        logerror(maskfile, 'Missing forestry mask file.')
+        return
+    if not overwrite and os.path.isfile(indexfile):
+        with np.load(indexfile) as index:
+            if str(index['maskfile']) == maskfile and float(index['maskmtime']) == os.path.getmtime(maskfile):
+                print('Forestry mask index is up to date: {}'.format(indexfile))
+                return
+    grids = {}
+    for tile in readtiles(shp):
+        grids[tile[0]] = tilegrid(tile)
+    print('Building forestry mask index for {} tiles from: {}'.format(len(grids), maskfile))
+    ds = gdal.Open(maskfile)
+    offsets = maskoffsets(ds, grids, windowsize = windowsize)
+    ds = None
+    arrays = {'maskfile': np.array(maskfile), 'maskmtime': np.array(os.path.getmtime(maskfile))}
+    for tilename in grids.keys():
+        geoTrans, ns, nl = grids[tilename]
+        arrays['grid_{}'.format(tilename)] = np.array([geoTrans[0], geoTrans[3], geoTrans[1], ns, nl], dtype = np.float64)
+        arrays['offsets_{}'.format(tilename)] = offsets[tilename]
+    tmpfile = indexfile.replace('.npz', '_tmp.npz')
+    np.savez_compressed(tmpfile, **arrays)
+    os.replace(tmpfile, indexfile) # workers never see a partially written index
+    print('Forestry mask index written to: {}'.format(indexfile))
+
+@functools.lru_cache(maxsize = margs.maskcachesize)
+def cachedmaskwindow(maskfile, maskmtime, geoTrans, ns, nl):
+    # Reads only the part of forestry mask maskfile that covers tile grid geoTrans, ns, nl and returns it as a read-only boolean (nl, ns) array in tile coordinates. Results are cached per process so that the probability and change stages of a tile share one read, maskmtime invalidates them when the mask is replaced.
+    ds = gdal.Open(maskfile)
+    mask_gt = ds.GetGeoTransform()
+    px, py = world2Pixel(mask_gt, geoTrans[0], geoTrans[3])
+    plx, ply = world2Pixel(mask_gt, geoTrans[0] + ns * geoTrans[1], geoTrans[3] - nl * geoTrans[1])
+    px, py = max(px - 1, 0), max(py - 1, 0) # one pixel margin for grids that are not aligned with the mask
+    plx, ply = min(plx + 2, ds.RasterXSize), min(ply + 2, ds.RasterYSize)
+    tilemask = np.zeros((nl, ns), dtype = bool)
+    if plx > px and ply > py:
+        data = ds.GetRasterBand(1).ReadAsArray(px, py, plx - px, ply - py)
+        my, mx = np.nonzero(numexpr.evaluate('(data == 1)'))
+        data = None
+        mX = mask_gt[1] * (mx + px).astype(np.float64) + mask_gt[0]
+        mY = mask_gt[5] * (my + py).astype(np.float64) + mask_gt[3]
+        xs = np.trunc((mX - geoTrans[0]) / geoTrans[1]).astype(np.int64)
+        ys = np.trunc((geoTrans[3] - mY) / geoTrans[1]).astype(np.int64)
+        intile = numexpr.evaluate('(xs >= 0) & (xs < ns) & (ys >= 0) & (ys < nl)')
+        tilemask[ys[intile], xs[intile]] = True
+    ds = None
+    tilemask.flags.writeable = False
+    return tilemask
+
+def readmaskwindow(geoTrans, ns, nl, *args, **kwargs):
+    # Returns the forestry mask of a tile grid as a read-only boolean (nl, ns) array, see cachedmaskwindow().
+    maskfile = kwargs.get('maskfile', margs.forestrymaskfile)
+    return cachedmaskwindow(maskfile, os.path.getmtime(maskfile), tuple(geoTrans), ns, nl)
+
+def getmaskpixels(tilename, geoTrans, ns, nl, *args, **kwargs):
+    # Returns the row and column arrays of the masked pixels of a tile with grid geoTrans, ns, nl. These are read from the forestry mask index when it is current and was built for the same grid. Otherwise they are taken from the tile window of the mask, without writing the index, so that concurrent workers do not race to rebuild it.
+    maskfile = kwargs.get('maskfile', margs.forestrymaskfile)
+    indexfile = kwargs.get('indexfile', maskindexfile)
+    offsets = None
+    if os.path.isfile(indexfile):
+        with np.load(indexfile) as index:
+            gridkey = 'grid_{}'.format(tilename)
+            if str(index['maskfile']) == maskfile and float(index['maskmtime']) == os.path.getmtime(maskfile) and gridkey in index.files:
+                if index[gridkey].tolist() == [geoTrans[0], geoTrans[3], geoTrans[1], ns, nl]:
+                    offsets = index['offsets_{}'.format(tilename)]
+    if offsets is None:
+        print('Forestry mask index is missing or stale for tile {}, reading tile window of mask file.'.format(tilename))
+        return np.nonzero(readmaskwindow(geoTrans, ns, nl, maskfile = maskfile))
+    return np.divmod(offsets, ns)
+
+## Time-series cube
+
+# The yearly forestry classes of a tile are also kept in one band sequential uint8 (years, rows, cols) raw file with an ENVI header, forestryclass_cube_{tile}.dat/.hdr in the Forestry directory.
+# Band i holds year 'start year' + i, unobserved years are 0, as for missing yearly rasters in calcyearlychange(). Cubes are always raw ENVI files so that they can be memory mapped.
+
+def cubefiles(indir, tilename):
+    # Returns the data and header file names of a tile time-series cube.
+    basename = os.path.join(indir, 'forestryclass_cube_{}'.format(tilename))
+    return basename + '.dat', basename + '.hdr'
+
+def readcubeheader(hdr):
+    # Returns a dict with startyear, bands, rows, cols, geotransform and observed years of a time-series cube, or None if there is no cube.
+    if not os.path.isfile(hdr):
+        return None
+    values = {}
+    with open(hdr, 'r') as lines:
+        for line in lines:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                values[key.strip()] = value.strip().strip('{}').strip()
+    header = {}
+    header['startyear'] = int(values['start year'])
+    header['bands'] = int(values['bands'])
+    header['rows'] = int(values['lines'])
+    header['cols'] = int(values['samples'])
+    header['geotransform'] = tuple([float(x) for x in values['geotransform'].split(',')])
+    header['observed'] = [int(x) for x in values['observed years'].split(',') if len(x.strip()) > 0]
+    return header
+
+def writecubeheader(hdr, tilename, header):
+    # Writes the ENVI header of a time-series cube, GDAL can open the cube as a band sequential ENVI file.
+    gt = header['geotransform']
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(2157) # Irish Transverse Mercator
+    srs.MorphToESRI()
+    with open(hdr, 'w') as output:
+        output.write('ENVI\n')
+        output.write('description = {{Forestry class time series for tile {}}}\n'.format(tilename))
+        output.write('samples = {}\n'.format(header['cols']))
+        output.write('lines = {}\n'.format(header['rows']))
+        output.write('bands = {}\n'.format(header['bands']))
+        output.write('header offset = 0\nfile type = ENVI Standard\ndata type = 1\ninterleave = bsq\nbyte order = 0\n')
+        output.write('map info = {{Arbitrary, 1, 1, {}, {}, {}, {}, units=Meters}}\n'.format(gt[0], gt[3], gt[1], -gt[5]))
+        output.write('coordinate system string = {{{}}}\n'.format(srs.ExportToWkt()))
+        output.write('band names = {{{}}}\n'.format(', '.join([str(header['startyear'] + i) for i in range(header['bands'])])))
+        output.write('start year = {}\n'.format(header['startyear']))
+        output.write('geotransform = {{{}}}\n'.format(', '.join([str(x) for x in gt])))
+        output.write('observed years = {{{}}}\n'.format(', '.join([str(x) for x in sorted(header['observed'])])))
+
+def updatecube(indir, tilename, year, data, geoTrans, *args, **kwargs):
+    # Writes one year of forestry classes into the tile time-series cube, creating the cube or extending its year range as needed.
+    startyear = kwargs.get('startyear', 1984)
+    endyear = kwargs.get('endyear', margs.endyear)
+    cubefile, hdr = cubefiles(indir, tilename)
+    rows, cols = data.shape
+    with cubelock:
+        header = readcubeheader(hdr)
+        if header and (header['rows'], header['cols']) == (rows, cols) and header['geotransform'] == tuple(geoTrans) and os.path.isfile(cubefile):
+            oldstart = header['startyear']
+            oldbands = header['bands']
+        else:
+            if header:
+                print('Tile {} geometry has changed, recreating the time-series cube.'.format(tilename))
+            header = {'startyear': min(startyear, year), 'bands': 0, 'rows': rows, 'cols': cols, 'geotransform': tuple(geoTrans), 'observed': []}
+            oldstart = header['startyear']
+            oldbands = 0
+        if oldbands == 0: # new cubes span startyear - endyear so that later years do not need a resize
+            newstart = min(startyear, year)
+            newend = max(endyear, year)
+        else:
+            newstart = min(oldstart, year)
+            newend = max(oldstart + oldbands - 1, year)
+        newbands = newend - newstart + 1
+        if newstart != oldstart or newbands != oldbands: # resize, copying any existing years into place
+            print('Resizing the time-series cube for tile {} to the years {} - {}.'.format(tilename, newstart, newend))
+            tmpfile = cubefile + '.tmp'
+            newcube = np.memmap(tmpfile, dtype = np.uint8, mode = 'w+', shape = (newbands, rows, cols))
+            if oldbands > 0:
+                oldcube = np.memmap(cubefile, dtype = np.uint8, mode = 'r', shape = (oldbands, rows, cols))
+                newcube[oldstart - newstart:oldstart - newstart + oldbands] = oldcube
+                del oldcube
+            newcube.flush()
+            del newcube
+            os.replace(tmpfile, cubefile)
+            header['startyear'] = newstart
+            header['bands'] = newbands
+        cube = np.memmap(cubefile, dtype = np.uint8, mode = 'r+', shape = (newbands, rows, cols))
+        cube[year - newstart] = data
+        cube.flush()
+        del cube
+        if not year in header['observed']:
+            header['observed'].append(year)
+        writecubeheader(hdr, tilename, header)
+
+def synccube(indir, tilename, years):
+    # Adds yearly forestry class rasters that are missing from the tile time-series cube or newer than it, e.g. those written before the cube existed or while it was not in use.
+    hdr = cubefiles(indir, tilename)[1]
+    header = readcubeheader(hdr)
+    if header:
+        cubetime = os.path.getmtime(hdr) # taken once, as each updated year rewrites the header
+    for year in years:
+        fname = productpath(indir, 'forestryclass_{}_{}.dat'.format(year, tilename))
+        if os.access(fname, os.F_OK) and (not header or not year in header['observed'] or os.path.getmtime(fname) > cubetime):
+            print('Adding {} to the time-series cube.'.format(os.path.basename(fname)))
+            ds = gdal.Open(fname)
+            updatecube(indir, tilename, year, ds.GetRasterBand(1).ReadAsArray(), ds.GetGeoTransform())
+            ds = None
+
+def opencube(indir, tilename):
+    # Returns a read only memory map of a tile time-series cube and its header, or (None, None) if there is no cube.
+    cubefile, hdr = cubefiles(indir, tilename)
+    header = readcubeheader(hdr)
+    if not header or not os.path.isfile(cubefile):
+        return None, None
+    return np.memmap(cubefile, dtype = np.uint8, mode = 'r', shape = (header['bands'], header['rows'], header['cols'])), header
+
+## Pixel queries
+
+queryfields = ['ID', 'X', 'Y', 'Tile', 'Signal', 'Cleaned', 'StartClass', 'EndClass', 'Afforested', 'Clearcut', 'Reforested', 'Status', 'StatusYear', 'Scenes']
+
+def readquerypoints(infile):
+    # Reads query points from a CSV file with X and Y columns in ITM and an optional ID column, or from a point shapefile. Returns a list of [ID, X, Y].
+    points = []
+    if infile.lower().endswith('.shp'):
+        ds = ogr.Open(infile, 0)
+        layer = ds.GetLayer()
+        layerdefn = layer.GetLayerDefn()
+        fieldnames = [layerdefn.GetFieldDefn(i).GetName() for i in range(layerdefn.GetFieldCount())]
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            if 'ID' in fieldnames:
+                ID = feature.GetField('ID')
+            else:
+                ID = feature.GetFID()
+            points.append([str(ID), geom.GetX(), geom.GetY()])
+        layer = None
+        ds = None
+    else:
+        with open(infile, 'r') as lines:
+            header = [x.strip().upper() for x in lines.readline().strip().split(',')]
+            for i, line in enumerate(lines):
+                line = line.strip().split(',')
+                if len(line) < len(header):
+                    continue
+                if 'ID' in header:
+                    ID = line[header.index('ID')]
+                else:
+                    ID = str(i + 1)
+                points.append([ID, float(line[header.index('X')]), float(line[header.index('Y')])])
+    return points
+
+def readpointvalues(ds, xs, ys):
+    # Returns the band 1 values of a dataset at ITM coordinates xs, ys in one read of the window covering all of them. Points outside the raster get 0.
+    gt = ds.GetGeoTransform()
+    cols = np.floor((xs - gt[0]) / gt[1]).astype(np.int64)
+    rows = np.floor((ys - gt[3]) / gt[5]).astype(np.int64)
+    inside = (cols >= 0) & (cols < ds.RasterXSize) & (rows >= 0) & (rows < ds.RasterYSize)
+    values = np.zeros(len(xs), dtype = np.uint8)
+    if inside.any():
+        c0, c1 = cols[inside].min(), cols[inside].max()
+        r0, r1 = rows[inside].min(), rows[inside].max()
+        data = ds.GetRasterBand(1).ReadAsArray(int(c0), int(r0), int(c1 - c0 + 1), int(r1 - r0 + 1))
+        values[inside] = data[rows[inside] - r0, cols[inside] - c0]
+    return values
+
+def querypixels(points, *args, **kwargs):
+    # Returns the yearly forestry class signal, cleaned signal, lcchange() results and scene level classifications for a list of [ID, X, Y] ITM points.
+    # Points are grouped by tile. For each tile the yearly forestry classes are read from the time-series cube, or else once from each yearly raster,
+    # and each scene classification or VRT that makeproclist() selects for the tile is read once for all of its points.
+    shp = kwargs.get('shp', margs.shp)
+    foresttograss = kwargs.get('foresttograss', None)
+    usecatfile = kwargs.get('usecatfile', True)
+    scenes = kwargs.get('scenes', True) # also read the scene level classifications
+    startyear = kwargs.get('startyear', 1984)
+    endyear = kwargs.get('endyear', margs.endyear)
+    usecube = kwargs.get('usecube', margs.usecube)
+    if margs.dt4a:
+        outsubdir = 'dt4a'
+    elif margs.dt4b:
+        outsubdir = 'dt4b'
+    else:
+        outsubdir = str(foresttograss)
+    indir = kwargs.get('indir', os.path.join(config['DEFAULT']['baseoutputdir'], r'{}\Probability\Forestry'.format(outsubdir)))
+    years = list(range(startyear, endyear + 1))
+    
+    tiledict = {}
+    for tilename, wkt in readtiles(shp):
+        tiledict[tilename] = [wkt, []]
+        minX, maxX, minY, maxY = ogr.CreateGeometryFromWkt(wkt).GetEnvelope()
+        tiledict[tilename].append((minX, maxX, minY, maxY))
+    results = []
+    for point in points:
+        ID, x, y = point
+        result = {'ID': ID, 'X': x, 'Y': y, 'Tile': None}
+        for tilename in tiledict.keys():
+            minX, maxX, minY, maxY = tiledict[tilename][2]
+            if x >= minX and x < maxX and y > minY and y <= maxY:
+                result['Tile'] = tilename
+                tiledict[tilename][1].append(len(results))
+                break
+        if not result['Tile']:
+            print('Point {} is outside of the tile grid.'.format(ID))
+        results.append(result)
+    
+    for tilename in sorted(tiledict.keys()):
+        wkt, indices, envelope = tiledict[tilename]
+        if len(indices) == 0:
+            continue
+        print('Querying {} points in tile {}.'.format(len(indices), tilename))
+        xs = np.array([results[i]['X'] for i in indices], dtype = np.float64)
+        ys = np.array([results[i]['Y'] for i in indices], dtype = np.float64)
+        signals = np.zeros((len(years), len(indices)), dtype = np.uint8)
+        tscube = None
+        if usecube:
+            synccube(indir, tilename, years)
+            tscube, cubeheader = opencube(indir, tilename)
+        if tscube is not None:
+            gt = cubeheader['geotransform']
+            cols = np.floor((xs - gt[0]) / gt[1]).astype(np.int64)
+            rows = np.floor((ys - gt[3]) / gt[5]).astype(np.int64)
+            inside = (cols >= 0) & (cols < cubeheader['cols']) & (rows >= 0) & (rows < cubeheader['rows'])
+            for i, year in enumerate(years):
+                j = year - cubeheader['startyear']
+                if j >= 0 and j < cubeheader['bands']:
+                    signals[i, inside] = tscube[j][rows[inside], cols[inside]]
+            tscube = None
+        else:
+            for i, year in enumerate(years):
+                fname = productpath(indir, 'forestryclass_{}_{}.dat'.format(year, tilename))
+                if os.access(fname, os.F_OK):
+                    ds = gdal.Open(fname)
+                    signals[i] = readpointvalues(ds, xs, ys)
+                    ds = None
+        cleaned = signals.copy()
+        clean = numexpr.evaluate('(cleaned == 1) | (cleaned == 3)').any(axis = 0) & numexpr.evaluate('(cleaned == 0) | (cleaned == 2)').any(axis = 0)
+        cleaned[:, clean] = cleansignalstack(cleaned[:, clean])
+        changes = lcchangestack(cleaned, years, endyear)
+        for k, i in enumerate(indices):
+            results[i]['Signal'] = signals[:, k].tolist()
+            results[i]['Cleaned'] = cleaned[:, k].tolist()
+            for fieldname, values in zip(queryfields[6:13], changes):
+                results[i][fieldname] = int(values[k])
+            results[i]['Scenes'] = []
+        if scenes:
+            scenelist = makeproclist(ogr.CreateGeometryFromWkt(wkt), foresttograss, usecatfile)
+            print('Reading {} scene classifications for tile {}.'.format(len(scenelist), tilename))
+            for scene in sorted(scenelist, key = lambda f: os.path.basename(f)[9:16]):
+                ds = gdal.Open(scene)
+                values = readpointvalues(ds, xs, ys)
+                ds = None
+                for k, i in enumerate(indices):
+                    if values[k] > 0:
+                        results[i]['Scenes'].append([os.path.basename(scene)[9:16], int(values[k])])
+    return results
+
+def writequeryresults(results, outfile):
+    # Writes querypixels() results to a CSV file. Signals are ';' separated yearly values, scenes are ';' separated YYYYDDD:class pairs.
+    print('Writing query results to: {}'.format(outfile))
+    with open(outfile, 'w') as output:
+        output.write('{}\n'.format(','.join(queryfields)))
+        for result in results:
+            if not result['Tile']:
+                output.write('{},{},{},,,,,,,,,,,\n'.format(result['ID'], result['X'], result['Y']))
+                continue
+            line = [result['ID'], result['X'], result['Y'], result['Tile'], ';'.join([str(x) for x in result['Signal']]), ';'.join([str(x) for x in result['Cleaned']])]
+            line += [result[fieldname] for fieldname in queryfields[6:13]]
+            line.append(';'.join(['{}:{}'.format(date, value) for date, value in result['Scenes']]))
+            output.write('{}\n'.format(','.join([str(x) for x in line])))
+
 ## Processing routines
 
 coeffdict = {}
@@ -851,6 +1991,141 @@ coeffdict['LT5'] = {'GRNIR':(0.662000 - 0.560000)/(0.830000 - 0.560000), 'NIRSWI
 coeffdict['LE7'] = {'GRNIR':(0.662000 - 0.560000)/(0.835000 - 0.560000), 'NIRSWIR12':(2.206000 - 1.648000)/(2.206000 - 0.835000)}
 coeffdict['LC8'] = {'GRNIR':(0.654600 - 0.561300)/(0.864600 - 0.561300), 'NIRSWIR12':(2.201000 - 1.609000)/(2.201000 - 0.864600)}
 
+def dt4features(blue, green, red, NIR, SWIR1, SWIR2, cfmaskdata, GRNIR, NIRSWIR12, *args, **kwargs):
+    # Evaluates the parts of the DT4 decision tree that do not depend on the forest to grassland NIR thresholds, in the rule order of the original rule by rule classification. Returns [base, vegclass, grass]:
+    # base: the class of each pixel where no threshold rule applies (classes 0 - 5 and 7)
+    # vegclass: 8 (mature forest) or 9 (possible forest or green heath) where the forest rules apply below minforesttograss, 0 elsewhere. Between minforesttograss and maxforesttograss these pixels become classes 10 and 11.
+    # grass: pixels that are grassland or cropland (class 6) at or above maxforesttograss
+    #
+    # Variables:
+    # blue - SWIR2: reflectance bands
+    # cfmaskdata: Fmask/ cfmask band, where 0 = clear land
+    # algorithm: 'DT4' or 'DT4a' use the original continuum removal estimates, 'DT4b' the corrected ones
+    algorithm = kwargs.get('algorithm', 'DT4b')
+
+    if algorithm == 'DT4b':
+        NIRSWIR = numexpr.evaluate("(SWIR2 - (SWIR2 - NIR) * NIRSWIR12 -  SWIR1) > 0")
+        GRNIRR = numexpr.evaluate("((NIR - green) * GRNIR + green -  red) > 0")
+    else:
+        NIRSWIR = numexpr.evaluate("((NIR + SWIR2) * NIRSWIR12 -  SWIR1) > 0")
+        GRNIRR = numexpr.evaluate("((green + NIR) * GRNIR -  red) > 0")
+
+    early = np.zeros(cfmaskdata.shape, dtype = np.uint8) # classes assigned before the threshold rules, 255 = none
+    numexpr.evaluate("where((cfmaskdata != 0) | (blue <= 0) | (blue >= 10000) | (green <= 0) | (green >= 10000) | (red <= 0) | (red >= 10000) | (NIR <= 0) | (NIR >= 10000) | (SWIR1 <= 0) | (SWIR1 >= 10000) | (SWIR2 <= 0) | (SWIR2 >= 10000), 0, " # Not clear land or bad pixels not caught by Fmask
+        "where((green > NIR) | (red > NIR), 1, " # Water
+        "where((blue < 1000) & (green < 1000) & (red < 1000) & (NIR < 1000) & (SWIR1 < 1000) & (SWIR2 < 1000), 2, 255)))", out = early, casting = 'unsafe') # Urban
+    base = np.zeros(cfmaskdata.shape, dtype = np.uint8)
+    numexpr.evaluate("where(early != 255, early, "
+        "where(GRNIRR & NIRSWIR, 7, " # Young forest
+        "where(GRNIRR & ~NIRSWIR & (NIR > SWIR1), 5, " # Heath
+        "where(~GRNIRR & (red < 1000), 3, " # Bog
+        "where((~GRNIRR & (red >= 1000)) | (GRNIRR & ~NIRSWIR), 4, 0)))))", out = base, casting = 'unsafe') # Bare soil
+    vegclass = np.zeros(cfmaskdata.shape, dtype = np.uint8)
+    numexpr.evaluate("where((early == 255) & (green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1), where(NIRSWIR, 8, 9), 0)", out = vegclass, casting = 'unsafe') # Mature forest, possible forest or green heath
+    grass = numexpr.evaluate("(early == 255) & (green > blue) & (green > red) & (green*4 < NIR) & NIRSWIR") # Grassland or cropland
+    early = None
+    NIRSWIR = None
+    GRNIRR = None
+    return [base, vegclass, grass]
+
+def dt4thresholdclasses(base, vegclass, grass, NIR, minforesttograss, maxforesttograss):
+    # Applies the NIR threshold rules of the DT4 decision tree to the output of dt4features(). Returns the uint8 class raster.
+    data = np.zeros(base.shape, dtype = np.uint8)
+    numexpr.evaluate("where((vegclass > 0) & (NIR < minforesttograss), vegclass, " # Mature forest, possible forest or green heath
+        "where((vegclass > 0) & (NIR < maxforesttograss), vegclass + 2, " # Mature forest or crop confusion, possible forest or green heath or crop confusion
+        "where(grass & (NIR >= maxforesttograss), 6, base)))", out = data, casting = 'unsafe') # Grassland or cropland
+    return data
+
+def dt4classes(blue, green, red, NIR, SWIR1, SWIR2, cfmaskdata, GRNIR, NIRSWIR12, minforesttograss, maxforesttograss, *args, **kwargs):
+    # Single pass decision tree shared by dt4(), DT4a() and DT4b(), see dt4features(). DT4 is the DT4a tree with minforesttograss = maxforesttograss, as classes 10 and 11 then never occur.
+    algorithm = kwargs.get('algorithm', 'DT4b')
+    base, vegclass, grass = dt4features(blue, green, red, NIR, SWIR1, SWIR2, cfmaskdata, GRNIR, NIRSWIR12, algorithm = algorithm)
+    return dt4thresholdclasses(base, vegclass, grass, NIR, minforesttograss, maxforesttograss)
+
+def blockwindows(ds, windowsize):
+    # Yields (xoff, yoff, xsize, ysize) windows covering a GDAL dataset. Windows are aligned to the block size of the first band and hold at most windowsize pixels where the block size allows. A windowsize of 0 or None returns the whole raster as one window.
+    ns = ds.RasterXSize
+    nl = ds.RasterYSize
+    if not windowsize:
+        yield 0, 0, ns, nl
+        return
+    bx, by = ds.GetRasterBand(1).GetBlockSize()
+    if bx >= ns or windowsize >= ns * by: # full width strips
+        wx = ns
+    else:
+        wx = max(bx, (windowsize // by) // bx * bx)
+    wy = max(by, (windowsize // wx) // by * by)
+    for yoff in range(0, nl, wy):
+        for xoff in range(0, ns, wx):
+            yield xoff, yoff, min(wx, ns - xoff), min(wy, nl - yoff)
+
+def countclearpixels(cfmask, *args, **kwargs):
+    # Returns the number of clear land pixels (value 0) in an open Fmask/ cfmask dataset, reading it window by window.
+    windowsize = kwargs.get('windowsize', margs.windowsize)
+    gooddata = 0
+    for window in blockwindows(cfmask, windowsize):
+        cfmaskdata = cfmask.GetRasterBand(1).ReadAsArray(*window)
+        gooddata += np.sum(numexpr.evaluate("(cfmaskdata == 0)"))
+    return gooddata
+
+def dt4windows(raster, cfmask, landsat, GRNIR, NIRSWIR12, minforesttograss, maxforesttograss, *args, **kwargs):
+    # Classifies an open surface reflectance dataset with dt4classes() one block aligned window at a time, so that only one window of the six reflectance bands and the Fmask band is held in memory. Returns the uint8 class raster.
+    # If thresholds is a list of foresttograss values, the threshold independent rules are evaluated once per window and only the NIR threshold rules are applied per value. The classifications are written to 'out', a list of (lines, samples) arrays, one per value, which may be memory maps on disk. Without 'out', a (thresholds, lines, samples) array is returned.
+    algorithm = kwargs.get('algorithm', 'DT4b')
+    windowsize = kwargs.get('windowsize', margs.windowsize)
+    thresholds = kwargs.get('thresholds', None)
+    out = kwargs.get('out', None)
+    if landsat == '8': # bands += 1
+        bandnums = [2, 3, 4, 5, 6, 7]
+    else:
+        bandnums = [1, 2, 3, 4, 5, 6]
+    if thresholds:
+        if out is None:
+            data = np.zeros((len(thresholds), cfmask.RasterYSize, cfmask.RasterXSize), dtype = np.uint8)
+            out = [data[i] for i in range(len(thresholds))]
+        else:
+            data = out
+    else:
+        data = np.zeros((cfmask.RasterYSize, cfmask.RasterXSize), dtype = np.uint8)
+    for xoff, yoff, xsize, ysize in blockwindows(raster, windowsize):
+        blue, green, red, NIR, SWIR1, SWIR2 = [raster.GetRasterBand(b).ReadAsArray(xoff, yoff, xsize, ysize) for b in bandnums]
+        cfmaskdata = cfmask.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize)
+        if thresholds:
+            base, vegclass, grass = dt4features(blue, green, red, NIR, SWIR1, SWIR2, cfmaskdata, GRNIR, NIRSWIR12, algorithm = 'DT4')
+            for i, foresttograss in enumerate(thresholds):
+                out[i][yoff:yoff + ysize, xoff:xoff + xsize] = dt4thresholdclasses(base, vegclass, grass, NIR, foresttograss, foresttograss)
+            base = None
+            vegclass = None
+            grass = None
+        else:
+            data[yoff:yoff + ysize, xoff:xoff + xsize] = dt4classes(blue, green, red, NIR, SWIR1, SWIR2, cfmaskdata, GRNIR, NIRSWIR12, minforesttograss, maxforesttograss, algorithm = algorithm)
+    blue = None
+    green = None
+    red = None
+    NIR = None
+    SWIR1 = None
+    SWIR2 = None
+    cfmaskdata = None
+    return data
+
+def getacqtime(infile):
+    # Returns the acquisition time header line for the classification of a reflectance file. For VRT inputs it is taken from the ENVI header of the matching surface reflectance file, otherwise it is set to 11:30 UTC on the acquisition date.
+    basename = os.path.basename(infile)
+    acqtime = ''
+    if not infile.endswith('.dat'):
+        flist = glob.glob(os.path.join(ieo.srdir, 'L*{}.dat'.format(basename[9:21])))
+        if len(flist) > 0:
+            hdr = flist[0].replace('.dat', '.hdr')
+        
+        with open(hdr, 'r') as lines: # Attempt to extract acquisition time data from ENVI header of input file
+            for line in lines:
+                if 'acquisition time' in line:
+                    acqtime = line
+    if acqtime == '':
+        datetuple = datetime.datetime.strptime(basename[9:16], '%Y%j')
+        acqtime =  'acquisition time = {}T11:30:00Z\n'.format(datetuple.strftime('%Y-%m-%d'))
+    return acqtime
+
 def dt4(infile, outdir, minpixels, foresttograss, *args, **kwargs):
     
     # By Guy Serbin, Spatial Analysis Unit, REDP, Teagasc National Food Research Centre, Ashtown, Dublin 15, Ireland.
@@ -866,10 +2141,19 @@ def dt4(infile, outdir, minpixels, foresttograss, *args, **kwargs):
     # This code was shamelessly adapted from an example in the ENVI help file.
     # This code makes use of the ENVI 5.x API.  It will not work in ealier versions.
     
+    # This is a single threshold call of dt4sweep().
+    sceneresult = dt4sweep(infile, [outdir], minpixels, [foresttograss], **kwargs)
+    return sceneresult[0][1], sceneresult[0][2]
+
+def dt4sweep(infile, outdirs, minpixels, thresholds, *args, **kwargs):
+    # Classifies a scene with the DT4 rules for several foresttograss values, reading the reflectance and Fmask data only once.
+    # outdirs and thresholds are matched lists, one output directory per foresttograss value.
+    # Returns a list of [outdir, success, message] for each output directory.
     cfmaskfile = kwargs.get('fmask', None)
     fmaskdir = kwargs.get('fmaskdir', ieo.fmaskdir)
     overwrite = kwargs.get('overwrite', margs.overwrite)
     listfile = kwargs.get('listfile', None)
+    windowsize = kwargs.get('windowsize', margs.windowsize)
     
     basename = os.path.basename(infile)
     SceneID = basename[:21]
@@ -885,36 +2169,40 @@ def dt4(infile, outdir, minpixels, foresttograss, *args, **kwargs):
                 logerror(cfmaskfile, 'File missing.')
                 if listfile:
                     ESPAreprocess(SceneID, listfile)
-                return False, 'No Fmask'
+                return [[outdir, False, 'No Fmask'] for outdir in outdirs]
     elif not fmaskdir and not cfmaskfile:
         print("Neither 'fmask' nor 'fmaskdir' have been defined for this scene, returning.")
         logerror(cfmaskfile, 'fmask or cfmask not defined.')
-        return False, 'No Fmask'
-    URI = os.path.join(outdir, basename.replace('_ref_ITM', '_DT4class'))
-    if URI.endswith('.vrt'):
-        URI = URI.replace('.vrt', '.dat')
-    if os.access(URI, os.F_OK):
-        if overwrite:
-            print('Found existing output file, deleting associated files and overwriting.')
-            files = glob.glob(URI.replace('.dat', '.*'))
-            for f in files:
-                os.remove(f)
-        else:
-            print('Found existing output file, skipping.')
-            return False, 'Output exists'
+        return [[outdir, False, 'No Fmask'] for outdir in outdirs]
+    sceneresult = []
+    pending = [] # indices of the thresholds still to be classified
+    for i, outdir in enumerate(outdirs):
+        URI = productpath(outdir, basename.replace('_ref_ITM', '_DT4class').replace('.vrt', '.dat'))
+        if os.access(URI, os.F_OK):
+            if overwrite:
+                print('Found existing output file, deleting associated files and overwriting.')
+                files = glob.glob(os.path.splitext(URI)[0] + '.*')
+                for f in files:
+                    os.remove(f)
+            else:
+                print('Found existing output file, skipping.')
+                sceneresult.append([outdir, False, 'Output exists'])
+                continue
+        pending.append(i)
+    if len(pending) == 0:
+        return sceneresult
   
     # Open Fmask file and use data to determine if scene is worth executing decision tree
     print("Found Fmask file {}, determining if scene is to be processed.".format(os.path.basename(cfmaskfile)))
     try: # Master Yoda: No. Try not. Do... or do not. There is no try.
         cfmask = gdal.Open(cfmaskfile)
         cfgt = cfmask.GetGeoTransform()
-        cfmaskdata = cfmask.GetRasterBand(1).ReadAsArray()
-        gooddata = np.sum(numexpr.evaluate("(cfmaskdata == 0)"))
+        gooddata = countclearpixels(cfmask, windowsize = windowsize)
         if gooddata < minpixels:
             print('There are an insufficient number of clear land pixels in this scene, returning.')
             cfmask = None
             gooddata = None
-            return False, 'Insufficient pixels'
+            return sceneresult + [[outdirs[i], False, 'Insufficient pixels'] for i in pending]
         else:
             print('A sufficient number of clear land pixels have been found in the scene, processing.')
             gooddata = None
@@ -923,79 +2211,48 @@ def dt4(infile, outdir, minpixels, foresttograss, *args, **kwargs):
         logerror(cfmaskfile, e) 
         if listfile:
             ESPAreprocess(SceneID, listfile)
-        return False, 'Fmask error'
+        return sceneresult + [[outdirs[i], False, 'Fmask error'] for i in pending]
+    tmpfiles = []
     try:
-        acqtime = ''
         # Open main data set
         raster = gdal.Open(infile)
         
         # Get data acquisition time 
-        if infile.endswith('.dat'):
-            hdr = infile.replace('.dat', '.hdr')
-        else:
-            flist = glob.glob(os.path.join(ieo.srdir, 'L*{}.dat'.format(basename[9:21])))
-            if len(flist) > 0:
-                hdr = flist[0].replace('.dat', '.hdr')
-            acqtime = '' # Attempt to extract acquisition time data from ENVI header of input file
-        
-            with open(hdr, 'r') as lines:
-                for line in lines:
-                    if 'acquisition time' in line:
-                        acqtime = line
-        if acqtime == '':
-            datetuple = datetime.datetime.strptime(basename[9:16], '%Y%j')
-            acqtime =  'acquisition time = {}T11:30:00Z\n'.format(datetuple.strftime('%Y-%m-%d'))
+        acqtime = getacqtime(infile)
         
         # Get file geometry
         geoTrans = raster.GetGeoTransform()
         ns = cfmask.RasterXSize
         nl = cfmask.RasterYSize
         
-        if landsat == '8': # bands += 1
-            blue = raster.GetRasterBand(2).ReadAsArray()
-            green  =raster.GetRasterBand(3).ReadAsArray()
-            red = raster.GetRasterBand(4).ReadAsArray()
-            NIR = raster.GetRasterBand(5).ReadAsArray()
-            SWIR1 = raster.GetRasterBand(6).ReadAsArray()
-            SWIR2 = raster.GetRasterBand(7).ReadAsArray()
-        else:
-            blue = raster.GetRasterBand(1).ReadAsArray()
-            green = raster.GetRasterBand(2).ReadAsArray()
-            red = raster.GetRasterBand(3).ReadAsArray()
-            NIR = raster.GetRasterBand(4).ReadAsArray()
-            SWIR1 = raster.GetRasterBand(5).ReadAsArray()
-            SWIR2 = raster.GetRasterBand(6).ReadAsArray()
-    
-        # Execute decision tree
-        data = np.zeros((nl, ns), dtype = np.uint8)
-        goodpixels = np.zeros((nl, ns), dtype = np.uint8) 
-        cfmaskdata[numexpr.evaluate("(cfmaskdata == 0) & ((blue <= 0) | (blue >= 10000) | (green <= 0) | (green >= 10000) | (red <= 0) | (red >= 10000) | (NIR <= 0) | (NIR >= 10000) | (SWIR1 <= 0) | (SWIR1 >= 10000) | (SWIR2 <= 0) | (SWIR2 >= 10000))")] = 5 # Mask to eliminate bad pixels not caught by Fmask
-        
-        data[numexpr.evaluate("((green > NIR) | (red > NIR)) & (cfmaskdata == 0)")] = 1 # Water
-        data[numexpr.evaluate("(blue < 1000) & (green < 1000) & (red < 1000) & (NIR < 1000) & (SWIR1 < 1000) & (SWIR2 < 1000) & (cfmaskdata == 0) & (data == 0)")] = 2 # Urban
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) > 0) & (NIR < foresttograss) & (cfmaskdata == 0)) & (data == 0)")] = 8 # Mature forest
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) <= 0) & (NIR < foresttograss) & (cfmaskdata == 0)) & (data == 0)")] = 9 # Possible forest or green heath
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR >= foresttograss) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) > 0) & (cfmaskdata == 0)) & (data == 0)")] = 6 # Grassland or cropland
-        data[numexpr.evaluate("(((((green + NIR) * GRNIR -  red) > 0)) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) > 0) & (cfmaskdata == 0)) & (data == 0)")] = 7 # Young forest
-        data[numexpr.evaluate("(((((green + NIR) * GRNIR -  red) > 0)) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) <= 0) & (NIR > SWIR1) & (cfmaskdata == 0)) & (data == 0)")] = 5 # Heath
-        data[numexpr.evaluate("(((((green + NIR) * GRNIR -  red) <= 0)) & (red < 1000) & (cfmaskdata == 0)) & (data == 0)")] = 3 # Bog
-        data[numexpr.evaluate("(((((((green + NIR) * GRNIR -  red) <= 0)) & (red >= 1000)) | (((((green + NIR) * GRNIR -  red) > 0)) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) <= 0))) & (cfmaskdata == 0)) & (data == 0)")] = 4 # Bare soil
+        # Execute decision tree for all pending thresholds in one pass over the scene. Each classification is written window by window to a memory map in its output directory, so that only one window is held in memory.
+        tmpfiles = [os.path.join(outdirs[i], '{}_DT4class.tmp.npy'.format(SceneID)) for i in pending]
+        data = [np.lib.format.open_memmap(tmpfile, mode = 'w+', dtype = np.uint8, shape = (nl, ns)) for tmpfile in tmpfiles]
+        dt4windows(raster, cfmask, landsat, GRNIR, NIRSWIR12, None, None, thresholds = [thresholds[i] for i in pending], out = data, windowsize = windowsize)
     except Exception as e:
         print('There was an error with the reflectance data file, logging and skipping scene: {}'.format(e))
         logerror(infile, e)
-        return False, 'Processing error'
+        data = None
+        for tmpfile in tmpfiles:
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+        return sceneresult + [[outdirs[i], False, 'Processing error'] for i in pending]
     
     # Write output data to disk
     print('Writing data to disk.')
     parentrasters = [infile, cfmaskfile]
-    writedata(data, 'DT4', geoTrans, foresttograss = foresttograss, acqtime = acqtime, SceneID = SceneID, outdir = outdir, rasters = parentrasters)
+    for j, i in enumerate(pending):
+        writedata(data[j], 'DT4', geoTrans, foresttograss = thresholds[i], acqtime = acqtime, SceneID = SceneID, outdir = outdirs[i], rasters = parentrasters)
+        data[j] = None
+        os.remove(tmpfiles[j])
+        sceneresult.append([outdirs[i], True, 'Success'])
     
     # Close open files
     data = None
     raster = None
     cfmask = None
     print("Scene has been classified.")
-    return True, 'Success'
+    return sceneresult
 
 
 def DT4a(infile, outdir, minpixels, *args, **kwargs):
@@ -1019,6 +2276,7 @@ def DT4a(infile, outdir, minpixels, *args, **kwargs):
     listfile = kwargs.get('listfile', None)
     minforesttograss = kwargs.get('minforesttograss', margs.minforesttograss)
     maxforesttograss = kwargs.get('maxforesttograss', margs.maxforesttograss)
+    windowsize = kwargs.get('windowsize', margs.windowsize)
     
     basename = os.path.basename(infile)
     SceneID = basename[:21]
@@ -1039,13 +2297,11 @@ def DT4a(infile, outdir, minpixels, *args, **kwargs):
         print("Neither 'fmask' nor 'fmaskdir' have been defined for this scene, returning.")
         logerror(cfmaskfile, 'fmask or cfmask not defined.')
         return False, 'No Fmask'
-    URI = os.path.join(outdir, basename.replace('_ref_ITM', '_DT4class'))
-    if URI.endswith('.vrt'):
-        URI = URI.replace('.vrt', '.dat')
+    URI = productpath(outdir, basename.replace('_ref_ITM', '_DT4class').replace('.vrt', '.dat'))
     if os.access(URI, os.F_OK):
         if overwrite:
             print('Found existing output file, deleting associated files and overwriting.')
-            files = glob.glob(URI.replace('.dat', '.*'))
+            files = glob.glob(os.path.splitext(URI)[0] + '.*')
             for f in files:
                 os.remove(f)
         else:
@@ -1057,8 +2313,7 @@ def DT4a(infile, outdir, minpixels, *args, **kwargs):
     try: # Master Yoda: No. Try not. Do... or do not. There is no try.
         cfmask = gdal.Open(cfmaskfile)
         cfgt = cfmask.GetGeoTransform()
-        cfmaskdata = cfmask.GetRasterBand(1).ReadAsArray()
-        gooddata = np.sum(numexpr.evaluate("(cfmaskdata == 0)"))
+        gooddata = countclearpixels(cfmask, windowsize = windowsize)
         if gooddata < minpixels:
             print('There are an insufficient number of clear land pixels in this scene, returning.')
             cfmask = None
@@ -1074,63 +2329,17 @@ def DT4a(infile, outdir, minpixels, *args, **kwargs):
             ESPAreprocess(SceneID, listfile)
         return False, 'Fmask error'
     try:
-        acqtime = ''
         # Open main data set
         raster = gdal.Open(infile)
         
         # Get data acquisition time 
-        if infile.endswith('.dat'):
-            hdr = infile.replace('.dat', '.hdr')
-        else:
-            flist = glob.glob(os.path.join(ieo.srdir, 'L*{}.dat'.format(basename[9:21])))
-            if len(flist) > 0:
-                hdr = flist[0].replace('.dat', '.hdr')
-            acqtime = '' # Attempt to extract acquisition time data from ENVI header of input file
-        
-            with open(hdr, 'r') as lines:
-                for line in lines:
-                    if 'acquisition time' in line:
-                        acqtime = line
-        if acqtime == '':
-            datetuple = datetime.datetime.strptime(basename[9:16], '%Y%j')
-            acqtime =  'acquisition time = {}T11:30:00Z\n'.format(datetuple.strftime('%Y-%m-%d'))
+        acqtime = getacqtime(infile)
         
         # Get file geometry
         geoTrans = raster.GetGeoTransform()
-        ns = cfmask.RasterXSize
-        nl = cfmask.RasterYSize
         
-        if landsat == '8': # bands += 1
-            blue = raster.GetRasterBand(2).ReadAsArray()
-            green  =raster.GetRasterBand(3).ReadAsArray()
-            red = raster.GetRasterBand(4).ReadAsArray()
-            NIR = raster.GetRasterBand(5).ReadAsArray()
-            SWIR1 = raster.GetRasterBand(6).ReadAsArray()
-            SWIR2 = raster.GetRasterBand(7).ReadAsArray()
-        else:
-            blue = raster.GetRasterBand(1).ReadAsArray()
-            green = raster.GetRasterBand(2).ReadAsArray()
-            red = raster.GetRasterBand(3).ReadAsArray()
-            NIR = raster.GetRasterBand(4).ReadAsArray()
-            SWIR1 = raster.GetRasterBand(5).ReadAsArray()
-            SWIR2 = raster.GetRasterBand(6).ReadAsArray()
-    
         # Execute decision tree
-        data = np.zeros((nl, ns), dtype = np.uint8)
-        goodpixels = np.zeros((nl, ns), dtype = np.uint8) 
-        cfmaskdata[numexpr.evaluate("(cfmaskdata == 0) & ((blue <= 0) | (blue >= 10000) | (green <= 0) | (green >= 10000) | (red <= 0) | (red >= 10000) | (NIR <= 0) | (NIR >= 10000) | (SWIR1 <= 0) | (SWIR1 >= 10000) | (SWIR2 <= 0) | (SWIR2 >= 10000))")] = 5 # Mask to eliminate bad pixels not caught by Fmask
-        
-        data[numexpr.evaluate("((green > NIR) | (red > NIR)) & (cfmaskdata == 0)")] = 1 # Water
-        data[numexpr.evaluate("(blue < 1000) & (green < 1000) & (red < 1000) & (NIR < 1000) & (SWIR1 < 1000) & (SWIR2 < 1000) & (cfmaskdata == 0) & (data == 0)")] = 2 # Urban
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) > 0) & (NIR < minforesttograss) & (cfmaskdata == 0)) & (data == 0)")] = 8 # Mature forest
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) <= 0) & (NIR < minforesttograss) & (cfmaskdata == 0)) & (data == 0)")] = 9 # Possible forest or green heath
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) > 0) & (NIR < maxforesttograss) & (cfmaskdata == 0)) & (data == 0)")] = 10 # Mature forest or crop confusion
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) <= 0) & (NIR < maxforesttograss) & (cfmaskdata == 0)) & (data == 0)")] = 11 # Possible forest or green heath or crop confusion
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR >= maxforesttograss) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) > 0) & (cfmaskdata == 0)) & (data == 0)")] = 6 # Grassland or cropland
-        data[numexpr.evaluate("(((((green + NIR) * GRNIR -  red) > 0)) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) > 0) & (cfmaskdata == 0)) & (data == 0)")] = 7 # Young forest
-        data[numexpr.evaluate("(((((green + NIR) * GRNIR -  red) > 0)) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) <= 0) & (NIR > SWIR1) & (cfmaskdata == 0)) & (data == 0)")] = 5 # Heath
-        data[numexpr.evaluate("(((((green + NIR) * GRNIR -  red) <= 0)) & (red < 1000) & (cfmaskdata == 0)) & (data == 0)")] = 3 # Bog
-        data[numexpr.evaluate("(((((((green + NIR) * GRNIR -  red) <= 0)) & (red >= 1000)) | (((((green + NIR) * GRNIR -  red) > 0)) & (((NIR + SWIR2) * NIRSWIR12 -  SWIR1) <= 0))) & (cfmaskdata == 0)) & (data == 0)")] = 4 # Bare soil
+        data = dt4windows(raster, cfmask, landsat, GRNIR, NIRSWIR12, minforesttograss, maxforesttograss, algorithm = 'DT4a', windowsize = windowsize)
     except Exception as e:
         print('There was an error with the reflectance data file, logging and skipping scene: {}'.format(e))
         logerror(infile, e)
@@ -1167,6 +2376,7 @@ def DT4b(infile, outdir, minpixels, *args, **kwargs):
     listfile = kwargs.get('listfile', None)
     minforesttograss = kwargs.get('minforesttograss', margs.minforesttograss)
     maxforesttograss = kwargs.get('maxforesttograss', margs.maxforesttograss)
+    windowsize = kwargs.get('windowsize', margs.windowsize)
     
     basename = os.path.basename(infile)
     SceneID = basename[:21]
@@ -1187,13 +2397,11 @@ def DT4b(infile, outdir, minpixels, *args, **kwargs):
         print("Neither 'fmask' nor 'fmaskdir' have been defined for this scene, returning.")
         logerror(cfmaskfile, 'fmask or cfmask not defined.')
         return False, 'No Fmask'
-    URI = os.path.join(outdir, basename.replace('_ref_ITM', '_DT4class'))
-    if URI.endswith('.vrt'):
-        URI = URI.replace('.vrt', '.dat')
+    URI = productpath(outdir, basename.replace('_ref_ITM', '_DT4class').replace('.vrt', '.dat'))
     if os.access(URI, os.F_OK):
         if overwrite:
             print('Found existing output file, deleting associated files and overwriting.')
-            files = glob.glob(URI.replace('.dat', '.*'))
+            files = glob.glob(os.path.splitext(URI)[0] + '.*')
             for f in files:
                 os.remove(f)
         else:
@@ -1205,8 +2413,7 @@ def DT4b(infile, outdir, minpixels, *args, **kwargs):
     try: # Master Yoda: No. Try not. Do... or do not. There is no try.
         cfmask = gdal.Open(cfmaskfile)
         cfgt = cfmask.GetGeoTransform()
-        cfmaskdata = cfmask.GetRasterBand(1).ReadAsArray()
-        gooddata = np.sum(numexpr.evaluate("(cfmaskdata == 0)"))
+        gooddata = countclearpixels(cfmask, windowsize = windowsize)
         if gooddata < minpixels:
             print('There are an insufficient number of clear land pixels in this scene, returning.')
             cfmask = None
@@ -1222,63 +2429,17 @@ def DT4b(infile, outdir, minpixels, *args, **kwargs):
             ESPAreprocess(SceneID, listfile)
         return False, 'Fmask error'
     try:
-        acqtime = ''
         # Open main data set
         raster = gdal.Open(infile)
         
         # Get data acquisition time 
-        if infile.endswith('.dat'):
-            hdr = infile.replace('.dat', '.hdr')
-        else:
-            flist = glob.glob(os.path.join(ieo.srdir, 'L*{}.dat'.format(basename[9:21])))
-            if len(flist) > 0:
-                hdr = flist[0].replace('.dat', '.hdr')
-            acqtime = '' # Attempt to extract acquisition time data from ENVI header of input file
-        
-            with open(hdr, 'r') as lines:
-                for line in lines:
-                    if 'acquisition time' in line:
-                        acqtime = line
-        if acqtime == '':
-            datetuple = datetime.datetime.strptime(basename[9:16], '%Y%j')
-            acqtime =  'acquisition time = {}T11:30:00Z\n'.format(datetuple.strftime('%Y-%m-%d'))
+        acqtime = getacqtime(infile)
         
         # Get file geometry
         geoTrans = raster.GetGeoTransform()
-        ns = cfmask.RasterXSize
-        nl = cfmask.RasterYSize
         
-        if landsat == '8': # bands += 1
-            blue = raster.GetRasterBand(2).ReadAsArray()
-            green  =raster.GetRasterBand(3).ReadAsArray()
-            red = raster.GetRasterBand(4).ReadAsArray()
-            NIR = raster.GetRasterBand(5).ReadAsArray()
-            SWIR1 = raster.GetRasterBand(6).ReadAsArray()
-            SWIR2 = raster.GetRasterBand(7).ReadAsArray()
-        else:
-            blue = raster.GetRasterBand(1).ReadAsArray()
-            green = raster.GetRasterBand(2).ReadAsArray()
-            red = raster.GetRasterBand(3).ReadAsArray()
-            NIR = raster.GetRasterBand(4).ReadAsArray()
-            SWIR1 = raster.GetRasterBand(5).ReadAsArray()
-            SWIR2 = raster.GetRasterBand(6).ReadAsArray()
-    
         # Execute decision tree
-        data = np.zeros((nl, ns), dtype = np.uint8)
-        goodpixels = np.zeros((nl, ns), dtype = np.uint8) 
-        cfmaskdata[numexpr.evaluate("(cfmaskdata == 0) & ((blue <= 0) | (blue >= 10000) | (green <= 0) | (green >= 10000) | (red <= 0) | (red >= 10000) | (NIR <= 0) | (NIR >= 10000) | (SWIR1 <= 0) | (SWIR1 >= 10000) | (SWIR2 <= 0) | (SWIR2 >= 10000))")] = 5 # Mask to eliminate bad pixels not caught by Fmask
-        
-        data[numexpr.evaluate("((green > NIR) | (red > NIR)) & (cfmaskdata == 0)")] = 1 # Water
-        data[numexpr.evaluate("(blue < 1000) & (green < 1000) & (red < 1000) & (NIR < 1000) & (SWIR1 < 1000) & (SWIR2 < 1000) & (cfmaskdata == 0) & (data == 0)")] = 2 # Urban
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & ((SWIR2 - (SWIR2 - NIR) * NIRSWIR12 -  SWIR1) > 0) & (NIR < minforesttograss) & (cfmaskdata == 0)) & (data == 0)")] = 8 # Mature forest
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & ((SWIR2 - (SWIR2 - NIR) * NIRSWIR12 -  SWIR1) <= 0) & (NIR < minforesttograss) & (cfmaskdata == 0)) & (data == 0)")] = 9 # Possible forest or green heath
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & ((SWIR2 - (SWIR2 - NIR) * NIRSWIR12 -  SWIR1) > 0) & (NIR < maxforesttograss) & (cfmaskdata == 0)) & (data == 0)")] = 10 # Mature forest or crop confusion
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & ((SWIR2 - (SWIR2 - NIR) * NIRSWIR12 -  SWIR1) <= 0) & (NIR < maxforesttograss) & (cfmaskdata == 0)) & (data == 0)")] = 11 # Possible forest or green heath or crop confusion
-        data[numexpr.evaluate("((green > blue) & (green > red) & (green*4 < NIR) & (NIR >= maxforesttograss) & ((SWIR2 - (SWIR2 - NIR) * NIRSWIR12 -  SWIR1) > 0) & (cfmaskdata == 0)) & (data == 0)")] = 6 # Grassland or cropland
-        data[numexpr.evaluate("(((((NIR - green) * GRNIR + green -  red) > 0)) & ((SWIR2 - (SWIR2 - NIR) * NIRSWIR12 -  SWIR1) > 0) & (cfmaskdata == 0)) & (data == 0)")] = 7 # Young forest
-        data[numexpr.evaluate("(((((NIR - green) * GRNIR + green -  red) > 0)) & ((SWIR2 - (SWIR2 - NIR) * NIRSWIR12 -  SWIR1) <= 0) & (NIR > SWIR1) & (cfmaskdata == 0)) & (data == 0)")] = 5 # Heath
-        data[numexpr.evaluate("(((((NIR - green) * GRNIR + green -  red) <= 0)) & (red < 1000) & (cfmaskdata == 0)) & (data == 0)")] = 3 # Bog
-        data[numexpr.evaluate("(((((((NIR - green) * GRNIR + green -  red) <= 0)) & (red >= 1000)) | (((((NIR - green) * GRNIR + green -  red) > 0)) & ((SWIR2 - (SWIR2 - NIR) * NIRSWIR12 -  SWIR1) <= 0))) & (cfmaskdata == 0)) & (data == 0)")] = 4 # Bare soil
+        data = dt4windows(raster, cfmask, landsat, GRNIR, NIRSWIR12, minforesttograss, maxforesttograss, algorithm = 'DT4b', windowsize = windowsize)
     except Exception as e:
         print('There was an error with the reflectance data file, logging and skipping scene: {}'.format(e))
         logerror(infile, e)
@@ -1297,9 +2458,111 @@ def DT4b(infile, outdir, minpixels, *args, **kwargs):
     return True, 'Success'
 
 
+def writeprobabilityrasters(counts, foresttograss, year, tilename, geoTrans, outdir, rasters, *args, **kwargs):
+    # Writes the class probability (pct), denominator and Highpos rasters of a tile-year from its (12, rows, cols) class count cube, see accumulateclasses().
+    multibandpct = kwargs.get('multibandpct', margs.multibandpct)
+    rows, cols = counts.shape[1:]
+    
+    # Grouped class counts are kept in Highpos class order in one contiguous stack, plane 0 stays zero so that pixels without observations get class 0 (no data)
+    if foresttograss:
+        stack = np.zeros((10, rows, cols), dtype = np.uint16)
+        water, urban, cropgrass, bogheath, forestry, heathforest, cropbog, cropforest, bogforest = stack[1:]
+    else:
+        stack = np.zeros((12, rows, cols), dtype = np.uint16)
+        water, urban, cropgrass, bogheath, forestry, heathforest, cropbog, cropforest, bogforest, forestcrop, forestcropheath = stack[1:]
+        forestcrop[:] = counts[10]
+        forestcropheath[:] = counts[11]
+    water[:] = counts[1]
+    urban[:] = counts[2]
+    np.add(counts[4], counts[6], out = cropgrass)
+    np.add(counts[3], counts[5], out = bogheath)
+    np.add(counts[7], counts[8], out = forestry)
+    heathforest[:] = counts[9]
+    denominator = counts[1:].sum(axis = 0, dtype = np.uint16)
+    del counts
+        
+    eval_ind = numexpr.evaluate('(bogheath == forestry)')
+    bogforest[eval_ind] = (np.add(bogheath[eval_ind], forestry[eval_ind])) #.astype(np.int16)
+#            writedata(bogforest, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'bogforest', rasters = rasters)
+    eval_ind = None
+    
+    eval_ind = numexpr.evaluate('(cropgrass == forestry)')
+    cropforest[eval_ind] = (np.add(cropgrass[eval_ind], forestry[eval_ind])) #.astype(np.int16)
+#            writedata(cropforest, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'cropforest', rasters = rasters)
+    eval_ind = None
+    
+    eval_ind = numexpr.evaluate('(cropgrass == bogheath)')
+    cropbog[eval_ind] = (np.add(cropgrass[eval_ind], bogheath[eval_ind])) #.astype(np.int16)
+#            writedata(cropbog, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'cropbog', rasters = rasters)            
+    eval_ind = None
+    
+#            denominator = np.sum([forestry + cropgrass + bogheath + heathforest + urban + water],axis=0).astype(dtype = np.float32)
+    writedata(denominator, 'denominator', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, rasters = rasters)
+    
+    eval_ind = numexpr.evaluate('(denominator > 0)')
+    
+    if foresttograss:
+        rastersets = [forestry, cropgrass, bogheath, heathforest, urban, water, bogforest, cropforest, cropbog]
+    else:
+        rastersets = [forestry, cropgrass, bogheath, heathforest, urban, water, bogforest, cropforest, cropbog, forestcrop, forestcropheath]
+    rasternames = pctclassnames[:len(rastersets)]
+    
+    if multibandpct: # one band per class in a single file
+        outdata = np.zeros((len(rastersets), rows, cols), dtype = np.uint16)
+        for i, data in enumerate(rastersets):
+            outdata[i][eval_ind] = (10000 * np.divide(data[eval_ind].astype(np.float32), denominator[eval_ind].astype(dtype = np.float32))).astype(np.int16)
+        writedata(outdata, 'pctstack', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, bandnames = rasternames, rasters = rasters)
+        del outdata
+    else:
+        for data, dataname in zip(rastersets, rasternames):
+            outdata = np.zeros((rows, cols), dtype = np.uint16)
+            outdata[eval_ind] = (10000 * np.divide(data[eval_ind].astype(np.float32), denominator[eval_ind].astype(dtype = np.float32))).astype(np.int16)
+            writedata(outdata, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = dataname, rasters = rasters)
+            del outdata
+    eval_ind = None
+    
+#            forestry[eval_ind] = (10000 * np.divide(forestry[eval_ind], denominator[eval_ind])).astype(np.int16)
+#            writedata(forestry, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'forestry', rasters = rasters)
+#            
+#            cropgrass[eval_ind] = (10000 * np.divide(cropgrass[eval_ind], denominator[eval_ind])).astype(np.int16)
+#            writedata(cropgrass, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'cropgrass', rasters = rasters)
+#            
+#            bogheath[eval_ind] = (10000 * np.divide(bogheath[eval_ind], denominator[eval_ind])).astype(np.int16)
+#            writedata(bogheath, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'bogheath', rasters = rasters)
+#            
+#            heathforest[eval_ind] = (10000 * np.divide(heathforest[eval_ind], denominator[eval_ind])).astype(np.int16)
+#            writedata(heathforest, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'heathforest', rasters = rasters)
+#            
+#            urban[eval_ind] = (10000 * np.divide(urban[eval_ind], denominator[eval_ind])).astype(np.int16)
+#            writedata(urban, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'urban', rasters = rasters)
+#            
+#            water[eval_ind] = (10000 * np.divide(water[eval_ind], denominator[eval_ind])).astype(np.int16)
+#            writedata(water, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'water', rasters = rasters)
+    
+    
+    highpos = stack.argmax(axis = 0).astype(np.uint8) # majority class along the class axis
+    writedata(highpos, 'Highpos', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, rasters = rasters)
+    del denominator
+    del eval_ind
+    del forestry
+    del cropgrass
+    del bogheath
+    del heathforest
+    del urban
+    del water
+    del highpos
+    del bogforest
+    del cropforest
+    del cropbog
+    del stack
+
+
 def calcprobabilityraster(tile, scenelist, foresttograss, year, *args, **kwargs):
     numyears = kwargs.get('numyears', 1)
     overwrite = kwargs.get('overwrite', margs.overwrite)
+    multibandpct = kwargs.get('multibandpct', margs.multibandpct)
+    maskprobability = kwargs.get('maskprobability', margs.maskprobability)
+    windows = kwargs.get('windows', {}) # precomputed tilewindow() results keyed by raster, see gettileoverlaps()
     dt4a = kwargs.get('dt4a', margs.dt4a)
     dt4b = kwargs.get('dt4b', margs.dt4b)
     if margs.dt4a:
@@ -1319,8 +2582,7 @@ def calcprobabilityraster(tile, scenelist, foresttograss, year, *args, **kwargs)
         print('Error: input directory is missing: {}'.format(indir))
         return None
         
-    if not os.access(outdir, os.F_OK):
-        os.mkdir(outdir)
+    makedir(outdir)
     
     rasters = []
     for y in range(numyears):
@@ -1329,157 +2591,78 @@ def calcprobabilityraster(tile, scenelist, foresttograss, year, *args, **kwargs)
                 rasters.append(scene)
     
     if len(rasters) > 0:
-        tilename = tile.GetField('Tile')
+        tilename, tilegeom = gettile(tile)
         headerdict = getheaderdict(rastertype = 'Highpos', year = year, tilename = tilename, foresttograss = foresttograss)
-        maj = os.path.join(outdir, headerdict['defaultbasefilename'])
+        maj = productpath(outdir, headerdict['defaultbasefilename'])
         if not overwrite and os.access(maj, os.F_OK):
             print('The pass command will be activated for calcprobabilityraster().')
             pass
         else:
             numfiles = len(rasters)
-            tilegeom = tile.GetGeometryRef()
             minX, maxX, minY, maxY = tilegeom.GetEnvelope()
             geoTrans = (minX, 30, 0.0, maxY, 0.0, -30)
             cols = int((maxX - minX) / 30) # number of samples or columns
             rows = int((maxY - minY) / 30) # number of lines or rows
             print('Found {} rasters, calculating majority land class for year {} and writing to: {}'.format(numfiles, year, maj))
-            dims = [minX, maxY, maxX, minY]
             
             print('Output columns: {}'.format(cols))
             print('Output rows: {}'.format(rows))
-            forestry = np.zeros((rows, cols), dtype = np.uint8)
-            cropgrass = np.zeros((rows, cols), dtype = np.uint8)
-            bogheath = np.zeros((rows, cols), dtype = np.uint8)
-            heathforest = np.zeros((rows, cols), dtype = np.uint8)
-            urban = np.zeros((rows, cols), dtype = np.uint8)
-            water = np.zeros((rows, cols), dtype = np.uint8)
-            if not foresttograss:
-                forestcrop = np.zeros((rows, cols), dtype = np.uint8)
-                forestcropheath = np.zeros((rows, cols), dtype = np.uint8)
-            denominator = np.zeros((rows, cols), dtype = np.uint8)
-            for i in range(numfiles):
-                r = rasters[i]
-                print('Opening file: {}'.format(os.path.basename(r)))
-                src_ds = gdal.Open(r)
-                gt = src_ds.GetGeoTransform()
-                extent = [gt[0], gt[3], gt[0] + gt[1] * src_ds.RasterXSize, gt[3] + gt[5] * src_ds.RasterYSize]
-#                if checkintersect(tilegeom, extent):
-                ul = [max(dims[0], extent[0]), min(dims[1], extent[1])]
-                lr = [min(dims[2], extent[2]), max(dims[3], extent[3])]
-                px, py = world2Pixel(geoTrans, ul[0], ul[1])
-                if px < 0:
-                    px = 0
-                if py < 0:
-                    py = 0
-                plx, ply = world2Pixel(geoTrans, lr[0], lr[1])
-                if plx >= extent[0]:
-                    plx = extent[0]-1
-                if ply >= extent[1]:
-                    ply = extent[1]-1
-                pX, pY = pixel2world(geoTrans, px, py)
-                plX, plY = pixel2world(geoTrans, plx, ply)
-                ulx,uly = world2Pixel(gt, pX, pY)
-                if ulx < 0:
-                    ulx = 0
-                lrx,lry = world2Pixel(gt, plX, plY)
-                if lrx >= src_ds.RasterXSize:
-                    lrx = src_ds.RasterXSize - 1 
-                if uly >= src_ds.RasterYSize:
-                    uly = src_ds.RasterYSize - 1
-                if lry < 0:
-                    lry = 0 
-                
-                dx = plx-px + 1
-                dy = ply-py + 1
-                band = np.zeros((rows, cols), dtype = np.uint8)
-                band[py:ply, px:plx] = src_ds.GetRasterBand(1).ReadAsArray(ulx, uly, dx - 1, dy - 1)
-                
-                forestry[numexpr.evaluate('((band == 7) | (band == 8))')] += 1
-                cropgrass[numexpr.evaluate('((band == 4) | (band == 6))')] += 1
-                bogheath[numexpr.evaluate('((band == 3) | (band == 5))')] += 1
-                heathforest[numexpr.evaluate('(band == 9)')] += 1
-                urban[numexpr.evaluate('(band == 2)')] += 1
-                water[numexpr.evaluate('(band == 1)')] += 1
-                if not foresttograss:
-                    forestcrop[numexpr.evaluate('(band == 10)')] += 1
-                    forestcropheath[numexpr.evaluate('(band == 11)')] += 1
-                denominator[numexpr.evaluate('((band >= 1) & (band <= 11) )')] += 1
-                del band
-                del src_ds
-                
-            eval_ind = numexpr.evaluate('(bogheath == forestry)')
-            bogforest = np.zeros((rows, cols), dtype = np.int8)
-            bogforest[eval_ind] = (np.add(bogheath[eval_ind], forestry[eval_ind])) #.astype(np.int16)
-#            writedata(bogforest, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'bogforest', rasters = rasters)
-            eval_ind = None
-            
-            eval_ind = numexpr.evaluate('(cropgrass == forestry)')
-            cropforest = np.zeros((rows, cols), dtype = np.int8)
-            cropforest[eval_ind] = (np.add(cropgrass[eval_ind], forestry[eval_ind])) #.astype(np.int16)
-#            writedata(cropforest, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'cropforest', rasters = rasters)
-            eval_ind = None
-            
-            cropbog = np.zeros((rows, cols), dtype = np.int8)
-            eval_ind = numexpr.evaluate('(cropgrass == bogheath)')
-            cropbog[eval_ind] = (np.add(cropgrass[eval_ind], bogheath[eval_ind])) #.astype(np.int16)
-#            writedata(cropbog, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'cropbog', rasters = rasters)            
-            eval_ind = None
-            
-#            denominator = np.sum([forestry + cropgrass + bogheath + heathforest + urban + water],axis=0).astype(dtype = np.float32)
-            writedata(denominator.astype(np.int16), 'denominator', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, rasters = rasters)
-            
-            eval_ind = numexpr.evaluate('(denominator > 0)')
-            
-            if foresttograss:
-                rastersets = [forestry, cropgrass, bogheath, heathforest, urban, water, bogforest, cropforest, cropbog]
-                rasternames = ['forestry', 'cropgrass', 'bogheath', 'heathforest', 'urban', 'water', 'bogforest', 'cropforest', 'cropbog']
-            else:
-                rastersets = [forestry, cropgrass, bogheath, heathforest, urban, water, bogforest, cropforest, cropbog, forestcrop, forestcropheath]
-                rasternames = ['forestry', 'cropgrass', 'bogheath', 'heathforest', 'urban', 'water', 'bogforest', 'cropforest', 'cropbog', 'forestcrop', 'forestcropheath']
-            
-            for data, dataname in zip(rastersets, rasternames):
-                outdata = np.zeros((rows, cols), dtype = np.uint16)
-                outdata[eval_ind] = (10000 * np.divide(data[eval_ind].astype(np.float32), denominator[eval_ind].astype(dtype = np.float32))).astype(np.int16)
-                writedata(outdata, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = dataname, rasters = rasters)
-                del outdata
-            eval_ind = None
-            
-#            forestry[eval_ind] = (10000 * np.divide(forestry[eval_ind], denominator[eval_ind])).astype(np.int16)
-#            writedata(forestry, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'forestry', rasters = rasters)
-#            
-#            cropgrass[eval_ind] = (10000 * np.divide(cropgrass[eval_ind], denominator[eval_ind])).astype(np.int16)
-#            writedata(cropgrass, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'cropgrass', rasters = rasters)
-#            
-#            bogheath[eval_ind] = (10000 * np.divide(bogheath[eval_ind], denominator[eval_ind])).astype(np.int16)
-#            writedata(bogheath, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'bogheath', rasters = rasters)
-#            
-#            heathforest[eval_ind] = (10000 * np.divide(heathforest[eval_ind], denominator[eval_ind])).astype(np.int16)
-#            writedata(heathforest, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'heathforest', rasters = rasters)
-#            
-#            urban[eval_ind] = (10000 * np.divide(urban[eval_ind], denominator[eval_ind])).astype(np.int16)
-#            writedata(urban, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'urban', rasters = rasters)
-#            
-#            water[eval_ind] = (10000 * np.divide(water[eval_ind], denominator[eval_ind])).astype(np.int16)
-#            writedata(water, 'pct', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, classname = 'water', rasters = rasters)
-            
+            # Class counts for DT4/a/b values 0 - 11 are kept in one cube, uint16 so that multi-year windows cannot overflow
+            counts = np.zeros((12, rows, cols), dtype = np.uint16)
+            pixelindex = np.arange(rows * cols, dtype = np.intp).reshape(rows, cols)
+            band = np.zeros((rows, cols), dtype = np.uint8) # read buffer, each scene is read into its own window of it
+            tilemask = None
+            if maskprobability and margs.usemaskfile:
+                tilemask = readmaskwindow(geoTrans, cols, rows)
+                print('Counting {} forestry mask pixels.'.format(np.count_nonzero(tilemask)))
+            # Rasters are grouped by acquisition date. A VRT is the only raster of its date, while scene classifications of the same date are mosaicked in memory as gdalbuildvrt -srcnodata 0 would: later scenes are drawn over earlier ones except where they are 0.
+            dates = {}
+            for r in rasters:
+                datestr = os.path.basename(r)[9:16]
+                if not datestr in dates.keys():
+                    dates[datestr] = []
+                dates[datestr].append(r)
+            for datestr in sorted(dates.keys()):
+                group = sorted(dates[datestr])
+                if len(group) > 1:
+                    band[:] = 0
+                extent = None # union of the tile slices of the group
+                for r in group:
+                    print('Opening file: {}'.format(os.path.basename(r)))
+                    src_ds = gdal.Open(r)
+                    try:
+                        if r in windows.keys():
+                            window = windows[r]
+                        else:
+                            window = tilewindow(geoTrans, cols, rows, src_ds.GetGeoTransform(), src_ds.RasterXSize, src_ds.RasterYSize)
+                    except ValueError as e:
+                        print('ERROR: {}: {}'.format(os.path.basename(r), e))
+                        logerror(r, e)
+                        window = None
+                    if not window:
+                        src_ds = None
+                        continue
+                    (xoff, yoff, xsize, ysize), dst = window
+                    if len(group) == 1:
+                        src_ds.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize, buf_obj = band[dst])
+                    else:
+                        data = src_ds.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize)
+                        np.copyto(band[dst], data, where = numexpr.evaluate('(data != 0)'))
+                        data = None
+                    src_ds = None
+                    if extent:
+                        extent = [min(extent[0], dst[0].start), max(extent[1], dst[0].stop), min(extent[2], dst[1].start), max(extent[3], dst[1].stop)]
+                    else:
+                        extent = [dst[0].start, dst[0].stop, dst[1].start, dst[1].stop]
+                if extent:
+                    dst = (slice(extent[0], extent[1]), slice(extent[2], extent[3]))
+                    accumulateclasses(counts, band[dst], dst, pixelindex, tilemask = tilemask)
+            del band
+            tilemask = None
+            del pixelindex
             
-            if foresttograss:
-                highpos = np.argmax([np.zeros((rows, cols), dtype = np.int16), water, urban, cropgrass, bogheath, forestry, heathforest,  cropbog, cropforest, bogforest], axis = 2)
-            else:
-                highpos = np.argmax([np.zeros((rows, cols), dtype = np.int16), water, urban, cropgrass, bogheath, forestry, heathforest,  cropbog, cropforest, bogforest, forestcrop, forestcropheath], axis = 2)
-            writedata(highpos, 'Highpos', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, rasters = rasters)
-            del denominator
-            del eval_ind
-            del forestry
-            del cropgrass
-            del bogheath
-            del heathforest
-            del urban
-            del water
-            del highpos
-            del bogforest
-            del cropforest
-            del cropbog
+            writeprobabilityrasters(counts, foresttograss, year, tilename, geoTrans, outdir, rasters, multibandpct = multibandpct)
+            del counts
             del tile
             
     else:
@@ -1505,38 +2688,43 @@ def Yearlydt4(indir, year, tilename, foresttograss, *args, **kwargs):
     # outdir = kwargs.get('outdir', None)
     yearoffset = kwargs.get('yearoffset', None)
     overwrite = kwargs.get('overwrite', margs.overwrite)
+    multibandpct = kwargs.get('multibandpct', margs.multibandpct)
     
     print('Now calculating yearly DT4 classification for tile {}.'.format(tilename))
     
+    usepctstack = False
     if yearoffset:
         startyear = year
         endyear = year + yearoffset - 1
-        bogheathURI = os.path.join(indir, '{}_pct_{}_{}_{}.dat'.format('bogheath', year, endyear, tilename))
-        heathforestURI = os.path.join(indir, '{}_pct_{}_{}_{}.dat'.format('heathforest', year, endyear, tilename))
-        bogforestURI = os.path.join(indir, '{}_pct_{}_{}_{}.dat'.format('bogforest', year, endyear, tilename))
-        forestryURI = os.path.join(indir, '{}_pct_{}_{}_{}.dat'.format('forestry', year, endyear, tilename))
-        cropgrassURI = os.path.join(indir, '{}_pct_{}_{}_{}.dat'.format('cropgrass', year, endyear, tilename))
-        urbanURI = os.path.join(indir, '{}_pct_{}_{}_{}.dat'.format('urban', year, endyear, tilename))
-        waterURI = os.path.join(indir, '{}_pct_{}_{}_{}.dat'.format('water', year, endyear, tilename))
-        URI = os.path.join(indir, '{}_pct_{}_{}_{}.dat'.format('DT4_class', year, endyear, tilename))
+        bogheathURI = productpath(indir, '{}_pct_{}_{}_{}.dat'.format('bogheath', year, endyear, tilename))
+        heathforestURI = productpath(indir, '{}_pct_{}_{}_{}.dat'.format('heathforest', year, endyear, tilename))
+        bogforestURI = productpath(indir, '{}_pct_{}_{}_{}.dat'.format('bogforest', year, endyear, tilename))
+        forestryURI = productpath(indir, '{}_pct_{}_{}_{}.dat'.format('forestry', year, endyear, tilename))
+        cropgrassURI = productpath(indir, '{}_pct_{}_{}_{}.dat'.format('cropgrass', year, endyear, tilename))
+        urbanURI = productpath(indir, '{}_pct_{}_{}_{}.dat'.format('urban', year, endyear, tilename))
+        waterURI = productpath(indir, '{}_pct_{}_{}_{}.dat'.format('water', year, endyear, tilename))
+        URI = productpath(indir, 'DT4_class_{}_{}_{}.dat'.format(year, endyear, tilename))
     
     else:
         startyear = None
         endyear = None
-        bogheathURI = os.path.join(indir, '{}_pct_{}_{}.dat'.format('bogheath', year, tilename))
-        heathforestURI = os.path.join(indir, '{}_pct_{}_{}.dat'.format('heathforest', year, tilename))
-        bogforestURI = os.path.join(indir, '{}_pct_{}_{}.dat'.format('bogforest', year, tilename))
-        forestryURI = os.path.join(indir, '{}_pct_{}_{}.dat'.format('forestry', year, tilename))
-        cropgrassURI = os.path.join(indir, '{}_pct_{}_{}.dat'.format('cropgrass', year, tilename))
-        urbanURI = os.path.join(indir, '{}_pct_{}_{}.dat'.format('urban', year, tilename))
-        waterURI = os.path.join(indir, '{}_pct_{}_{}.dat'.format('water', year, tilename))
-        URI = os.path.join(indir, '{}_pct_{}_{}.dat'.format('DT4_class', year, tilename))
+        bogheathURI = productpath(indir, '{}_pct_{}_{}.dat'.format('bogheath', year, tilename))
+        heathforestURI = productpath(indir, '{}_pct_{}_{}.dat'.format('heathforest', year, tilename))
+        bogforestURI = productpath(indir, '{}_pct_{}_{}.dat'.format('bogforest', year, tilename))
+        forestryURI = productpath(indir, '{}_pct_{}_{}.dat'.format('forestry', year, tilename))
+        cropgrassURI = productpath(indir, '{}_pct_{}_{}.dat'.format('cropgrass', year, tilename))
+        urbanURI = productpath(indir, '{}_pct_{}_{}.dat'.format('urban', year, tilename))
+        waterURI = productpath(indir, '{}_pct_{}_{}.dat'.format('water', year, tilename))
+        URI = productpath(indir, 'DT4_class_{}_{}.dat'.format(year, tilename))
         parentrasters = [bogheathURI, heathforestURI, bogforestURI, forestryURI, cropgrassURI, urbanURI, waterURI]
+        if multibandpct: # read the multi-band pct file written by writeprobabilityrasters(multibandpct = True), not any per-class files left by other runs
+            parentrasters = [productpath(indir, 'pct_{}_{}.dat'.format(year, tilename))]
+            usepctstack = True
     
     if os.path.exists(URI):
         if overwrite:
             print('Found existing output file, deleting associated files and overwriting.')
-            files = glob.glob(URI.replace('.dat', '.*'))
+            files = glob.glob(os.path.splitext(URI)[0] + '.*')
             for f in files:
                 os.remove(f)
         else:
@@ -1549,35 +2737,46 @@ def Yearlydt4(indir, year, tilename, foresttograss, *args, **kwargs):
             return
     
     # Open files
-    forestryRaster = gdal.Open(forestryURI)
-    bogheathRaster = gdal.Open(bogheathURI)
-    heathforestRaster = gdal.Open(heathforestURI)
-    cropgrassRaster = gdal.Open(cropgrassURI)
-    waterRaster = gdal.Open(waterURI)
-    urbanRaster = gdal.Open(urbanURI)
-    bogforestRaster = gdal.Open(bogforestURI)
-    
-    # Get file geometry from forestry dataset
-    geoTrans = forestryRaster.GetGeoTransform() 
-    ns = forestryRaster.RasterXSize
-    nl = forestryRaster.RasterYSize
-    
-    # Get data from open files
-    forestry = forestryRaster.GetRasterBand(1).ReadAsArray()
-    heathforest = heathforestRaster.GetRasterBand(1).ReadAsArray()
-    bogforest = bogforestRaster.GetRasterBand(1).ReadAsArray()
-    bogheath = bogheathRaster.GetRasterBand(1).ReadAsArray()
-    cropgrass = cropgrassRaster.GetRasterBand(1).ReadAsArray()
-    water = waterRaster.GetRasterBand(1).ReadAsArray()
-    urban = urbanRaster.GetRasterBand(1).ReadAsArray()
-    
-    if not foresttograss:
-        forestcropURI = os.path.join(indir, '{}_pct_{}_{}.dat'.format('forestcrop', year, tilename))
-        forestcropheathURI = os.path.join(indir, '{}_pct_{}_{}.dat'.format('forestcropheath', year, tilename))
-        forestcropRaster = gdal.Open(forestcropURI)
-        forestcropheathRaster = gdal.Open(forestcropheathURI)
-        forestcrop = forestcropRaster.GetRasterBand(1).ReadAsArray()
-        forestcropheath = forestcropheathRaster.GetRasterBand(1).ReadAsArray()
+    if usepctstack: # all class probabilities are read from the multi-band pct file in one call
+        pctRaster = gdal.Open(parentrasters[0])
+        geoTrans = pctRaster.GetGeoTransform() 
+        ns = pctRaster.RasterXSize
+        nl = pctRaster.RasterYSize
+        pct = pctRaster.ReadAsArray()
+        pctRaster = None
+        forestry, cropgrass, bogheath, heathforest, urban, water, bogforest = pct[:7]
+        if not foresttograss:
+            forestcrop, forestcropheath = pct[9:11]
+    else:
+        forestryRaster = gdal.Open(forestryURI)
+        bogheathRaster = gdal.Open(bogheathURI)
+        heathforestRaster = gdal.Open(heathforestURI)
+        cropgrassRaster = gdal.Open(cropgrassURI)
+        waterRaster = gdal.Open(waterURI)
+        urbanRaster = gdal.Open(urbanURI)
+        bogforestRaster = gdal.Open(bogforestURI)
+    
+        # Get file geometry from forestry dataset
+        geoTrans = forestryRaster.GetGeoTransform() 
+        ns = forestryRaster.RasterXSize
+        nl = forestryRaster.RasterYSize
+    
+        # Get data from open files
+        forestry = forestryRaster.GetRasterBand(1).ReadAsArray()
+        heathforest = heathforestRaster.GetRasterBand(1).ReadAsArray()
+        bogforest = bogforestRaster.GetRasterBand(1).ReadAsArray()
+        bogheath = bogheathRaster.GetRasterBand(1).ReadAsArray()
+        cropgrass = cropgrassRaster.GetRasterBand(1).ReadAsArray()
+        water = waterRaster.GetRasterBand(1).ReadAsArray()
+        urban = urbanRaster.GetRasterBand(1).ReadAsArray()
+    
+        if not foresttograss:
+            forestcropURI = productpath(indir, '{}_pct_{}_{}.dat'.format('forestcrop', year, tilename))
+            forestcropheathURI = productpath(indir, '{}_pct_{}_{}.dat'.format('forestcropheath', year, tilename))
+            forestcropRaster = gdal.Open(forestcropURI)
+            forestcropheathRaster = gdal.Open(forestcropheathURI)
+            forestcrop = forestcropRaster.GetRasterBand(1).ReadAsArray()
+            forestcropheath = forestcropheathRaster.GetRasterBand(1).ReadAsArray()
         
     # rasters = [water,urban,cropgrass,bogheath,forestry]
     
@@ -1667,12 +2866,12 @@ def forestryclass(tilename, foresttograss, year, *args, **kwargs):
     indir = kwargs.get('indir', os.path.join(config['DEFAULT']['baseoutputdir'], r'{}\Probability'.format(outsubdir)))
     outdir = kwargs.get('outdir', os.path.join(config['DEFAULT']['baseoutputdir'], r'{}\Probability\Forestry'.format(outsubdir)))
     print('Now calculating forestry classes for tile {}.'.format(tilename))
-    if not os.path.exists(outdir):
-        os.mkdir(outdir)
-    infile = kwargs.get('infile', os.path.join(indir, 'DT4_class_{}_{}.dat'.format(year, tilename)))
+    makedir(outdir)
+    infile = kwargs.get('infile', productpath(indir, 'DT4_class_{}_{}.dat'.format(year, tilename)))
     overwrite = kwargs.get('overwrite', margs.overwrite)
+    usecube = kwargs.get('usecube', margs.usecube)
     headerdict = getheaderdict(rastertype = 'ForestryClass', year = year, tilename = tilename, foresttograss = foresttograss)
-    outfile = os.path.join(outdir, headerdict['defaultbasefilename'])
+    outfile = productpath(outdir, headerdict['defaultbasefilename'])
     if not overwrite and os.access(outfile, os.F_OK):
         print('{} exists and no overwrite has been set, skipping.'.format(os.path.basename(outfile)))
         return
@@ -1688,6 +2887,8 @@ def forestryclass(tilename, foresttograss, year, *args, **kwargs):
         b = r[1]
         outraster[numexpr.evaluate("(band>=a)&(band<=b)")] = r[2]
     writedata(outraster, 'ForestryClass', geoTrans, foresttograss = foresttograss, year = year, tilename = tilename, outdir = outdir, rasters = [infile])
+    if usecube:
+        updatecube(outdir, tilename, year, outraster, geoTrans)
     band = None
     img = None
     outraster = None
@@ -1711,6 +2912,8 @@ def calcyearlychange(tilename, foresttograss, *args, **kwargs):
     endyear = kwargs.get('endyear', margs.endyear)
     overwrite = kwargs.get('overwrite', margs.overwrite)
     opp = kwargs.get('opp', False)
+    engine = kwargs.get('engine', margs.changeengine) # 'array' or 'pixel' (per-pixel reference loop)
+    usecube = kwargs.get('usecube', margs.usecube)
 #    usemaskfile = kwargs.get('usemaskfile', True)
     years = list(range(startyear, endyear + 1))
     
@@ -1727,51 +2930,54 @@ def calcyearlychange(tilename, foresttograss, *args, **kwargs):
     print('Reading files from: {}'.format(indir))
     
     print('Files will be written to: {}'.format(outdir))
-    if not os.access(outdir, os.F_OK):
-        os.mkdir(outdir)
+    makedir(outdir)
     
     headerdict = getheaderdict(rastertype = 'year', tilename = tilename, foresttograss = foresttograss, observationtype = 'reforested')
-    outfile = os.path.join(outdir, headerdict['defaultbasefilename'])
+    outfile = productpath(outdir, headerdict['defaultbasefilename'])
     if not overwrite and os.access(outfile, os.F_OK):
         print('{} exists and no overwrite has been set, skipping.'.format(os.path.basename(outfile)))
         return
     files = []
     parentrasters = []
     print(len(years))
-
-    for year in years:
-        if opp:
-            fname = os.path.join(indir, '{}_{}_forestryclass.dat'.format(tilename, year))
-        else:
-            fname = os.path.join(indir, 'forestryclass_{}_{}.dat'.format(year, tilename))
-        if os.access(fname, os.F_OK):
-            parentrasters.append(fname)
-            files.append(gdal.Open(fname))
-            if not geoTrans:
-                geoTrans = files[0].GetGeoTransform()
-                ns = files[0].RasterXSize
-                nl = files[0].RasterYSize
-                if margs.usemaskfile:
-                    ULx, ULy = pixel2world(geoTrans, 0, 0)
-                    mask_ds = gdal.Open(margs.forestrymaskfile)
-                    mask_gt = mask_ds.GetGeoTransform()
-                    mx, my = world2Pixel(mask_gt, ULx, ULy)
-                    print('mx = {}, my = {}, ns = {}, nl = {}'.format(mx, my, ns, nl))
-                    mask = mask_ds.GetRasterBand(1).ReadAsArray()
-                    print('mask dimensions: {}'.format(mask.shape))
-                    mvals = np.where(numexpr.evaluate('(mask == 1)'))
-                    # print(mvals.shape)
-                    yvals = mvals[0].tolist()
-                    xvals = mvals[1].tolist()
-                    mvals = None
-                    print('Total xvals = {}, yvals = {}'.format(len(xvals), len(yvals)))
-                else:
-                    yvals = list(range(nl))
-                    xvals = list(range(ns))
-                numpixels = ns * nl
-                
-        else:
-            files.append(0)
+    
+    tscube = None
+    if usecube and engine == 'array' and not opp:
+        synccube(indir, tilename, years)
+        tscube, cubeheader = opencube(indir, tilename)
+    if tscube is not None: # yearly forestry classes are memory mapped from the tile time-series cube instead of opening every yearly raster
+        print('Reading yearly forestry classes from the time-series cube.')
+        geoTrans = cubeheader['geotransform']
+        ns = cubeheader['cols']
+        nl = cubeheader['rows']
+        parentrasters.append(cubefiles(indir, tilename)[0])
+    else:
+        for year in years:
+            if opp:
+                fname = productpath(indir, '{}_{}_forestryclass.dat'.format(tilename, year))
+            else:
+                fname = productpath(indir, 'forestryclass_{}_{}.dat'.format(year, tilename))
+            if os.access(fname, os.F_OK):
+                parentrasters.append(fname)
+                files.append(gdal.Open(fname))
+                if not geoTrans:
+                    geoTrans = files[-1].GetGeoTransform()
+                    ns = files[-1].RasterXSize
+                    nl = files[-1].RasterYSize
+            else:
+                files.append(0)
+    if not geoTrans:
+        print('Error: no yearly forestry class rasters were found for tile {}.'.format(tilename))
+        return
+    if margs.usemaskfile and engine != 'array': # the array engine takes the tile's pixels from the forestry mask index
+        yvals, xvals = np.nonzero(readmaskwindow(geoTrans, ns, nl))
+        yvals = yvals.tolist()
+        xvals = xvals.tolist()
+        print('Total xvals = {}, yvals = {}'.format(len(xvals), len(yvals)))
+    else:
+        yvals = list(range(nl))
+        xvals = list(range(ns))
+    numpixels = ns * nl
     startclass = np.zeros((nl, ns), dtype = np.uint8)
     endclass = np.zeros((nl, ns), dtype = np.uint8)
     statusmap = np.zeros((nl, ns), dtype = np.uint8)
@@ -1779,90 +2985,115 @@ def calcyearlychange(tilename, foresttograss, *args, **kwargs):
     afforested = np.zeros((nl, ns), dtype = np.uint16)
     statusyearmap = np.zeros((nl, ns), dtype = np.uint16)
     reforested = np.zeros((nl, ns), dtype = np.uint16)
-    if margs.usemaskfile:
+    if margs.usemaskfile and engine != 'array':
         numpixels = len(xvals)
     
-    x = 0
-    y = 0
-    for i in range(numpixels):
-        if margs.usemaskfile:        
-            mx = xvals[i]
-            my = yvals[i]
-            X, Y = pixel2world(mask_gt, mx, my)
-            x, y = world2Pixel(geoTrans, X, Y)
-        
-        if x >= 0 and x < ns and y >= 0 and y < nl:
-            signal=[]
+    if engine == 'array':
+        # Read each yearly forestry class raster once into a (years, rows, cols) cube and process all pixels at once
+        if tscube is None:
+            print('Reading {} yearly forestry class rasters into memory.'.format(len(parentrasters)))
+            cube = np.zeros((len(files), nl, ns), dtype = np.uint8)
             for i in range(len(files)):
                 if files[i] != 0:
-                    band = files[i].GetRasterBand(1).ReadAsArray(x, y, 1, 1)
-                    if band:
-                        signal.append(band[0, 0])
+                    cube[i] = files[i].GetRasterBand(1).ReadAsArray()
+        if margs.usemaskfile:
+            ys, xs = getmaskpixels(tilename, geoTrans, ns, nl)
+        else:
+            ys, xs = np.indices((nl, ns)).reshape(2, -1)
+        print('Calculating change for {} pixels.'.format(len(xs)))
+        if tscube is not None: # only the pages holding masked pixels are read from the memory mapped cube
+            signals = np.zeros((len(years), len(xs)), dtype = np.uint8)
+            for i, year in enumerate(years):
+                j = year - cubeheader['startyear']
+                if j >= 0 and j < cubeheader['bands']:
+                    signals[i] = tscube[j][ys, xs]
+            tscube = None
+        else:
+            signals = cube[:, ys, xs]
+            cube = None
+        clean = numexpr.evaluate('(signals == 1) | (signals == 3)').any(axis = 0) & numexpr.evaluate('(signals == 0) | (signals == 2)').any(axis = 0)
+        signals[:, clean] = cleansignalstack(signals[:, clean])
+        clean = None
+        startclass[ys, xs], endclass[ys, xs], afforested[ys, xs], clearcut[ys, xs], reforested[ys, xs], statusmap[ys, xs], statusyearmap[ys, xs] = lcchangestack(signals, years, endyear)
+        signals = None
+    else: # per-pixel reference mode
+        x = 0
+        y = 0
+        for i in range(numpixels):
+            if margs.usemaskfile: # mask pixels are already in tile coordinates
+                x = xvals[i]
+                y = yvals[i]
+        
+            if x >= 0 and x < ns and y >= 0 and y < nl:
+                signal=[]
+                for i in range(len(files)):
+                    if files[i] != 0:
+                        band = files[i].GetRasterBand(1).ReadAsArray(x, y, 1, 1)
+                        if band:
+                            signal.append(band[0, 0])
+                        else:
+                            signal.append(0)
                     else:
                         signal.append(0)
-                else:
-                    signal.append(0)
-            if (1 in signal or 3 in signal) and (0 in signal or 2 in signal):
-                # print(signal)
-                signal = cleansignal(np.array(signal)).tolist()
-            startclass[y, x] = signal[0]  
-            endclass[y, x] = signal[-1]
-            if 3 in signal and 1 in signal:
-                cut = False
-                refor = False
-                if signal[0] == 1:
-                    afforested[y, x] = years[signal.index(next(i for i in signal[1:] if i == 3))]
-                for i in range(len(years) - 1, 0,-1):
-                    if signal[i] == 3 and signal[i - 1] == 1:
-                        year = years[i]
-                        if year > afforested[y, x] and (afforested[y, x] > 0 or signal[0] == 3) and not refor:
-                            reforested[y, x] = year
-                            refor = True 
-                    elif signal[i] == 1 and signal[i - 1] == 3:
-                        year = years[i]
-                        clearcut[y, x] = year
-                        cut = True
-                    if refor and cut:
-                        break
-                diffyear=0
-                if reforested[y, x] > afforested[y, x]:
-                    lastforest = reforested[y, x]
-                else:
-                    lastforest = afforested[y, x]
-                if clearcut[y, x] > lastforest: #reforested[y, x] and clearcut[y, x] > afforested[y, x]:
-                    diffyear = endyear - clearcut[y, x] # replace year
-                    if diffyear < 5:
-                        statusmap[y, x] = 5 # recent clearcut
-                    elif diffyear < 10:
-                        statusmap[y, x] = 4 # possible deforestation
-                    elif diffyear >= 10:
-                        statusmap[y, x] = 3 # deforested
-                    statusyearmap[y, x] = clearcut[y, x]
-                elif reforested[y, x] > afforested[y, x]:
-                    statusmap[y, x] = 6 # reforested
-                    statusyearmap[y, x] = reforested[y, x]
-                elif afforested[y, x] > 0:
-                    statusmap[y, x] = 7 # afforested
-                    statusyearmap[y, x] = afforested[y, x]
-            elif 3 in signal and 0 not in signal:
-                statusmap[y, x] = 2
-            elif 1 in signal and 0 not in signal:
-                statusmap[y, x] = 1
+                if (1 in signal or 3 in signal) and (0 in signal or 2 in signal):
+                    # print(signal)
+                    signal = cleansignal(np.array(signal)).tolist()
+                startclass[y, x] = signal[0]  
+                endclass[y, x] = signal[-1]
+                if 3 in signal and 1 in signal:
+                    cut = False
+                    refor = False
+                    if signal[0] == 1:
+                        afforested[y, x] = years[signal.index(next(i for i in signal[1:] if i == 3))]
+                    for i in range(len(years) - 1, 0,-1):
+                        if signal[i] == 3 and signal[i - 1] == 1:
+                            year = years[i]
+                            if year > afforested[y, x] and (afforested[y, x] > 0 or signal[0] == 3) and not refor:
+                                reforested[y, x] = year
+                                refor = True 
+                        elif signal[i] == 1 and signal[i - 1] == 3:
+                            year = years[i]
+                            clearcut[y, x] = year
+                            cut = True
+                        if refor and cut:
+                            break
+                    diffyear=0
+                    if reforested[y, x] > afforested[y, x]:
+                        lastforest = reforested[y, x]
+                    else:
+                        lastforest = afforested[y, x]
+                    if clearcut[y, x] > lastforest: #reforested[y, x] and clearcut[y, x] > afforested[y, x]:
+                        diffyear = endyear - clearcut[y, x] # replace year
+                        if diffyear < 5:
+                            statusmap[y, x] = 5 # recent clearcut
+                        elif diffyear < 10:
+                            statusmap[y, x] = 4 # possible deforestation
+                        elif diffyear >= 10:
+                            statusmap[y, x] = 3 # deforested
+                        statusyearmap[y, x] = clearcut[y, x]
+                    elif reforested[y, x] > afforested[y, x]:
+                        statusmap[y, x] = 6 # reforested
+                        statusyearmap[y, x] = reforested[y, x]
+                    elif afforested[y, x] > 0:
+                        statusmap[y, x] = 7 # afforested
+                        statusyearmap[y, x] = afforested[y, x]
+                elif 3 in signal and 0 not in signal:
+                    statusmap[y, x] = 2
+                elif 1 in signal and 0 not in signal:
+                    statusmap[y, x] = 1
         
-        if pixnum % 10000 == 0:
-            drawProgressBar((float(pixnum) / float(numpixels)), pixnum, numpixels)
+            if pixnum % 10000 == 0:
+                drawProgressBar((float(pixnum) / float(numpixels)), pixnum, numpixels)
 
-        if not margs.usemaskfile:
-            x += 1
-            if x == ns:
-                y += 1
-                x = 0
-        pixnum += 1 
+            if not margs.usemaskfile:
+                x += 1
+                if x == ns:
+                    y += 1
+                    x = 0
+            pixnum += 1 
     
     for i in range(len(files)): # close open files 
         files[i] = None
-        mask = None
-        mask_ds = None
     print('Writing files to disk.')
     writedata(startclass, 'ForestryClass', geoTrans, foresttograss = foresttograss, year = startyear, outdir = outdir, tilename = tilename, rasters =  parentrasters)
     writedata(endclass, 'ForestryClass', geoTrans, foresttograss = foresttograss, year = endyear, outdir = outdir, tilename = tilename, rasters =  parentrasters)
@@ -1890,14 +3121,15 @@ def proctile(tile, foresttograss, *args, **kwargs):
     fconly = kwargs.get('fconly', False) 
     yearlychangeonly = kwargs.get('yearlychangeonly', False)
     yearlychange = kwargs.get('yearlychange', True)
-    usecatfile = kwargs.get('usecatfile', True)
+    usecatfile = kwargs.get('usecatfile', not margs.usescenes)
     badlistfile = kwargs.get('badlist', ieo.badlandsat)
+    changeengine = kwargs.get('changeengine', margs.changeengine)
     prob = True
     fc = True
     yc = True
     yearly = True
     probdir = os.path.join(os.path.join(config['DEFAULT']['baseoutputdir'], str(foresttograss)), 'Probability')
-    tilename = tile.GetField('Tile')
+    tilename, tilegeom = gettile(tile)
     dt4a = kwargs.get('dt4a', margs.dt4a)
     dt4b = kwargs.get('dt4b', margs.dt4b)
     if margs.dt4a:
@@ -1913,20 +3145,21 @@ def proctile(tile, foresttograss, *args, **kwargs):
         print('Now processing DT4 classifications for Tile {} for the years: {} - {}, foresttograss = {}.'.format(tilename, startyear, endyear, foresttograss))
     else:
         print('Now processing DT4a classifications for Tile {} for the years: {} - {}.'.format(tilename, startyear, endyear))
-    tilegeom = tile.GetGeometryRef()
 #    if prob:
     
     forestrydir = os.path.join(probdir, 'Forestry')
     changedir = os.path.join(forestrydir, 'Change')
-    forestrystatusfile = os.path.join(changedir, 'forestrystatus_{}.dat'.format(tilename))
+    forestrystatusfile = productpath(changedir, 'forestrystatus_{}.dat'.format(tilename))
     if not os.path.isfile(forestrystatusfile) or overwrite:
         if not yearlychangeonly:
+            print('Now getting scene lists to process for the years: {} - {}'.format(startyear, endyear))
+            proclists = makeproclists(tilegeom, foresttograss, usecatfile, years = list(range(startyear, endyear + 1)), badlistfile = badlistfile, tilename = tilename)
+            windows = gettileoverlaps(tilename, foresttograss)
             for year in range(startyear, endyear+1):
-                print('Now getting scene list to process for year: {}'.format(year))
-                scenelist = makeproclist(tilegeom, foresttograss, usecatfile, year = year, badlistfile = badlistfile)
+                scenelist = proclists[year]
                 if len(scenelist) > 0:
                     print('A total of {} scenes were found to process. Calculating probability rasters.'.format(len(scenelist)))
-                    probdir = calcprobabilityraster(tile, scenelist, foresttograss, year, overwrite = overwrite)
+                    probdir = calcprobabilityraster(tile, scenelist, foresttograss, year, overwrite = overwrite, windows = windows)
                     if probdir:
                         print('Determining YearlyDT4 classes.')
                         Yearlydt4(probdir, year, tilename, foresttograss, overwrite = overwrite)
@@ -1936,7 +3169,7 @@ def proctile(tile, foresttograss, *args, **kwargs):
                     print('Error: no scenes found to process.') 
         if yearlychange:
             print('Now calculating yearly change for tile {}.'.format(tilename))
-            calcyearlychange(tilename, foresttograss, overwrite = overwrite)
+            calcyearlychange(tilename, foresttograss, overwrite = overwrite, engine = changeengine)
     else:
         print('Overwrite has not been set or {} does not exist, skipping.'.format(os.path.basename(forestrystatusfile)))
            
@@ -1958,6 +3191,10 @@ def makemaps(*args, **kwargs):
     reproctiles = kwargs.get('reproctiles', False)
     startyear = kwargs.get('startyear', margs.startyear)
     endyear = kwargs.get('endyear', margs.endyear)
+    changeengine = kwargs.get('changeengine', margs.changeengine)
+    workers = kwargs.get('workers', margs.workers)
+    splityears = kwargs.get('splityears', margs.splityears)
+    incremental = kwargs.get('incremental', margs.incremental)
     
     if not os.path.isfile(shp) and not os.path.dirname(shp) == ieo.gdb_path:
         print('ERROR: AIRT is missing: {}'.format(shp))
@@ -1967,57 +3204,96 @@ def makemaps(*args, **kwargs):
     if reproctiles:
         tiledict = makereproctiledict(startyear = startyear, endyear = endyear)
     
-    if shp.endswith('shp'): # Enable use of tiles now available in IEO 1.1.0
-        driver1 = ogr.GetDriverByName("ESRI Shapefile")
-        ds = driver1.Open(shp, 0)
-        tiles = ds.GetLayer()
-    else:
-        driver1 = ogr.GetDriverByName("FileGDB")
-        gdb, lname = os.path.split(shp)
-        ds = driver1.Open(gdb, 0)
-        tiles = ds.GetLayer(lname)
+    tiles = readtiles(shp)
     
     if dt4a or dt4b:
-        foresttograss = None
+        ftglist = [None]
         if dt4b:
             print('Now processing tiles using the DT4b algorithm.')
         else:
             print('Now processing tiles using the DT4a algorithm.')
-        for tile in tiles:
-            print('Now using tile: {}'.format(tile.GetField('Tile')))
-            if usetile:
-                if tile.GetField('Tile') == usetile:
-                    proctile(tile, foresttograss, overwrite = overwrite, yearlychange = yearlychange, yearlychangeonly = yearlychangeonly, dt4a = dt4a, dt4b = dt4b) # , probabilityonly = probabilityonly, yearlyonly = yearlyonly, fconly = fconly, 
-            elif reproctiles:
-                years = sorted(list(tiledict.keys()))
-                for year in years:
-                    if tile.GetField('Tile') in tiledict[year]:
-                        proctile(tile, foresttograss, overwrite = overwrite, yearlychange = yearlychange, startyear = year, endyear = year, yearlychangeonly = yearlychangeonly, dt4a = dt4a, dt4b = dt4b)
-            else:
-                proctile(tile, foresttograss, overwrite = overwrite, yearlychangeonly = yearlychangeonly, dt4a = dt4a, dt4b = dt4b)
-        print('All tiles have been processed.')
-        tiles.ResetReading()
     else:
-        foresttograss = minforesttograss
-        while foresttograss <= maxforesttograss:
-            print('Now processing tiles for foresttograss = {}.'.format(foresttograss))
-            for tile in tiles:
+        ftglist = list(range(minforesttograss, maxforesttograss + 1, increment))
+    
+    if margs.usecatfile and not margs.usescenes: # before planning, so that makeproclists() sees the overlaps of new catalog rows
+        for foresttograss in ftglist:
+            updatetileoverlaps(foresttograss, shp = shp)
+    
+    # Tiles are passed on as [tilename, WKT] pairs so that they can be sent to worker processes
+    if incremental: # rebuild only stale tile-years, then the change maps of the tiles affected
+        yeartasks = []
+        changetasks = []
+        if usetile:
+            tiles = [tileinfo for tileinfo in tiles if tileinfo[0] == usetile]
+        for foresttograss in ftglist:
+            tiledict, changetiles = makeincrementalplan(tiles, foresttograss, startyear = startyear, endyear = endyear)
+            print('Incremental build: {} stale tile-years and {} stale change maps found.'.format(sum([len(tiledict[year]) for year in tiledict.keys()]), len(changetiles)))
+            for year in sorted(list(tiledict.keys())):
+                for tileinfo in tiles:
+                    if tileinfo[0] in tiledict[year]:
+                        yeartasks.append([tileinfo, foresttograss, {'overwrite': True, 'yearlychange': False, 'startyear': year, 'endyear': year, 'dt4a': dt4a, 'dt4b': dt4b, 'changeengine': changeengine}])
+            if yearlychange:
+                for tileinfo in tiles:
+                    if tileinfo[0] in changetiles:
+                        changetasks.append([tileinfo, foresttograss, {'overwrite': True, 'yearlychangeonly': True, 'dt4a': dt4a, 'dt4b': dt4b, 'changeengine': changeengine}])
+        stages = [yeartasks, changetasks]
+    else:
+        tasks = []
+        for foresttograss in ftglist:
+            for tileinfo in tiles:
+                tilename = tileinfo[0]
                 if usetile:
-                    if tile.GetField('Tile') == usetile:
-                        proctile(tile, foresttograss, overwrite = overwrite, yearlychange = yearlychange, yearlychangeonly = yearlychangeonly, dt4a = dt4a, dt4b = dt4b) # , probabilityonly = probabilityonly, yearlyonly = yearlyonly, fconly = fconly, yearlychangeonly = yearlychangeonly
+                    if tilename == usetile:
+                        tasks.append([tileinfo, foresttograss, {'overwrite': overwrite, 'yearlychange': yearlychange, 'yearlychangeonly': yearlychangeonly, 'dt4a': dt4a, 'dt4b': dt4b, 'changeengine': changeengine}])
                 elif reproctiles:
                     years = sorted(list(tiledict.keys()))
                     for year in years:
-                        if tile.GetField('Tile') in tiledict[year]:
-                            proctile(tile, foresttograss, overwrite = overwrite, yearlychange = yearlychange, startyear = year, endyear = year, yearlychangeonly = yearlychangeonly, dt4a = dt4a, dt4b = dt4b)
+                        if tilename in tiledict[year]:
+                            tasks.append([tileinfo, foresttograss, {'overwrite': overwrite, 'yearlychange': yearlychange, 'startyear': year, 'endyear': year, 'yearlychangeonly': yearlychangeonly, 'dt4a': dt4a, 'dt4b': dt4b, 'changeengine': changeengine}])
                 else:
-                    proctile(tile, foresttograss, overwrite = overwrite, yearlychangeonly = yearlychangeonly, dt4a = dt4a, dt4b = dt4b)
-            print('All tiles have been processed for foresttograss = {}.'.format(foresttograss))
-            tiles.ResetReading()
-            foresttograss += increment
-    ds = None
+                    tasks.append([tileinfo, foresttograss, {'overwrite': overwrite, 'yearlychangeonly': yearlychangeonly, 'dt4a': dt4a, 'dt4b': dt4b, 'changeengine': changeengine}])
+    
+        if splityears or reproctiles: # run the probability stage per tile-year, then the change stage per tile once all years are done. Reprocessed tiles always have one task per tile-year, so their change maps are only built once per tile.
+            yeartasks = []
+            changetasks = []
+            for tileinfo, foresttograss, tilekwargs in tasks:
+                if not tilekwargs['yearlychangeonly']:
+                    for year in range(tilekwargs.get('startyear', margs.startyear), tilekwargs.get('endyear', margs.endyear) + 1):
+                        yearkwargs = dict(tilekwargs, startyear = year, endyear = year, yearlychange = False)
+                        yeartasks.append([tileinfo, foresttograss, yearkwargs])
+                if tilekwargs.get('yearlychange', True):
+                    changekwargs = dict(tilekwargs, yearlychangeonly = True)
+                    changekwargs.pop('startyear', None)
+                    changekwargs.pop('endyear', None)
+                    if not [tileinfo, foresttograss, changekwargs] in changetasks:
+                        changetasks.append([tileinfo, foresttograss, changekwargs])
+            stages = [yeartasks, changetasks]
+        else:
+            stages = [tasks]
+    
+    if yearlychange and margs.usemaskfile and changeengine == 'array':
+        makemaskindex(shp = shp) # built once here rather than by competing workers
+    
+    for stage in stages:
+        if workers > 1 and len(stage) > 1:
+            print('Processing {} tile tasks using {} worker processes.'.format(len(stage), workers))
+            pool = multiprocessing.Pool(workers, initdt4worker, (loglock, cubelock))
+            for tilename in pool.imap_unordered(proctileworker, stage):
+                print('Tile {} has been processed.'.format(tilename))
+            pool.close()
+            pool.join()
+        else:
+            for task in stage:
+                print('Now using tile: {}'.format(task[0][0]))
+                proctileworker(task)
+    print('All tiles have been processed.')
     print('All maps have been created.')
 
+def proctileworker(task):
+    tile, foresttograss, tilekwargs = task
+    proctile(tile, foresttograss, **tilekwargs)
+    return tile[0]
+
 ## batch functions
 
 def cleandir(d, *args, **kwargs):
@@ -2044,39 +3320,17 @@ def cleandir(d, *args, **kwargs):
                     if os.path.isfile(f):
                         os.remove(f)
 
-def batchdt4(*args, **kwargs):
-    # updated 8 February 2018 to include DT4b algorithm as new default
+def finddt4scenes(*args, **kwargs):
+    # Returns [reflectance file, Fmask file] pairs of the surface reflectance scenes within the year and day of year limits that have an Fmask file, or None if no scenes were found at all.
     indir = kwargs.get('indir', ieo.srdir)
-    invrtdir = os.path.join(indir, 'vrt')
     fmaskdir = kwargs.get('fmaskdir', ieo.fmaskdir)
-    fmaskvrtdir = os.path.join(fmaskdir, 'vrt')
-    outbasedir = kwargs.get('outbasedir', config['DEFAULT']['baseoutputdir'])
     startyear = kwargs.get('startyear', margs.startyear)
     endyear = kwargs.get('endyear', margs.endyear)
-    yearoffset = kwargs.get('yearoffset', 5)
     startday = kwargs.get('startday', margs.startday)
     endday = kwargs.get('endday', margs.endday) 
     path = kwargs.get('path', None)
     row = kwargs.get('row', None)
-    minforesttograss = kwargs.get('minforesttograss', margs.minforesttograss)
-    maxforesttograss = kwargs.get('maxforesttograss', margs.maxforesttograss)
-    minpixels = kwargs.get('minpixels', margs.minpixels)
-    increment = kwargs.get('increment',  margs.increment)
-    overwrite = kwargs.get('overwrite', margs.overwrite)
-    listfile = kwargs.get('listfile', os.path.join(os.path.join(ieo.catdir, 'LEDAPS_processing_lists'), 'LEDAPS_list_{}.txt'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))))
-    dt4a = kwargs.get('dt4a', margs.dt4a)
-    dt4b = kwargs.get('dt4b', margs.dt4b)
-    
-    if dt4a or dt4b:
-        foresttograss = None
-        incs = 1
-    else:
-        foresttograss = minforesttograss    
-        incs = (maxforesttograss - minforesttograss) / increment + 1
     filelist = []
-        
-    lastday = datetime.datetime.strptime('{}{:03}'.format(endyear, endday), '%Y%j')
-    today = datetime.datetime.today()
     
     if path and row:
         flist = glob.glob(os.path.join(indir, 'L*{:03}{:03}*_ref_ITM.dat'.format(path, row)))
@@ -2102,7 +3356,53 @@ def batchdt4(*args, **kwargs):
                     filelist.append([f, fmask])
     else:
         print('No scenes were found to process. Returning.')
+        return None
+    return filelist
+
+def batchdt4(*args, **kwargs):
+    # updated 8 February 2018 to include DT4b algorithm as new default
+    indir = kwargs.get('indir', ieo.srdir)
+    invrtdir = os.path.join(indir, 'vrt')
+    fmaskdir = kwargs.get('fmaskdir', ieo.fmaskdir)
+    fmaskvrtdir = os.path.join(fmaskdir, 'vrt')
+    outbasedir = kwargs.get('outbasedir', config['DEFAULT']['baseoutputdir'])
+    startyear = kwargs.get('startyear', margs.startyear)
+    endyear = kwargs.get('endyear', margs.endyear)
+    yearoffset = kwargs.get('yearoffset', 5)
+    startday = kwargs.get('startday', margs.startday)
+    endday = kwargs.get('endday', margs.endday) 
+    path = kwargs.get('path', None)
+    row = kwargs.get('row', None)
+    minforesttograss = kwargs.get('minforesttograss', margs.minforesttograss)
+    maxforesttograss = kwargs.get('maxforesttograss', margs.maxforesttograss)
+    minpixels = kwargs.get('minpixels', margs.minpixels)
+    increment = kwargs.get('increment',  margs.increment)
+    overwrite = kwargs.get('overwrite', margs.overwrite)
+    listfile = kwargs.get('listfile', os.path.join(os.path.join(ieo.catdir, 'LEDAPS_processing_lists'), 'LEDAPS_list_{}.txt'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))))
+    dt4a = kwargs.get('dt4a', margs.dt4a)
+    dt4b = kwargs.get('dt4b', margs.dt4b)
+    workers = kwargs.get('workers', margs.workers)
+    windowsize = kwargs.get('windowsize', margs.windowsize)
+    usefmaskindex = kwargs.get('usefmaskindex', margs.usefmaskindex)
+    
+    if dt4a or dt4b:
+        foresttograss = None
+        incs = 1
+    else:
+        foresttograss = minforesttograss    
+        incs = (maxforesttograss - minforesttograss) / increment + 1
+    filelist = finddt4scenes(indir = indir, fmaskdir = fmaskdir, startyear = startyear, endyear = endyear, startday = startday, endday = endday, path = path, row = row)
+    if filelist is None:
         return
+    
+    skipped = 0
+    if usefmaskindex: # drop scenes with too few clear land pixels before scheduling
+        index = makefmaskindex(fmasklist = [f[1] for f in filelist], workers = workers, windowsize = windowsize)
+        clearscenes = queryfmaskindex(index, minpixels)
+        skipped = len(filelist)
+        filelist = [f for f in filelist if os.path.basename(f[1])[:21] in clearscenes or not os.path.basename(f[1])[:21] in index.keys()] # scenes missing from the index are classified, so that unreadable Fmask files are reported
+        skipped -= len(filelist)
+        print('{} scenes have an insufficient number of clear land pixels according to the Fmask index and will be skipped.'.format(skipped))
         
     print('\n')
     numfiles = int(len(filelist) * incs)
@@ -2117,6 +3417,7 @@ def batchdt4(*args, **kwargs):
         outdirs = []
         while foresttograss <= maxforesttograss:
             outdirs.append(os.path.join(outbasedir, str(foresttograss)))
+            foresttograss += increment
     for outdir in outdirs:    
         if not os.access(outdir, os.F_OK):
             print("Creating directory: {}".format(outdir))
@@ -2129,43 +3430,104 @@ def batchdt4(*args, **kwargs):
         if overwrite: # Delete any existing files for this foresttograss value
             cleandir(outdir, deldt4s = True)
             
-    for f in filelist:
-        foresttograss = minforesttograss
-        for outdir in outdirs:
-            if not dt4a and not dt4b:
-                foresttograss = int(os.path.basename(outdir))
-            breakloop = False # Breaks while loop for Fmask issues 
-#            outdir = os.path.join(outbasedir, str(foresttograss))
-            basename = os.path.basename(f[0])
-            ref = f[0]
-            fmask = f[1]
-            print('Processing scene {}, number {} of {}.'.format(basename[:21], filenum, numfiles))
-            retry = True
-            errors = 0
-            while retry and errors < 5:
-                if dt4b:
-                    success, msg = DT4b(ref, outdir, minpixels, minforesttograss = minforesttograss, maxforesttograss = maxforesttograss, fmask = fmask, overwrite = overwrite, listfile = listfile)
-                elif dt4a:
-                    success, msg = DT4a(ref, outdir, minpixels, minforesttograss = minforesttograss, maxforesttograss = maxforesttograss, fmask = fmask, overwrite = overwrite, listfile = listfile)
+    kwargs = {'minforesttograss': minforesttograss, 'maxforesttograss': maxforesttograss, 'overwrite': overwrite, 'listfile': listfile, 'dt4a': dt4a, 'dt4b': dt4b, 'windowsize': windowsize}
+    tasks = [[f[0], f[1], outdirs, minpixels, kwargs] for f in filelist]
+    results = {'Success': 0}
+    if skipped > 0:
+        results['Insufficient pixels'] = skipped
+    starttime = datetime.datetime.now()
+    if workers > 1:
+        print('Classifying {} scenes using {} worker processes.'.format(len(tasks), workers))
+        pool = multiprocessing.Pool(workers, initdt4worker, (loglock,))
+        sceneresults = pool.imap_unordered(dt4sceneworker, tasks)
+    else:
+        sceneresults = map(dt4sceneworker, tasks)
+    for ref, sceneresult in sceneresults:
+        print('Finished scene {}, number {} of {}.'.format(os.path.basename(ref)[:21], filenum, len(tasks)))
+        for outdir, success, msg in sceneresult:
+            if not msg in results.keys():
+                results[msg] = 0
+            results[msg] += 1
+        filenum += 1
+    if workers > 1:
+        pool.close()
+        pool.join()
+    minutes = (datetime.datetime.now() - starttime).total_seconds() / 60.
+    print('Processed {} scenes in {:.1f} minutes ({:.2f} scenes per minute).'.format(len(tasks), minutes, len(tasks) / max(minutes, 1. / 60.)))
+    for msg in sorted(results.keys()):
+        print('{}: {}'.format(msg, results[msg]))
+
+def initdt4worker(lock, *args):
+    # Shares the error log lock, and optionally the time-series cube lock, with worker processes.
+    global loglock, cubelock
+    loglock = lock
+    if len(args) > 0:
+        cubelock = args[0]
+
+def dt4sceneworker(task):
+    ref, fmask, outdirs, minpixels, kwargs = task
+    return ref, dt4scene(ref, fmask, outdirs, minpixels, **kwargs)
+
+def dt4scene(ref, fmask, outdirs, minpixels, *args, **kwargs):
+    # Classifies one scene into each of outdirs with dt4sweep(), DT4a() or DT4b(), retrying up to five times on errors. Returns a list of [outdir, success, message] for each classification attempted.
+    minforesttograss = kwargs.get('minforesttograss', margs.minforesttograss)
+    maxforesttograss = kwargs.get('maxforesttograss', margs.maxforesttograss)
+    overwrite = kwargs.get('overwrite', margs.overwrite)
+    listfile = kwargs.get('listfile', None)
+    dt4a = kwargs.get('dt4a', margs.dt4a)
+    dt4b = kwargs.get('dt4b', margs.dt4b)
+    windowsize = kwargs.get('windowsize', margs.windowsize)
+    basename = os.path.basename(ref)
+    sceneresult = []
+    if not dt4a and not dt4b: # DT4 threshold sweep: all foresttograss values are classified from a single read of the scene
+        print('Processing scene {}.'.format(basename[:21]))
+        thresholds = [int(os.path.basename(outdir)) for outdir in outdirs]
+        errors = 0
+        while len(outdirs) > 0 and errors < 5:
+            retrydirs = []
+            for outdir, success, msg in dt4sweep(ref, outdirs, minpixels, thresholds, fmask = fmask, overwrite = overwrite, listfile = listfile, windowsize = windowsize):
+                if not success and not msg in ['Insufficient pixels', 'No Fmask', 'Output exists']:
+                    retrydirs.append(outdir)
                 else:
-                    success, msg = dt4(ref, outdir, minpixels, foresttograss, fmask = fmask, overwrite = overwrite, listfile = listfile)
-                if success:
-                    retry = False
-                elif not success and msg in ['Insufficient pixels', 'No Fmask', 'Output exists']:
-                    print('There was an error with the scene: {}. Skipping.'.format(msg))
-#                    filelist.pop(filelist.index(f))
-                    if msg in ['Insufficient pixels', 'No Fmask']:
-                        breakloop = True
-                    retry = False
+                    if not success:
+                        print('There was an error with the scene: {}. Skipping.'.format(msg))
+                    sceneresult.append([outdir, success, msg])
+            if len(retrydirs) > 0:
+                print('There was an error with SceneID {}: {}.'.format(basename[:21], msg))
+                errors += 1
+                if errors < 5:
+                    print('Retry {}/5'.format(errors))
                 else:
-                    print('There was an error with SceneID {}: {}.'.format(basename[:21], msg))
-                    errors += 1
-                    if errors <= 5:
-                        print('Retry {}/5'.format(errors))
-            if breakloop:
-                break
-            foresttograss += increment
-        filenum += 1
+                    sceneresult.extend([[outdir, False, msg] for outdir in retrydirs])
+            thresholds = [int(os.path.basename(outdir)) for outdir in retrydirs]
+            outdirs = retrydirs
+        return sceneresult
+    for outdir in outdirs:
+        breakloop = False # Breaks while loop for Fmask issues 
+        print('Processing scene {}.'.format(basename[:21]))
+        retry = True
+        errors = 0
+        while retry and errors < 5:
+            if dt4b:
+                success, msg = DT4b(ref, outdir, minpixels, minforesttograss = minforesttograss, maxforesttograss = maxforesttograss, fmask = fmask, overwrite = overwrite, listfile = listfile, windowsize = windowsize)
+            else:
+                success, msg = DT4a(ref, outdir, minpixels, minforesttograss = minforesttograss, maxforesttograss = maxforesttograss, fmask = fmask, overwrite = overwrite, listfile = listfile, windowsize = windowsize)
+            if success:
+                retry = False
+            elif not success and msg in ['Insufficient pixels', 'No Fmask', 'Output exists']:
+                print('There was an error with the scene: {}. Skipping.'.format(msg))
+                if msg in ['Insufficient pixels', 'No Fmask']:
+                    breakloop = True
+                retry = False
+            else:
+                print('There was an error with SceneID {}: {}.'.format(basename[:21], msg))
+                errors += 1
+                if errors <= 5:
+                    print('Retry {}/5'.format(errors))
+        sceneresult.append([outdir, success, msg])
+        if breakloop:
+            break
+    return sceneresult
  
 def batchmultiyeardt4(*args, **kwargs):
     
@@ -2209,18 +3571,319 @@ def batchmultiyeardt4(*args, **kwargs):
         foresttograss += increment
 
                                         
+## Streaming pipeline
+
+# Scenes are classified into memory and added straight to per-tile class count accumulators of the year being processed, so that neither the scene classifications nor the VRTs need be written and read back. Scenes are streamed in acquisition date order, and scenes of the same date are mosaicked per tile as gdalbuildvrt -srcnodata 0 would. A tile-year is finished, and its accumulator freed, as soon as the last scene of the year that overlaps it has been counted.
+# As scenes of a year span the whole season, most accumulators live until the last dates of the year. Memory is therefore about 25 bytes per tile pixel and foresttograss value: a uint16 count per class plus the date mosaic. For the 1000 x 975 pixel national tiles that is about 3.2 GB for 135 tiles with DT4b, and five times that for a five threshold DT4 sweep. --streamtiles limits the tiles accumulated per pass, at the cost of classifying scenes that overlap tiles of several passes once per pass. With worker processes, at most two classified scenes per worker are held on top of that.
+
+def classifyscene(infile, cfmaskfile, minpixels, *args, **kwargs):
+    # Classifies a scene into memory with dt4windows(). Returns [data, geoTrans, acqtime, message], where data is None if the scene was not classified. With a list of thresholds, data holds one DT4 classification per foresttograss value.
+    algorithm = kwargs.get('algorithm', 'DT4b')
+    thresholds = kwargs.get('thresholds', None)
+    minforesttograss = kwargs.get('minforesttograss', margs.minforesttograss)
+    maxforesttograss = kwargs.get('maxforesttograss', margs.maxforesttograss)
+    windowsize = kwargs.get('windowsize', margs.windowsize)
+    basename = os.path.basename(infile)
+    NIRSWIR12 = coeffdict[basename[:3]]['NIRSWIR12']
+    GRNIR = coeffdict[basename[:3]]['GRNIR']
+    landsat = basename[2:3]
+    try:
+        cfmask = gdal.Open(cfmaskfile)
+        if countclearpixels(cfmask, windowsize = windowsize) < minpixels:
+            cfmask = None
+            return [None, None, None, 'Insufficient pixels']
+    except Exception as e:
+        print('There was an error in the Fmask file, logging and skipping scene: {}'.format(e))
+        logerror(cfmaskfile, e)
+        return [None, None, None, 'Fmask error']
+    try:
+        raster = gdal.Open(infile)
+        acqtime = getacqtime(infile)
+        geoTrans = raster.GetGeoTransform()
+        data = dt4windows(raster, cfmask, landsat, GRNIR, NIRSWIR12, minforesttograss, maxforesttograss, algorithm = algorithm, thresholds = thresholds, windowsize = windowsize)
+    except Exception as e:
+        print('There was an error with the reflectance data file, logging and skipping scene: {}'.format(e))
+        logerror(infile, e)
+        return [None, None, None, 'Processing error']
+    raster = None
+    cfmask = None
+    return [data, geoTrans, acqtime, 'Success']
+
+def classifysceneworker(task):
+    ref, fmask, minpixels, kwargs = task
+    return [ref, fmask] + classifyscene(ref, fmask, minpixels, **kwargs)
+
+def orderedresults(pool, func, tasks, maxpending):
+    # Yields func(task) for each task in order, with at most maxpending tasks submitted to the pool ahead of the result being consumed, so that classified scenes cannot pile up in memory while earlier ones are composited.
+    pending = []
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= maxpending:
+            yield pending.pop(0).get()
+    while len(pending) > 0:
+        yield pending.pop(0).get()
+
+def finishtileyear(tilename, foresttograss, year, counts, geoTrans, rasters, *args, **kwargs):
+    # Writes the probability rasters of a streamed tile-year from its class count cube and derives its yearly DT4 and forestry classes, as proctile() does for rasters read from disk.
+    multibandpct = kwargs.get('multibandpct', margs.multibandpct)
+    if margs.dt4a:
+        outsubdir = 'dt4a'
+    elif margs.dt4b:
+        outsubdir = 'dt4b'
+    else:
+        outsubdir = str(foresttograss)
+    outdir = os.path.join(os.path.join(config['DEFAULT']['baseoutputdir'], outsubdir), 'Probability')
+    makedir(outdir)
+    print('Tile {} year {}: writing probability rasters from {} streamed scenes.'.format(tilename, year, len(rasters)))
+    writeprobabilityrasters(counts, foresttograss, year, tilename, geoTrans, outdir, rasters, multibandpct = multibandpct)
+    Yearlydt4(outdir, year, tilename, foresttograss, overwrite = True, multibandpct = multibandpct)
+    forestryclass(tilename, foresttograss, year, overwrite = True)
+
+def flushdate(datebuffers, datescenes, accumulators, scenewindows, pending, grids, pixelindexes, year, ftglist):
+    # Counts the classes composited for one acquisition date into the tile accumulators and empties the date buffers. Then finishes the tile-years that no later scene of the year overlaps. Returns the [tilename, foresttograss] pairs finished.
+    finished = []
+    for tilename in datebuffers.keys():
+        bands, extent = datebuffers[tilename]
+        dst = (slice(extent[0], extent[1]), slice(extent[2], extent[3]))
+        counts, rasters, tilemask = accumulators[tilename]
+        for j in range(len(ftglist)):
+            accumulateclasses(counts[j], bands[j][dst], dst, pixelindexes[bands.shape[1:]], tilemask = tilemask)
+    datebuffers.clear()
+    for ref in datescenes:
+        for tilename in scenewindows[ref].keys():
+            pending[tilename] -= 1
+            if pending[tilename] == 0 and tilename in accumulators.keys():
+                counts, rasters, tilemask = accumulators.pop(tilename)
+                for foresttograss, tilecounts in zip(ftglist, counts):
+                    finishtileyear(tilename, foresttograss, year, tilecounts, grids[tilename][0], rasters)
+                    finished.append([tilename, foresttograss])
+                counts = None
+    return finished
+
+def streammaps(*args, **kwargs):
+    # Streaming pipeline from surface reflectance scenes to tile maps, see above. Scene classifications are only written if writescenes = True. Yearly change is calculated per tile once all years have been streamed.
+    shp = kwargs.get('shp', margs.shp)
+    startyear = kwargs.get('startyear', margs.startyear)
+    endyear = kwargs.get('endyear', margs.endyear)
+    minpixels = kwargs.get('minpixels', margs.minpixels)
+    minforesttograss = kwargs.get('minforesttograss', margs.minforesttograss)
+    maxforesttograss = kwargs.get('maxforesttograss', margs.maxforesttograss)
+    increment = kwargs.get('increment', margs.increment)
+    overwrite = kwargs.get('overwrite', margs.overwrite)
+    dt4a = kwargs.get('dt4a', margs.dt4a)
+    dt4b = kwargs.get('dt4b', margs.dt4b)
+    workers = kwargs.get('workers', margs.workers)
+    windowsize = kwargs.get('windowsize', margs.windowsize)
+    usefmaskindex = kwargs.get('usefmaskindex', margs.usefmaskindex)
+    writescenes = kwargs.get('writescenes', margs.writescenes)
+    maskprobability = kwargs.get('maskprobability', margs.maskprobability)
+    yearlychange = kwargs.get('yearlychange', True)
+    changeengine = kwargs.get('changeengine', margs.changeengine)
+    outbasedir = kwargs.get('outbasedir', config['DEFAULT']['baseoutputdir'])
+    maxtiles = kwargs.get('maxtiles', margs.streamtiles)
+    listfile = kwargs.get('listfile', os.path.join(os.path.join(ieo.catdir, 'LEDAPS_processing_lists'), 'LEDAPS_list_{}.txt'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))))
+    
+    if dt4b:
+        algorithm = 'DT4b'
+        ftglist = [None]
+        outsubdirs = ['dt4b']
+        thresholds = None
+    elif dt4a:
+        algorithm = 'DT4a'
+        ftglist = [None]
+        outsubdirs = ['dt4a']
+        thresholds = None
+    else: # one DT4 classification per foresttograss value from a single read of each scene
+        algorithm = 'DT4'
+        ftglist = list(range(minforesttograss, maxforesttograss + 1, increment))
+        outsubdirs = [str(foresttograss) for foresttograss in ftglist]
+        thresholds = ftglist
+    for outsubdir in outsubdirs:
+        makedir(os.path.join(os.path.join(outbasedir, outsubdir), 'Probability'))
+    
+    filelist = finddt4scenes(startyear = startyear, endyear = endyear)
+    if filelist is None:
+        return
+    badlist = getbadlist()
+    filelist = [f for f in filelist if not os.path.basename(f[0])[9:16] in badlist]
+    results = {'Success': 0}
+    if usefmaskindex: # drop scenes with too few clear land pixels before scheduling
+        index = makefmaskindex(fmasklist = [f[1] for f in filelist], workers = workers, windowsize = windowsize)
+        clearscenes = queryfmaskindex(index, minpixels)
+        skipped = len(filelist)
+        filelist = [f for f in filelist if os.path.basename(f[1])[:21] in clearscenes or not os.path.basename(f[1])[:21] in index.keys()] # scenes missing from the index are classified, so that unreadable Fmask files are reported
+        results['Insufficient pixels'] = skipped - len(filelist)
+    
+    tiles = readtiles(shp)
+    grids = {}
+    for tile in tiles:
+        grids[tile[0]] = tilegrid(tile)
+    pixelindexes = {}
+    streamed = []
+    seenscenes = set()
+    if yearlychange and margs.usemaskfile and changeengine == 'array':
+        makemaskindex(shp = shp)
+    classkwargs = {'algorithm': algorithm, 'thresholds': thresholds, 'minforesttograss': minforesttograss, 'maxforesttograss': maxforesttograss, 'windowsize': windowsize}
+    starttime = datetime.datetime.now()
+    
+    for year in range(startyear, endyear + 1):
+        yearlist = sorted([f for f in filelist if os.path.basename(f[0])[9:13] == str(year)], key = lambda f: (os.path.basename(f[0])[9:16], os.path.basename(f[0])))
+        if len(yearlist) == 0:
+            continue
+        # Tile windows of each scene from its Fmask geometry, and the number of scenes of the year still to come for each tile
+        donetiles = []
+        if not overwrite:
+            for tilename in grids.keys():
+                done = True
+                for foresttograss, outsubdir in zip(ftglist, outsubdirs):
+                    headerdict = getheaderdict(rastertype = 'Highpos', year = year, tilename = tilename, foresttograss = foresttograss)
+                    if not os.path.isfile(productpath(os.path.join(os.path.join(outbasedir, outsubdir), 'Probability'), headerdict['defaultbasefilename'])):
+                        done = False
+                if done:
+                    donetiles.append(tilename)
+        scenewindows = {}
+        pending = {}
+        for ref, fmask in yearlist:
+            ds = gdal.Open(fmask)
+            srcgeometry = (ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize)
+            ds = None
+            scenewindows[ref] = {}
+            for tilename in grids.keys():
+                if tilename in donetiles:
+                    continue
+                geoTrans, cols, rows = grids[tilename]
+                try:
+                    window = tilewindow(geoTrans, cols, rows, *srcgeometry)
+                except ValueError as e:
+                    print('ERROR: {}: {}'.format(os.path.basename(fmask), e))
+                    logerror(fmask, e)
+                    window = None
+                if window:
+                    scenewindows[ref][tilename] = window
+                    if not tilename in pending.keys():
+                        pending[tilename] = 0
+                    pending[tilename] += 1
+        # Tiles are streamed in passes of at most maxtiles tiles, each pass reading only the scenes that overlap its tiles
+        tilenames = sorted(pending.keys())
+        if maxtiles > 0:
+            batches = [tilenames[i:i + maxtiles] for i in range(0, len(tilenames), maxtiles)]
+        else:
+            batches = [tilenames]
+        for batch in batches:
+            batchwindows = {}
+            for ref, fmask in yearlist:
+                batchwindows[ref] = dict([(tilename, scenewindows[ref][tilename]) for tilename in scenewindows[ref].keys() if tilename in batch])
+            batchlist = [f for f in yearlist if len(batchwindows[f[0]]) > 0]
+            gigabytes = sum([grids[tilename][1] * grids[tilename][2] for tilename in batch]) * len(ftglist) * (12 * 2 + 1) / 1024. ** 3
+            print('Year {}: streaming {} scenes into {} of {} tiles, using up to {:.1f} GB for class counts.'.format(year, len(batchlist), len(batch), len(tilenames), gigabytes))
+            
+            tasks = [[ref, fmask, minpixels, classkwargs] for ref, fmask in batchlist]
+            if workers > 1 and len(tasks) > 1:
+                pool = multiprocessing.Pool(workers, initdt4worker, (loglock,))
+                sceneresults = orderedresults(pool, classifysceneworker, tasks, 2 * workers) # in order, so that same-date scenes are mosaicked as in a VRT
+            else:
+                pool = None
+                sceneresults = map(classifysceneworker, tasks)
+            accumulators = {} # [class count cubes, one per foresttograss value, parent rasters, tile forestry mask] keyed by tile
+            datebuffers = {} # [(foresttograss values, rows, cols) mosaic of the current date, extent] keyed by tile
+            datescenes = []
+            currentdate = None
+            for ref, fmask, data, geoTrans, acqtime, msg in sceneresults:
+                basename = os.path.basename(ref)
+                if basename[9:16] != currentdate:
+                    streamed.extend(flushdate(datebuffers, datescenes, accumulators, batchwindows, pending, grids, pixelindexes, year, ftglist))
+                    datescenes = []
+                    currentdate = basename[9:16]
+                datescenes.append(ref)
+                firstpass = not ref in seenscenes # scenes overlapping tiles of several passes are classified once per pass, but only counted and written once
+                seenscenes.add(ref)
+                if firstpass:
+                    if not msg in results.keys():
+                        results[msg] = 0
+                    results[msg] += 1
+                if data is None:
+                    if firstpass:
+                        print('Scene {} was not classified: {}'.format(basename[:21], msg))
+                        if msg == 'Fmask error':
+                            ESPAreprocess(basename[:21], listfile)
+                    continue
+                print('Streaming scene {} into {} tiles.'.format(basename[:21], len(batchwindows[ref])))
+                if data.ndim == 2:
+                    data = data[np.newaxis]
+                if writescenes and firstpass:
+                    for j, foresttograss in enumerate(ftglist):
+                        outdir = os.path.join(outbasedir, outsubdirs[j])
+                        if algorithm == 'DT4':
+                            writedata(data[j], 'DT4', geoTrans, foresttograss = foresttograss, acqtime = acqtime, SceneID = basename[:21], outdir = outdir, rasters = [ref, fmask])
+                        else:
+                            writedata(data[j], algorithm, geoTrans, minforesttograss = minforesttograss, maxforesttograss = maxforesttograss, acqtime = acqtime, SceneID = basename[:21], outdir = outdir, rasters = [ref, fmask])
+                for tilename in batchwindows[ref].keys():
+                    (xoff, yoff, xsize, ysize), dst = batchwindows[ref][tilename]
+                    tilegt, cols, rows = grids[tilename]
+                    if not tilename in accumulators.keys():
+                        tilemask = None
+                        if maskprobability and margs.usemaskfile:
+                            tilemask = readmaskwindow(tilegt, cols, rows)
+                        accumulators[tilename] = [[np.zeros((12, rows, cols), dtype = np.uint16) for foresttograss in ftglist], [], tilemask]
+                        if not (rows, cols) in pixelindexes.keys():
+                            pixelindexes[(rows, cols)] = np.arange(rows * cols, dtype = np.intp).reshape(rows, cols)
+                    accumulators[tilename][1].append(ref)
+                    if tilename in datebuffers.keys():
+                        extent = datebuffers[tilename][1]
+                        datebuffers[tilename][1] = [min(extent[0], dst[0].start), max(extent[1], dst[0].stop), min(extent[2], dst[1].start), max(extent[3], dst[1].stop)]
+                    else:
+                        datebuffers[tilename] = [np.zeros((len(ftglist), rows, cols), dtype = np.uint8), [dst[0].start, dst[0].stop, dst[1].start, dst[1].stop]]
+                    bands = datebuffers[tilename][0]
+                    for j in range(len(ftglist)):
+                        window = data[j, yoff:yoff + ysize, xoff:xoff + xsize]
+                        np.copyto(bands[j][dst], window, where = numexpr.evaluate('(window != 0)')) # later scenes of the date are drawn over earlier ones except where they are 0
+                    window = None
+                data = None
+            streamed.extend(flushdate(datebuffers, datescenes, accumulators, batchwindows, pending, grids, pixelindexes, year, ftglist))
+            if pool:
+                pool.close()
+                pool.join()
+    
+    minutes = (datetime.datetime.now() - starttime).total_seconds() / 60.
+    print('Streamed {} scenes in {:.1f} minutes.'.format(sum([results[msg] for msg in results.keys() if msg != 'Insufficient pixels' or not usefmaskindex]), minutes))
+    for msg in sorted(results.keys()):
+        print('{}: {}'.format(msg, results[msg]))
+    
+    if yearlychange:
+        changetasks = []
+        for tileinfo in tiles:
+            for foresttograss in ftglist:
+                if [tileinfo[0], foresttograss] in streamed:
+                    changetasks.append([tileinfo, foresttograss, {'overwrite': True, 'yearlychangeonly': True, 'dt4a': dt4a, 'dt4b': dt4b, 'changeengine': changeengine}])
+        if workers > 1 and len(changetasks) > 1:
+            print('Calculating change for {} tiles using {} worker processes.'.format(len(changetasks), workers))
+            pool = multiprocessing.Pool(workers, initdt4worker, (loglock, cubelock))
+            for tilename in pool.imap_unordered(proctileworker, changetasks):
+                print('Tile {} has been processed.'.format(tilename))
+            pool.close()
+            pool.join()
+        else:
+            for task in changetasks:
+                proctileworker(task)
+    print('Streaming pipeline complete.')
+
 ## main
 
 def main():
 #    overwrite = margs.overwrite
     if margs.dt4a:
         margs.dt4b = False
+    if margs.stream:
+        streammaps(overwrite = margs.overwrite, shp = margs.shp)
+        return
     if margs.calcdt4:
         
        batchdt4(overwrite = margs.overwrite) 
-       import ifordeovrt
-       ifordeovrt.margs.overwrite = True
-       ifordeovrt.batchvrts()
+       if not margs.usescenes: # tiles can be processed straight from the scene classifications otherwise
+           import ifordeovrt
+           ifordeovrt.margs.overwrite = margs.overwrite
+           ifordeovrt.margs.update = not margs.overwrite # only new or changed dates
+           ifordeovrt.batchvrts()
     # if computername == 'HCAX378':
     #     if margs.calcdt4:
     #         print('Calculating DT4 classifications.')
@@ -2228,6 +3891,25 @@ def main():
     #     tileshp = r'D:\Spatial Analysis Unit\Analysis\CForRep\Working\Classifications\IRL_tiles_45.shp'
     #     if not os.path.exists(tileshp):
     #         makegrid(outfile = tileshp)
+    if margs.querypoints:
+        if margs.dt4a or margs.dt4b:
+            foresttograss = None
+        else:
+            foresttograss = margs.minforesttograss
+        queryoutput = margs.queryoutput
+        if not queryoutput:
+            queryoutput = '{}_query.csv'.format(os.path.splitext(margs.querypoints)[0])
+        results = querypixels(readquerypoints(margs.querypoints), foresttograss = foresttograss, shp = margs.shp)
+        writequeryresults(results, queryoutput)
+        return
+    if margs.scenetiles:
+        if margs.dt4a or margs.dt4b:
+            foresttograss = None
+        else:
+            foresttograss = margs.minforesttograss
+        tilenames = getscenetiles(margs.scenetiles, foresttograss, shp = margs.shp)
+        print('Scene {} feeds {} tiles: {}'.format(margs.scenetiles, len(tilenames), ', '.join(tilenames)))
+        return
     makemaps(overwrite = margs.overwrite, shp = margs.shp)
 
 if __name__ == '__main__':
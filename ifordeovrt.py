@@ -8,10 +8,9 @@ Created on Wed Aug  3 15:16:51 2016
 
 # 8 February 2018: Updated to support DT4b files
 
-import os, sys, glob, datetime, argparse, shutil, ieo
-from subprocess import Popen
+import os, sys, glob, datetime, argparse, shutil, multiprocessing, sqlite3, ieo
 from pkg_resources import resource_filename, Requirement
-from osgeo import ogr, osr
+from osgeo import gdal, ogr, osr
 
 if sys.version_info[0] == 2:
     import ConfigParser as configparser
@@ -37,14 +36,20 @@ parser.add_argument('--increment', type = int, default = 250, help = 'Increment
 parser.add_argument('--dt4a', type = bool, default = False, help = 'Use DT4a data files (default = False, setting to True overrides --dt4b setting).')
 parser.add_argument('--dt4b', type = bool, default = True, help = 'Use DT4b data files (default = True).')
 parser.add_argument('-l', '--listonly', action = "store_true", help = 'Rewrite catalog lists, but not VRTs.')
-parser.add_argument('-u', '--update', action = "store_true", help = 'Update VRTs and lists for new scenes.')
+parser.add_argument('-u', '--update', action = "store_true", help = 'Only build VRTs and catalog entries for new or changed dates, and remove those of dates whose scene classifications have gone.')
 parser.add_argument('-f', '--fix', action = "store_true", help = 'Fix shapefiles only.')
+parser.add_argument('--workers', type = int, default = 1, help = 'Number of worker processes used to build VRTs (default = 1).')
+parser.add_argument('-c', '--catalog', action = "store_true", help = 'Build scene catalog databases from existing catalog shapefiles only.')
 margs = parser.parse_args()
 
 if margs.dt4a:
     margs.dt4b = False
 
 catdir = config['DEFAULT']['catdir'] # os.path.join(margs.rootdir,'Catalog')
+if config['DEFAULT'].get('outputformat', 'ENVI') == 'ENVI': # classification file extension, see ifordeo.writedata()
+    classext = '.dat'
+else:
+    classext = '.tif'
 #print(catdir)
 
 target = osr.SpatialReference()
@@ -53,7 +58,7 @@ target.ImportFromEPSG(2157) # Irish Transverse Mercator ERTS-89
 driver = ogr.GetDriverByName("ESRI Shapefile")
 
 def makefilelist(dirname, datetuple):
-    flist = glob.glob(os.path.join(dirname, 'L*%s*.dat'%datetuple.strftime('%Y%j')))
+    flist = glob.glob(os.path.join(dirname, 'L*%s*%s'%(datetuple.strftime('%Y%j'), classext)))
     filelist = []
     if len(flist) >= 2:
         if len(flist) == 2 and os.path.basename(flist[0])[6:9] == os.path.basename(flist[1])[6:9]:
@@ -84,31 +89,31 @@ def makefilelist(dirname, datetuple):
 
 def makevrtfilename(outdir, filelist):
     numscenes = len(filelist)
-    basename = os.path.basename(filelist[0]).replace('.dat','.vrt')
+    basename = os.path.basename(filelist[0]).replace(classext,'.vrt')
     startrow = basename[8:9]
     endrow = os.path.basename(filelist[-1])[8:9]
     outbasename = '%s%d%s%s%s'%(basename[:6],numscenes,startrow,endrow,basename[9:])
     vrtfilename = os.path.join(outdir, outbasename)
     return vrtfilename
 
-def writetocsv(catfile, vrt, filelist, datetuple):
-    scenelist = ['None'] * 4
-    path = None
-    for f in filelist:
-        sceneID = os.path.basename(f)[:21]
-        i = int(sceneID[7:9]) - 21
-        scenelist[i] = sceneID
-        if not path:
-            path = sceneID[3:6]
+def makecsvline(vrt, filelist, datetuple):
+    scenelist = getscenelist(filelist)
+    path = os.path.basename(filelist[0])[3:6] # row 21 may be missing
+    outline = '%s,%s,%s,%s'%(datetuple.strftime('%Y-%m-%d'),datetuple.strftime('%Y'),datetuple.strftime('%j'),path)
+    for s in scenelist:
+        outline += ',%s'%s
+    return '{},{}\n'.format(outline,vrt)
+
+def writetocsv(catfile, vrt, filelist, datetuple, *args, **kwargs):
+    # Appends one or more VRTs to a catalog CSV file. entries is a list of [vrt, filelist, datetuple], otherwise the single VRT given is written.
+    entries = kwargs.get('entries', [[vrt, filelist, datetuple]])
     header = 'Date,Year,DOY,Path,R021,R022,R023,R024,VRT'    
     if not os.path.isfile(catfile): # creates catalog file if missing
         with open(catfile,'w') as output:
             output.write('%s\n'%header)    
-    outline = '%s,%s,%s,%s'%(datetuple.strftime('%Y-%m-%d'),datetuple.strftime('%Y'),datetuple.strftime('%j'),scenelist[0][3:6])
-    for s in scenelist:
-        outline += ',%s'%s
     with open(catfile,'a') as output:
-        output.write('{},{}\n'.format(outline,vrt))
+        for entry in entries:
+            output.write(makecsvline(*entry))
     
 def fixshps():
     foresttograss = margs.minforesttograss    
@@ -121,27 +126,99 @@ def fixshps():
         writetoshp(catshp, fix = True)
         foresttograss += margs.increment
 
-def writetoshp(catshp, *args, **kwargs):
-    vrt = kwargs.get('vrt', None)
-    filelist = kwargs.get('filelist', None)
-    datetuple = kwargs.get('datetuple', None)
-    fix = kwargs.get('fix', False)
-    
-    src_ds = driver.Open(ieo.landsatshp, 0)
-    inlayer = src_ds.GetLayer()
-    
-    if not fix:
-        ftg = os.path.basename(os.path.dirname(filelist[0]))
-#        print(filelist[0])    
-        path = int(os.path.basename(filelist[0])[3:6])
-    
-#    featlist= []
-        scenelist = []
-        scenelist = ['None'] * 4
-        for f in filelist:
-            sceneID = os.path.basename(f)[:21]
-            i = int(sceneID[7:9]) - 21
-            scenelist[i] = sceneID
+def getcatalogdb(subdir):
+    # Returns the path of the scene catalog database of a DT4/a/b output subdirectory, e.g. 3250 or dt4b.
+    return os.path.join(catdir, '{}_proc.sqlite'.format(subdir))
+
+def opencatalog(catdb):
+    # Opens a scene catalog database, creating its tables if missing. Each VRT or single scene is one row of 'scenes' with its footprint as WKT, the footprint bounds are in the R-tree 'scenes_rtree' under the same id, and 'scenerows' lists the Landsat scenes it is made of.
+    conn = sqlite3.connect(catdb)
+    conn.execute('CREATE TABLE IF NOT EXISTS scenes (id INTEGER PRIMARY KEY, VRT TEXT UNIQUE, Date TEXT, Year INTEGER, DOY INTEGER, YearDOY TEXT, Path INTEGER, Bad INTEGER, WKT TEXT)')
+    conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS scenes_rtree USING rtree(id, minX, maxX, minY, maxY)')
+    conn.execute('CREATE TABLE IF NOT EXISTS scenerows (id INTEGER, sceneID TEXT, Row INTEGER)')
+    for name, table, column in [('Year', 'scenes', 'Year'), ('DOY', 'scenes', 'DOY'), ('YearDOY', 'scenes', 'YearDOY'), ('Path', 'scenes', 'Path'), ('Bad', 'scenes', 'Bad'), ('sceneID', 'scenerows', 'sceneID'), ('Row', 'scenerows', 'Row'), ('id', 'scenerows', 'id')]:
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_{}_{} ON {} ({})'.format(table, name, table, column))
+    conn.commit()
+    return conn
+
+def writetocatalog(catdb, vrt, scenelist, datetuple, geom, *args, **kwargs):
+    # Adds or replaces a VRT in the scene catalog database. scenelist holds the sceneIDs of rows 21 to 24 or 'None'.
+    badlist = kwargs.get('badlist', [])
+    conn = kwargs.get('conn', None)
+    commit = kwargs.get('commit', True) # bulk writers commit once for all rows
+    closeconn = conn is None
+    if closeconn:
+        conn = opencatalog(catdb)
+    yeardoy = datetuple.strftime('%Y%j')
+    path = None
+    for sceneID in scenelist:
+        if sceneID != 'None':
+            path = int(sceneID[3:6])
+            break
+    cur = conn.cursor()
+    cur.execute('SELECT id FROM scenes WHERE VRT = ?', (vrt,))
+    row = cur.fetchone()
+    if row:
+        cur.execute('DELETE FROM scenes WHERE id = ?', row)
+        cur.execute('DELETE FROM scenes_rtree WHERE id = ?', row)
+        cur.execute('DELETE FROM scenerows WHERE id = ?', row)
+    cur.execute('INSERT INTO scenes (VRT, Date, Year, DOY, YearDOY, Path, Bad, WKT) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (vrt, datetuple.strftime('%Y-%m-%d'), datetuple.year, int(datetuple.strftime('%j')), yeardoy, path, int(yeardoy in badlist), geom.ExportToWkt()))
+    rowid = cur.lastrowid
+    minX, maxX, minY, maxY = geom.GetEnvelope()
+    cur.execute('INSERT INTO scenes_rtree VALUES (?, ?, ?, ?, ?)', (rowid, minX, maxX, minY, maxY))
+    for sceneID in scenelist:
+        if sceneID != 'None':
+            cur.execute('INSERT INTO scenerows VALUES (?, ?, ?)', (rowid, sceneID, int(sceneID[6:9])))
+    if commit or closeconn:
+        conn.commit()
+    if closeconn:
+        conn.close()
+
+def getbadlist():
+    # Returns the YYYYDOY date strings of bad Landsat scenes listed in ieo.badlandsat.
+    badlist = []
+    if os.path.isfile(ieo.badlandsat):
+        with open(ieo.badlandsat, 'r') as lines:
+            for line in lines:
+                if len(line) >= 7:
+                    badlist.append(line.rstrip())
+    return badlist
+
+def shptocatalog(catshp, catdb):
+    # Builds a scene catalog database from an existing catalog shapefile, so that VRTs need not be rebuilt.
+    if not os.path.isfile(catshp):
+        print('ERROR: catalog shapefile not found: {}'.format(catshp))
+        return
+    print('Writing {} to catalog database: {}'.format(os.path.basename(catshp), os.path.basename(catdb)))
+    badlist = getbadlist()
+    conn = opencatalog(catdb)
+    data_source = driver.Open(catshp, 0)
+    layer = data_source.GetLayer()
+    for feat in layer:
+        vrt = feat.GetField('VRT')
+        geom = feat.GetGeometryRef()
+        if vrt and geom:
+            datetuple = datetime.datetime.strptime('{}{:03d}'.format(feat.GetField('Year'), feat.GetField('DOY')), '%Y%j')
+            scenelist = [feat.GetField('R021'), feat.GetField('R022'), feat.GetField('R023'), feat.GetField('R024')]
+            writetocatalog(catdb, vrt, scenelist, datetuple, geom, badlist = badlist, conn = conn, commit = False)
+    data_source = None
+    conn.commit()
+    conn.close()
+
+def batchcatalogs():
+    for subdir in getsubdirs():
+        shptocatalog(os.path.join(os.path.join(catdir, 'shp'), '{}_proc.shp'.format(subdir)), getcatalogdb(subdir))
+
+def getscenelist(filelist):
+    # Returns the sceneIDs of rows 21 to 24 in a list of scene classification files, with 'None' for missing rows.
+    scenelist = ['None'] * 4
+    for f in filelist:
+        sceneID = os.path.basename(f)[:21]
+        scenelist[int(sceneID[7:9]) - 21] = sceneID
+    return scenelist
+
+def opencatalogshp(catshp, ftg):
+    # Opens a catalog shapefile for writing, creating it if missing. Returns the data source and layer.
     if not os.path.isfile(catshp):
         data_source = driver.CreateDataSource(catshp)
         layer = data_source.CreateLayer("VRT shapes for {}".format(ftg), target, ogr.wkbPolygon)
@@ -157,46 +234,77 @@ def writetoshp(catshp, *args, **kwargs):
     else:
         data_source = driver.Open(catshp, 1)
         layer = data_source.GetLayer()
-    if not fix:
-        outfeature = ogr.Feature(layer.GetLayerDefn())
-        outfeature.SetField('Date', datetuple.strftime('%Y-%m-%d'))
-        outfeature.SetField('Year', datetuple.year)
-        outfeature.SetField('DOY', int(datetuple.strftime('%j')))
-        outfeature.SetField('Path', path)
-        for a, b in zip(['R021', 'R022', 'R023', 'R024'], scenelist):
-            outfeature.SetField(a, b)
-        outfeature.SetField('VRT', vrt)
-        outgeom = prepfootprint(inlayer, scenelist)
-        outfeature.SetGeometry(outgeom)
-        layer.CreateFeature(outfeature)
-    else:
+    return data_source, layer
+
+def addshpfeature(layer, vrt, filelist, datetuple):
+    # Adds a VRT to an open catalog shapefile layer. Returns its footprint.
+    scenelist = getscenelist(filelist)
+    outfeature = ogr.Feature(layer.GetLayerDefn())
+    outfeature.SetField('Date', datetuple.strftime('%Y-%m-%d'))
+    outfeature.SetField('Year', datetuple.year)
+    outfeature.SetField('DOY', int(datetuple.strftime('%j')))
+    outfeature.SetField('Path', int(os.path.basename(filelist[0])[3:6]))
+    for a, b in zip(['R021', 'R022', 'R023', 'R024'], scenelist):
+        outfeature.SetField(a, b)
+    outfeature.SetField('VRT', vrt)
+    outgeom = prepfootprint(scenelist)
+    outfeature.SetGeometry(outgeom)
+    layer.CreateFeature(outfeature)
+    return outgeom
+
+def writetoshp(catshp, *args, **kwargs):
+    # Adds a single VRT to a catalog shapefile, or with fix = True recalculates the footprints of all VRTs in it. Returns the footprint added.
+    vrt = kwargs.get('vrt', None)
+    filelist = kwargs.get('filelist', None)
+    datetuple = kwargs.get('datetuple', None)
+    fix = kwargs.get('fix', False)
+    outgeom = None
+    if fix:
+        data_source = driver.Open(catshp, 1)
+        layer = data_source.GetLayer()
         for feat in layer:
             vrt = feat.GetField('VRT')
             if os.path.isfile(vrt):
                 print('Processing VRT: {}'.format(vrt))
                 scenelist = [feat.GetField('R021'), feat.GetField('R022'), feat.GetField('R023'), feat.GetField('R024')]
-                outgeom = prepfootprint(inlayer, scenelist)
+                outgeom = prepfootprint(scenelist)
                 feat.SetGeometry(outgeom)
                 layer.SetFeature(feat)
-    src_ds = None
+    else:
+        data_source, layer = opencatalogshp(catshp, os.path.basename(os.path.dirname(filelist[0])))
+        outgeom = addshpfeature(layer, vrt, filelist, datetuple)
     data_source = None
-    
-def prepfootprint(inlayer, scenelist):
+    return outgeom
+
+footprintdict = None # Landsat scene footprints keyed by sceneID, read once per process from ieo.landsatshp
+
+def getfootprints():
+    # Returns a dict of lists of footprint geometries keyed by sceneID, reading the Landsat footprint layer only on the first call.
+    global footprintdict
+    if footprintdict is None:
+        footprintdict = {}
+        src_ds = driver.Open(ieo.landsatshp, 0)
+        inlayer = src_ds.GetLayer()
+        for feature in inlayer:
+            geom = feature.GetGeometryRef()
+            if geom:
+                sceneID = feature.GetField("sceneID")
+                if not sceneID in footprintdict.keys():
+                    footprintdict[sceneID] = []
+                footprintdict[sceneID].append(geom.Clone())
+        src_ds = None
+        print('Read {} Landsat scene footprints.'.format(len(footprintdict)))
+    return footprintdict
+
+def prepfootprint(scenelist):
     numscenes = 4 - scenelist.count('None')
     print('Number of scenes = {}'.format(numscenes))
     pointdict = {'X': [], 'Y': [], 'XY': []}
-    inlayer.ResetReading()
-    for feature in inlayer:
-        if feature.GetField("sceneID") in scenelist:
-            
-#            fit = inlayer.GetFeature(feature)
-            geom = feature.GetGeometryRef()
-#            if numscenes > 1:
-            pointdict = getpoints(geom, pointdict)
-#            else:
-#                outgeom = geom
-#                break
-#    if numscenes > 1:
+    footprints = getfootprints()
+    for sceneID in scenelist:
+        if sceneID in footprints.keys():
+            for geom in footprints[sceneID]:
+                pointdict = getpoints(geom, pointdict)
     ULpos = pointdict['Y'].index(max(pointdict['Y']))
     URpos = pointdict['X'].index(max(pointdict['X']))
     LRpos = pointdict['Y'].index(min(pointdict['Y']))
@@ -224,25 +332,212 @@ def getpoints(geom, pointdict):
         pointdict['XY'].append(point)
     return pointdict
 
-def makevrt(filelist, catfile, catshp, vrt, datetuple):
+def buildvrt(vrt, filelist):
+    # Mosaics the scene classifications of one date into a VRT in-process. Returns [success, message].
     basename = os.path.basename(vrt)
     print('Now creating VRT: %s'%basename)
-    proclist = ['gdalbuildvrt','-srcnodata','0',vrt]    
-#    scenelist.append(vrt)
-    for f in filelist:
-        if os.path.isfile(f):
-            proclist.append(f)
-    p = Popen(proclist)
-    print(p.communicate())
-    writetocsv(catfile, vrt, filelist, datetuple)
-    writetoshp(catshp, vrt = vrt, filelist = filelist, datetuple = datetuple)
+    srclist = [f for f in filelist if os.path.isfile(f)]
+    try:
+        vrt_ds = gdal.BuildVRT(vrt, srclist, srcNodata = 0)
+        if not vrt_ds:
+            return [False, gdal.GetLastErrorMsg()]
+        vrt_ds = None # flushes the VRT to disk
+    except Exception as e:
+        return [False, str(e)]
+    return [True, None]
+
+def buildvrtworker(task):
+    vrt, filelist, datetuple = task
+    return task + buildvrt(vrt, filelist)
+
+def buildvrts(tasks, *args, **kwargs):
+    # Builds the VRTs of a list of [vrt, filelist, datetuple] tasks, using a pool of worker processes if workers > 1. Returns the tasks of the VRTs that were built, sorted by VRT.
+    workers = kwargs.get('workers', margs.workers)
+    built = []
+    if workers > 1 and len(tasks) > 1:
+        print('Building {} VRTs using {} worker processes.'.format(len(tasks), workers))
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(buildvrtworker, tasks)
+    else:
+        pool = None
+        results = map(buildvrtworker, tasks)
+    for vrt, filelist, datetuple, success, msg in results:
+        if success:
+            built.append([vrt, filelist, datetuple])
+        else:
+            print('ERROR: VRT could not be built: {}: {}'.format(os.path.basename(vrt), msg))
+    if pool:
+        pool.close()
+        pool.join()
+    built.sort(key = lambda task: task[0])
+    return built
+
+class catalogwriter(object):
+    # Writes VRTs to the catalog CSV file, shapefile and database of an output subdirectory. Each is opened once for the whole run and the database rows are written in one transaction, which is committed by close().
+    def __init__(self, catfile, catshp, catdb, ftg, *args, **kwargs):
+        self.badlist = kwargs.get('badlist', [])
+        self.count = 0
+        if not os.path.isfile(catfile): # creates catalog file if missing
+            with open(catfile, 'w') as output:
+                output.write('Date,Year,DOY,Path,R021,R022,R023,R024,VRT\n')
+        self.csv = open(catfile, 'a')
+        self.data_source, self.layer = opencatalogshp(catshp, ftg)
+        self.catdb = catdb
+        self.conn = None
+        if catdb:
+            self.conn = opencatalog(catdb)
+    
+    def write(self, vrt, filelist, datetuple):
+        self.csv.write(makecsvline(vrt, filelist, datetuple))
+        outgeom = addshpfeature(self.layer, vrt, filelist, datetuple)
+        if self.conn:
+            writetocatalog(self.catdb, vrt, getscenelist(filelist), datetuple, outgeom, badlist = self.badlist, conn = self.conn, commit = False)
+        self.count += 1
+    
+    def close(self):
+        self.csv.close()
+        self.layer = None
+        self.data_source = None
+        if self.conn:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+def writecatalogrows(catfile, catshp, catdb, entries, *args, **kwargs):
+    # Writes the catalog CSV lines, shapefile features and database rows of a list of [vrt, filelist, datetuple] entries with one catalogwriter.
+    badlist = kwargs.get('badlist', [])
+    if len(entries) == 0:
+        return
+    print('Writing {} VRTs to catalog: {}'.format(len(entries), os.path.basename(catfile)))
+    writer = catalogwriter(catfile, catshp, catdb, os.path.basename(os.path.dirname(entries[0][1][0])), badlist = badlist)
+    try:
+        for vrt, filelist, datetuple in entries:
+            writer.write(vrt, filelist, datetuple)
+    finally:
+        writer.close()
+
+def makevrt(filelist, catfile, catshp, vrt, datetuple, *args, **kwargs):
+    catdb = kwargs.get('catdb', None)
+    badlist = kwargs.get('badlist', [])
+    success, msg = buildvrt(vrt, filelist)
+    if not success:
+        print('ERROR: VRT could not be built: {}: {}'.format(os.path.basename(vrt), msg))
+        return
+    writecatalogrows(catfile, catshp, catdb, [[vrt, filelist, datetuple]], badlist = badlist)
 
 def updatevrt(dirname, catfile, catshp, datetuple):
     vrtdir = os.path.join(dirname,'vrt')
     flist = makefilelist(dirname, datetuple)
     if flist:
         vrt = makevrtfilename(vrtdir, flist)
-        makevrt(flist, catfile, catshp, vrt, datetuple)
+        makevrt(flist, catfile, catshp, vrt, datetuple, catdb = getcatalogdb(os.path.basename(dirname)), badlist = getbadlist())
+
+def getfiledict(d):
+    # Returns the scene classification files of an output subdirectory as a dict of lists keyed by YYYYDOY.
+    filedict = {}
+    subdir = os.path.basename(d)
+    if subdir.lower() == 'dt4a':
+        filelist = glob.glob(os.path.join(d,'L*DT4aclass{}'.format(classext)))
+    elif subdir.lower() == 'dt4b':
+        filelist = glob.glob(os.path.join(d,'L*DT4bclass{}'.format(classext)))
+    else:
+        filelist = glob.glob(os.path.join(d,'L*DT4class{}'.format(classext)))
+    for f in filelist:
+        SceneID = os.path.basename(f)[:21]
+        filedict.setdefault(SceneID[9:16], []).append(f)
+    return filedict
+
+def readcatalogstate(catdb):
+    # Returns the VRTs in a scene catalog database as a dict of [VRT, set of member sceneIDs] lists keyed by YYYYDOY.
+    state = {}
+    conn = opencatalog(catdb)
+    for rowid, vrt, yeardoy in conn.execute('SELECT id, VRT, YearDOY FROM scenes').fetchall():
+        members = set([row[0] for row in conn.execute('SELECT sceneID FROM scenerows WHERE id = ?', (rowid,))])
+        if not yeardoy in state.keys():
+            state[yeardoy] = []
+        state[yeardoy].append([vrt, members])
+    conn.close()
+    return state
+
+def removecatalogrows(catfile, catshp, catdb, vrts):
+    # Removes VRTs from the catalog CSV file, shapefile and database, and deletes the VRT files. Single scenes catalogued in place of a VRT are not deleted.
+    if len(vrts) == 0:
+        return
+    vrts = set(vrts)
+    print('Removing {} VRTs from catalog: {}'.format(len(vrts), os.path.basename(catfile)))
+    if os.path.isfile(catfile):
+        with open(catfile, 'r') as lines:
+            linelist = [line for line in lines if not line.rstrip('\n').split(',')[-1] in vrts]
+        with open(catfile, 'w') as output:
+            output.writelines(linelist)
+    if os.path.isfile(catshp):
+        data_source = driver.Open(catshp, 1)
+        layer = data_source.GetLayer()
+        fids = [feat.GetFID() for feat in layer if feat.GetField('VRT') in vrts]
+        for fid in fids:
+            layer.DeleteFeature(fid)
+        data_source.ExecuteSQL('REPACK {}'.format(layer.GetName()))
+        data_source = None
+    conn = opencatalog(catdb)
+    for vrt in vrts:
+        row = conn.execute('SELECT id FROM scenes WHERE VRT = ?', (vrt,)).fetchone()
+        if row:
+            conn.execute('DELETE FROM scenes WHERE id = ?', row)
+            conn.execute('DELETE FROM scenes_rtree WHERE id = ?', row)
+            conn.execute('DELETE FROM scenerows WHERE id = ?', row)
+    conn.commit()
+    conn.close()
+    for vrt in vrts:
+        if vrt.lower().endswith('.vrt') and os.path.isfile(vrt):
+            os.remove(vrt)
+
+def updatenewvrts(*args, **kwargs):
+    # Updates the VRTs and catalogs of output subdirectories incrementally. Dates with classification files but no VRT in the catalog database get a new VRT, VRTs whose member scenes differ from the files on disk or that are older than any of them are rebuilt, and VRTs of dates without files are removed. Dates with a single scene are catalogued with the scene file in place of a VRT. Subdirectories without a catalog database are built in full by batchnewvrts().
+    dirlist = kwargs.get('dirlist', None)
+    workers = kwargs.get('workers', margs.workers)
+    for d in dirlist:
+        subdir = os.path.basename(d)
+        catfile = os.path.join(catdir, '{}_proc.csv'.format(subdir))
+        catshp = os.path.join(os.path.join(catdir, 'shp'), '{}_proc.shp'.format(subdir))
+        catdb = getcatalogdb(subdir)
+        if not os.path.isfile(catdb) and os.path.isfile(catshp):
+            shptocatalog(catshp, catdb)
+        if not os.path.isfile(catdb):
+            print('No catalog found for {}, building all VRTs.'.format(subdir))
+            batchnewvrts(dirlist = [d], workers = workers)
+            continue
+        print('Now updating VRTs for: {}'.format(d))
+        filedict = getfiledict(d)
+        state = readcatalogstate(catdb)
+        vrtdir = os.path.join(d,'vrt')
+        if not os.path.isdir(vrtdir):
+            os.mkdir(vrtdir)
+        tasks = []
+        singles = []
+        removals = []
+        for yeardoy in sorted(filedict.keys()):
+            filelist = sorted(filedict[yeardoy])
+            if len(filelist) < 2:
+                vrt = filelist[0]
+            else:
+                vrt = makevrtfilename(vrtdir, filelist)
+            members = set(getscenelist(filelist)) - set(['None'])
+            newest = max([os.path.getmtime(f) for f in filelist])
+            current = [entry for entry in state.get(yeardoy, []) if entry[0] == vrt and entry[1] == members and os.path.isfile(vrt) and os.path.getmtime(vrt) >= newest]
+            if len(current) == 0:
+                if len(filelist) < 2:
+                    singles.append([vrt, filelist, datetime.datetime.strptime(yeardoy, '%Y%j')])
+                else:
+                    tasks.append([vrt, filelist, datetime.datetime.strptime(yeardoy, '%Y%j')])
+            removals.extend([entry[0] for entry in state.get(yeardoy, []) if len(current) == 0 or entry[0] != vrt])
+        for yeardoy in state.keys():
+            if not yeardoy in filedict.keys(): # inputs have disappeared
+                removals.extend([entry[0] for entry in state[yeardoy]])
+        print('{}: {} new or changed dates, {} VRTs to remove, {} dates unchanged.'.format(subdir, len(tasks) + len(singles), len(removals), len(filedict) - len(tasks) - len(singles)))
+        removecatalogrows(catfile, catshp, catdb, removals) # VRTs rebuilt under the same name are removed first as well
+        entries = buildvrts(tasks, workers = workers) + singles
+        entries.sort(key = lambda entry: (entry[2], entry[0]))
+        writecatalogrows(catfile, catshp, catdb, entries, badlist = getbadlist())
 
 def batchnewvrts(*args, **kwargs):
     global catdir
@@ -250,6 +545,7 @@ def batchnewvrts(*args, **kwargs):
     dirlist = kwargs.get('dirlist', None)
     subdirs = kwargs.get('subdirs', None)
     overwrite = kwargs.get('overwrite', False)
+    workers = kwargs.get('workers', margs.workers)
     
     if dirname:
         dirlist = [dirname]
@@ -260,20 +556,9 @@ def batchnewvrts(*args, **kwargs):
     
     for d in dirlist:
         print('Now searching for files in: {}'.format(d))
-        filedict = {}
         subdir = os.path.basename(d)
-        if subdir.lower() == 'dt4a':
-            filelist = glob.glob(os.path.join(d,'L*DT4aclass.dat'))
-        elif subdir.lower() == 'dt4b':
-            filelist = glob.glob(os.path.join(d,'L*DT4bclass.dat'))
-        else:
-            filelist = glob.glob(os.path.join(d,'L*DT4class.dat'))
-        if len(filelist) > 0:
-            for f in filelist:
-                SceneID = os.path.basename(f)[:21]
-                if not SceneID[9:16] in filedict.keys():
-                    filedict[SceneID[9:16]] = [f]
-                filedict[SceneID[9:16]].append(f)
+        filedict = getfiledict(d)
+        if len(filedict) > 0:
             datelist = list(filedict.keys())
             datelist.sort()
             catfile = os.path.join(catdir, '{}_proc.csv'.format(subdir))
@@ -298,6 +583,11 @@ def batchnewvrts(*args, **kwargs):
                 now = datetime.datetime.now()
                 bak = catfile.replace('.csv','.{}.bak'.format(now.strftime('%Y%m%d-%H%M%S')))
                 shutil.move(catfile, bak)
+            catdb = getcatalogdb(subdir)
+            if overwrite and os.path.isfile(catdb):
+                now = datetime.datetime.now()
+                shutil.move(catdb, catdb.replace('.sqlite','.{}.sqlite.bak'.format(now.strftime('%Y%m%d-%H%M%S'))))
+            badlist = getbadlist()
 #            if os.path.isfile(catshp):    
 #                flist = glob.glob(catshp.replace('.shp','.*'))
 #                for f in flist:
@@ -312,38 +602,45 @@ def batchnewvrts(*args, **kwargs):
                         if os.path.isfile(f1):
                             os.remove(f1)
             
+            tasks = []
+            singles = [] # dates with a single scene are catalogued with the scene file in place of a VRT
             for f in datelist:
                 datetuple = datetime.datetime.strptime(f,'%Y%j')
                 numfiles = len(filedict[f])
                 if numfiles > 1:
                     filedict[f].sort()
                     vrt = makevrtfilename(vrtdir, filedict[f])
-                    print('Now processing: {}'.format(os.path.basename(vrt)))
-                    makevrt(filedict[f], catfile, catshp, vrt, datetuple)
+                    tasks.append([vrt, filedict[f], datetuple])
                 elif numfiles == 1:
-                    vrt = filedict[0]
+                    vrt = filedict[f][0]
                     print('Writing to catalog file {}: {}'.format(os.path.basename(catfile), os.path.basename(vrt)))
-                    writetocsv(catfile, vrt, filedict[f], datetuple)
+                    singles.append([vrt, filedict[f], datetuple])
                 else:
                     print('ERROR: No files found for date {}.'.format(f))
+            entries = buildvrts(tasks, workers = workers) + singles
+            entries.sort(key = lambda entry: (entry[2], entry[0]))
+            writecatalogrows(catfile, catshp, catdb, entries, badlist = badlist)
 
-def batchvrts():
-    today = datetime.datetime.today()
-    
-    # rootdir = r'D:\Spatial Analysis Unit\Archive\Landsat'
-#    rootdir = margs.rootdir
+def getsubdirs():
+    # Returns the DT4/a/b output subdirectories selected by the command line arguments.
     subdirs = []
     if margs.dt4a:
-        foresttograss = None
         subdirs.append('dt4a')
     elif margs.dt4b:
-        foresttograss = None
         subdirs.append('dt4b')
     else:
         foresttograss = margs.minforesttograss
         while foresttograss <= margs.maxforesttograss:
             subdirs.append(str(foresttograss))
             foresttograss += margs.increment
+    return subdirs
+
+def batchvrts():
+    today = datetime.datetime.today()
+    
+    # rootdir = r'D:\Spatial Analysis Unit\Archive\Landsat'
+#    rootdir = margs.rootdir
+    subdirs = getsubdirs()
         
     dirlist = []
     
@@ -352,70 +649,17 @@ def batchvrts():
     for subdir in subdirs:
         dirlist.append(os.path.join(margs.rootdir, subdir))
     
-    batchnewvrts(dirlist = dirlist, overwrite = margs.overwrite)
-    '''
-#    print(dirlist)
-    if margs.overwrite: # not margs.listonly and 
-        batchnewvrts(dirlist = dirlist)
-                
-    elif margs.update: # margs.listonly or 
-        for subdir in subdirs:
-            d = os.path.join(margs.rootdir,subdir)
-            vrtdir = os.path.join(d,'vrt')
-            catfile = os.path.join(catdir, '{}_proc.csv'.format(subdir))
-            catshpdir = os.path.join(catdir, 'shp')
-            if not os.path.isdir(catshpdir):
-                os.mkdir(catshpdir)
-            catshp = os.path.join(catshpdir, '{}_proc.shp'.format(subdir))
-            print('Now processing: {}'.format(os.path.basename(catfile)))
-            bak = '{}.{}.bak'.format(catfile, today.strftime('%Y%m%d-%H%M%S'))
-            shutil.move(catfile, bak)
-            datelist = []
-            with open(bak, 'r') as lines:
-                for line in lines:
-                    if not line.startswith('Date'):
-                        linelist = line.strip('\n').split(',')
-                        datetuple = datetime.datetime.strptime('{}{}'.format(linelist[1],linelist[2]),'%Y%j')
-                        filelist = glob.glob(os.path.join(d,'L*{}{}*.dat'.format(linelist[1],linelist[2])))
-                        basename = os.path.basename(linelist[8])
-                        if margs.update:
-                            if (len(filelist) == 1 and basename[6:7] == '0') or (len(filelist) == int(basename[6:7])):
-                                with open(catfile,'a') as output:
-                                    output.write(line)  
-                                datelist.append('{}{}'.format(linelist[1],linelist[2]))
-                            else:
-                                updatevrt(d, catfile, catshp, datetuple)
-                                datelist.append('{}{}'.format(linelist[1],linelist[2]))
-                        else:
-                            vrtlist = glob.glob(os.path.join(vrtdir,'L*{}{}*.vrt'.format(linelist[1],linelist[2])))
-                            if len(vrtlist) == 0:
-                                vrt = makevrtfilename(d, filelist)
-                            else:
-                                vrt = vrtlist[0]
-                            writetocsv(catfile, vrt, filelist, datetime.datetime.strptime('{}{}'.format(linelist[1],linelist[2]),'%Y%j')) 
-                    else:
-                        with open(catfile,'w') as output:
-                            output.write(line)
-            if margs.update:
-                print('Searching for new scenes.')
-                filelist = glob.glob(os.path.join(d,'L*.dat'))
-                newlist = []
-                for f in filelist:
-                    if not os.path.basename(f)[9:16] in datelist:
-                        newlist.append(os.path.basename(f)[9:16])
-                if len(newlist) > 0:
-                    print('New files have been found, processing.')
-                    for n in newlist:
-                        datetuple = datetime.datetime.strptime(n,'%Y%j')
-                        updatevrt(d, catfile, catshp, datetuple)
-                        
-                    
-    '''
+    if margs.update and not margs.overwrite:
+        updatenewvrts(dirlist = dirlist)
+    else:
+        batchnewvrts(dirlist = dirlist, overwrite = margs.overwrite)
     print('Processing complete.')
 
 def main():
     if margs.fix:
         fixshps()
+    elif margs.catalog:
+        batchcatalogs()
     else:
         batchvrts()
 
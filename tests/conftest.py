@@ -0,0 +1,18 @@
+# Shared fixtures for the IForDEO tests.
+# ifordeo.py parses its command line when imported, so it is imported here with no arguments. The tests need the full build environment (GDAL and ieo).
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope = 'session')
+def ifordeo():
+    pytest.importorskip('osgeo')
+    pytest.importorskip('ieo')
+    argv = sys.argv
+    sys.argv = argv[:1]
+    try:
+        import ifordeo
+    finally:
+        sys.argv = argv
+    return ifordeo
@@ -0,0 +1,13 @@
+# cleansignalstack() must clean a (years, pixels) array exactly as cleansignal() cleans each pixel's signal.
+import numpy as np
+import pytest
+
+@pytest.mark.parametrize('numyears', [2, 3, 5, 35])
+def test_cleansignalstack_matches_cleansignal(ifordeo, numyears):
+    signals = np.random.RandomState(numyears).randint(0, 4, size = (numyears, 5000)).astype(np.uint8)
+    # cleansignal() is only called for signals with both forest and non-forest values, see lcchange()
+    mixed = ((signals == 1) | (signals == 3)).any(axis = 0) & ((signals == 0) | (signals == 2)).any(axis = 0)
+    signals = signals[:, mixed]
+    batch = ifordeo.cleansignalstack(signals.copy())
+    for j in range(signals.shape[1]):
+        assert np.array_equal(ifordeo.cleansignal(signals[:, j].copy()), batch[:, j]), 'signal {}'.format(signals[:, j].tolist())
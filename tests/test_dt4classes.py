@@ -0,0 +1,75 @@
+# dt4classes() must reproduce the rule by rule DT4, DT4a and DT4b classifications it replaced, including the rule order.
+import numexpr
+import numpy as np
+import pytest
+
+def oldclasses(blue, green, red, NIR, SWIR1, SWIR2, cfmaskdata, GRNIR, NIRSWIR12, minforesttograss, maxforesttograss, algorithm):
+    # The decision tree of the original dt4(), DT4a() and DT4b() functions. DT4 has a single foresttograss value, and no classes 10 and 11.
+    if algorithm == 'DT4b':
+        NIRSWIR = '(SWIR2 - (SWIR2 - NIR) * NIRSWIR12 -  SWIR1)'
+        GRNIRR = '((NIR - green) * GRNIR + green -  red)'
+    else:
+        NIRSWIR = '((NIR + SWIR2) * NIRSWIR12 -  SWIR1)'
+        GRNIRR = '((green + NIR) * GRNIR -  red)'
+    cfmaskdata = cfmaskdata.copy()
+    data = np.zeros(cfmaskdata.shape, dtype = np.uint8)
+    cfmaskdata[numexpr.evaluate("(cfmaskdata == 0) & ((blue <= 0) | (blue >= 10000) | (green <= 0) | (green >= 10000) | (red <= 0) | (red >= 10000) | (NIR <= 0) | (NIR >= 10000) | (SWIR1 <= 0) | (SWIR1 >= 10000) | (SWIR2 <= 0) | (SWIR2 >= 10000))")] = 5
+    rules = [
+        (1, "((green > NIR) | (red > NIR)) & (cfmaskdata == 0)"),
+        (2, "(blue < 1000) & (green < 1000) & (red < 1000) & (NIR < 1000) & (SWIR1 < 1000) & (SWIR2 < 1000) & (cfmaskdata == 0) & (data == 0)"),
+        (8, "((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & ({0} > 0) & (NIR < minforesttograss) & (cfmaskdata == 0)) & (data == 0)".format(NIRSWIR)),
+        (9, "((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & ({0} <= 0) & (NIR < minforesttograss) & (cfmaskdata == 0)) & (data == 0)".format(NIRSWIR)),
+    ]
+    if algorithm != 'DT4':
+        rules += [
+            (10, "((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & ({0} > 0) & (NIR < maxforesttograss) & (cfmaskdata == 0)) & (data == 0)".format(NIRSWIR)),
+            (11, "((green > blue) & (green > red) & (green*4 < NIR) & (NIR > SWIR1) & ({0} <= 0) & (NIR < maxforesttograss) & (cfmaskdata == 0)) & (data == 0)".format(NIRSWIR)),
+        ]
+    rules += [
+        (6, "((green > blue) & (green > red) & (green*4 < NIR) & (NIR >= maxforesttograss) & ({0} > 0) & (cfmaskdata == 0)) & (data == 0)".format(NIRSWIR)),
+        (7, "(({1} > 0) & ({0} > 0) & (cfmaskdata == 0)) & (data == 0)".format(NIRSWIR, GRNIRR)),
+        (5, "(({1} > 0) & ({0} <= 0) & (NIR > SWIR1) & (cfmaskdata == 0)) & (data == 0)".format(NIRSWIR, GRNIRR)),
+        (3, "(({0} <= 0) & (red < 1000) & (cfmaskdata == 0)) & (data == 0)".format(GRNIRR)),
+        (4, "(((({1} <= 0) & (red >= 1000)) | (({1} > 0) & ({0} <= 0))) & (cfmaskdata == 0)) & (data == 0)".format(NIRSWIR, GRNIRR)),
+    ]
+    for classval, rule in rules:
+        data[numexpr.evaluate(rule)] = classval
+    return data
+
+def makebands(seed, n = 240000):
+    # Uniformly random reflectances, including out of range values, vegetation-like spectra that reach the forest and grassland rules, and dark spectra that reach the urban rule.
+    rs = np.random.RandomState(seed)
+    randombands = [rs.randint(-500, 10500, n // 3) for i in range(6)]
+    vegetation = [rs.randint(lo, hi, n // 3) for lo, hi in [(100, 700), (200, 900), (50, 800), (1000, 6000), (300, 3500), (100, 2500)]]
+    dark = [rs.randint(1, 1100, n // 3) for i in range(6)]
+    bands = [np.concatenate(b).astype(np.int16).reshape(400, n // 400) for b in zip(randombands, vegetation, dark)]
+    cfmaskdata = np.where(rs.rand(*bands[0].shape) < 0.1, rs.randint(1, 5, bands[0].shape), 0).astype(np.uint8)
+    return bands, cfmaskdata
+
+@pytest.mark.parametrize('sensor', ['LT5', 'LE7', 'LC8'])
+@pytest.mark.parametrize('algorithm', ['DT4', 'DT4a', 'DT4b'])
+def test_dt4classes_matches_old_rules(ifordeo, algorithm, sensor):
+    bands, cfmaskdata = makebands(len(sensor + algorithm))
+    GRNIR = ifordeo.coeffdict[sensor]['GRNIR']
+    NIRSWIR12 = ifordeo.coeffdict[sensor]['NIRSWIR12']
+    if algorithm == 'DT4':
+        minforesttograss, maxforesttograss = 3000, 3000
+    else:
+        minforesttograss, maxforesttograss = 2500, 4000
+    expected = oldclasses(*(bands + [cfmaskdata, GRNIR, NIRSWIR12, minforesttograss, maxforesttograss, algorithm]))
+    data = ifordeo.dt4classes(*(bands + [cfmaskdata, GRNIR, NIRSWIR12, minforesttograss, maxforesttograss]), algorithm = algorithm)
+    assert data.dtype == np.uint8
+    assert np.array_equal(data, expected)
+    # every class of the tree is exercised
+    classes = set(range(12)) if algorithm != 'DT4' else set(range(10))
+    assert set(np.unique(expected)) == classes
+
+def test_dt4threshold_sweep_matches_old_rules(ifordeo):
+    # The DT4 sweep evaluates dt4features() once and applies each foresttograss threshold with dt4thresholdclasses().
+    bands, cfmaskdata = makebands(1)
+    GRNIR = ifordeo.coeffdict['LC8']['GRNIR']
+    NIRSWIR12 = ifordeo.coeffdict['LC8']['NIRSWIR12']
+    base, vegclass, grass = ifordeo.dt4features(*(bands + [cfmaskdata, GRNIR, NIRSWIR12]), algorithm = 'DT4')
+    for foresttograss in range(1500, 5001, 500):
+        expected = oldclasses(*(bands + [cfmaskdata, GRNIR, NIRSWIR12, foresttograss, foresttograss, 'DT4']))
+        assert np.array_equal(ifordeo.dt4thresholdclasses(base, vegclass, grass, bands[3], foresttograss, foresttograss), expected)
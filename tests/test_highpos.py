@@ -0,0 +1,63 @@
+# Highpos, the majority class of a tile-year, from writeprobabilityrasters() on a small class count cube.
+import numpy as np
+import pytest
+
+# (DT4 class counts, expected Highpos) per pixel. Highpos classes: 0 no data, 1 water, 2 urban, 3 crop/grass, 4 bog/heath, 5 forestry, 6 heath/forest, 7 crop/bog, 8 crop/forest, 9 bog/forest, 10 forest/crop, 11 forest/crop/heath
+pixels = [
+    ({}, 0),
+    ({1: 3}, 1),
+    ({1: 1, 2: 2}, 2),
+    ({4: 1, 6: 2, 7: 2}, 3),
+    ({3: 2, 5: 2, 8: 1}, 4),
+    ({7: 1, 8: 4, 1: 2}, 5),
+    ({9: 3, 8: 1}, 6),
+    ({4: 2, 3: 2}, 7), # crop/grass = bog/heath
+    ({6: 2, 8: 2}, 8), # crop/grass = forestry
+    ({3: 1, 5: 2, 7: 3}, 9), # bog/heath = forestry
+    ({1: 2, 2: 2}, 1), # ties go to the lower class
+    ({10: 5, 8: 1}, 10),
+    ({11: 5, 2: 1}, 11),
+]
+
+def makecounts(pixels):
+    counts = np.zeros((12, 1, len(pixels)), dtype = np.uint16)
+    for j, (classcounts, highpos) in enumerate(pixels):
+        for c, n in classcounts.items():
+            counts[c, 0, j] = n
+    return counts
+
+@pytest.fixture
+def written(ifordeo, monkeypatch):
+    # Collects the rasters passed to writedata() by rastertype and class name.
+    outputs = {}
+    def writedata(data, rastertype, geoTrans, *args, **kwargs):
+        outputs[kwargs.get('classname', None) or rastertype] = np.array(data)
+    monkeypatch.setattr(ifordeo, 'writedata', writedata)
+    return outputs
+
+@pytest.mark.parametrize('foresttograss', [None, 3000])
+def test_highpos(ifordeo, written, foresttograss):
+    if foresttograss: # DT4 has no classes 10 and 11
+        tilepixels = pixels[:-2]
+    else:
+        tilepixels = pixels
+    ifordeo.writeprobabilityrasters(makecounts(tilepixels), foresttograss, 2020, 'T1', (0, 30, 0, 0, 0, -30), '.', [], multibandpct = False)
+    assert written['Highpos'].dtype == np.uint8
+    assert written['Highpos'][0].tolist() == [highpos for classcounts, highpos in tilepixels]
+    assert written['denominator'].dtype == np.uint16
+    assert written['denominator'][0].tolist() == [sum(classcounts.values()) for classcounts, highpos in tilepixels]
+
+def test_denominator_above_int16(ifordeo, written):
+    # Observation counts above 32767 must not wrap.
+    counts = makecounts([({1: 30000, 5: 10000}, 1)])
+    ifordeo.writeprobabilityrasters(counts, None, 2020, 'T1', (0, 30, 0, 0, 0, -30), '.', [], multibandpct = False)
+    assert written['denominator'][0].tolist() == [40000]
+
+def test_highpos_pct(ifordeo, written):
+    # The per-class probabilities are scaled to 10000 and the multi-band stack holds the same values as the per-class files.
+    ifordeo.writeprobabilityrasters(makecounts(pixels), None, 2020, 'T1', (0, 30, 0, 0, 0, -30), '.', [], multibandpct = False)
+    assert written['forestry'][0, 5] == 10000 * 5 // 7
+    assert written['water'][0, 1] == 10000
+    ifordeo.writeprobabilityrasters(makecounts(pixels), None, 2020, 'T1', (0, 30, 0, 0, 0, -30), '.', [], multibandpct = True)
+    for i, classname in enumerate(ifordeo.pctclassnames[:11]):
+        assert np.array_equal(written['pctstack'][i], written[classname])
@@ -0,0 +1,30 @@
+# The array change engine, cleansignalstack() and lcchangestack(), must give the same seven outputs as lcchange() does per pixel.
+import numpy as np
+import pytest
+
+def arraychanges(ifordeo, signals, years, endyear):
+    # As the array engine of calcyearlychange(): only signals with both forest and non-forest values are cleaned.
+    signals = signals.copy()
+    clean = ((signals == 1) | (signals == 3)).any(axis = 0) & ((signals == 0) | (signals == 2)).any(axis = 0)
+    signals[:, clean] = ifordeo.cleansignalstack(signals[:, clean])
+    return ifordeo.lcchangestack(signals, years, endyear)
+
+def edgesignals(numyears):
+    # Constant signals of every class, and signals that switch between forest and not forest once or every year.
+    signals = [np.full(numyears, c) for c in range(4)]
+    for a, b in [(1, 3), (3, 1), (0, 3), (2, 1)]:
+        for k in range(1, numyears):
+            signals.append(np.array([a] * k + [b] * (numyears - k)))
+        signals.append(np.array([(a, b)[i % 2] for i in range(numyears)]))
+    return np.array(signals, dtype = np.uint8).T
+
+@pytest.mark.parametrize('numyears', [1, 2, 5, 35])
+def test_lcchangestack_matches_lcchange(ifordeo, numyears):
+    years = list(range(1984, 1984 + numyears))
+    endyear = years[-1]
+    signals = np.concatenate([edgesignals(numyears), np.random.RandomState(numyears).randint(0, 4, size = (numyears, 5000)).astype(np.uint8)], axis = 1)
+    changes = arraychanges(ifordeo, signals, years, endyear)
+    assert len(changes) == 7
+    for j in range(signals.shape[1]):
+        expected = ifordeo.lcchange(signals[:, j].tolist(), years, endyear)
+        assert [int(values[j]) for values in changes] == [int(v) for v in expected], 'signal {}'.format(signals[:, j].tolist())
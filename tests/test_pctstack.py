@@ -0,0 +1,21 @@
+# The multi-band pct file must hold the same class probabilities as the per-class pct files when read back through GDAL.
+# Writes and reads real files, so it needs GDAL with its ENVI driver and ieo's ENVIfile for the per-class files.
+import numpy as np
+import pytest
+
+def test_pctstack_readback(ifordeo, tmp_path):
+    gdal = pytest.importorskip('osgeo.gdal')
+    pytest.importorskip('ieo')
+    if gdal.GetDriverByName('ENVI') is None:
+        pytest.skip('GDAL has no ENVI driver')
+    counts = np.random.RandomState(0).randint(0, 6, size = (12, 20, 30)).astype(np.uint16)
+    geoTrans = (500000.0, 30.0, 0.0, 800000.0, 0.0, -30.0)
+    for multibandpct in [True, False]:
+        ifordeo.writeprobabilityrasters(counts.copy(), None, 2020, 'T1', geoTrans, str(tmp_path), [], multibandpct = multibandpct)
+    ds = gdal.Open(ifordeo.productpath(str(tmp_path), 'pct_2020_T1.dat'))
+    assert (ds.RasterCount, ds.RasterYSize, ds.RasterXSize) == (11, 20, 30)
+    assert ds.GetGeoTransform() == geoTrans
+    for i, classname in enumerate(ifordeo.pctclassnames[:11]):
+        pct = gdal.Open(ifordeo.productpath(str(tmp_path), '{}_pct_2020_T1.dat'.format(classname))).ReadAsArray()
+        assert np.array_equal(ds.GetRasterBand(i + 1).ReadAsArray(), pct), classname
+    ds = None
@@ -0,0 +1,60 @@
+# tilewindow() read windows and tile slices for scenes that overlap a tile partly, along an edge, fully or not at all.
+import numpy as np
+import pytest
+
+tilegt = (500000.0, 30.0, 0.0, 800000.0, 0.0, -30.0)
+tilecols, tilerows = 100, 80
+
+def scenegt(col, row):
+    # Geotransform of a scene whose first pixel is at tile column col, row row.
+    return (tilegt[0] + col * 30.0, 30.0, 0.0, tilegt[3] - row * 30.0, 0.0, -30.0)
+
+def checkwindow(window, scene, tile):
+    # The window read from the scene must be the same pixels as the tile slices.
+    (xoff, yoff, xsize, ysize), dst = window
+    assert np.array_equal(scene[yoff:yoff + ysize, xoff:xoff + xsize], tile[dst])
+
+def gridvalues(col, row, cols, rows):
+    # Unique values per pixel of the shared grid, so that misaligned windows cannot match.
+    return np.add.outer(np.arange(row, row + rows) * 10000, np.arange(col, col + cols))
+
+@pytest.mark.parametrize('col, row, cols, rows', [
+    (-20, -10, 50, 40), # upper left corner
+    (70, 60, 50, 40), # lower right corner
+    (30, -25, 10, 200), # crosses the tile from top to bottom
+    (-5, -5, 200, 200), # covers the tile
+    (10, 10, 20, 20), # inside the tile
+])
+def test_tilewindow_partial_overlap(ifordeo, col, row, cols, rows):
+    window = ifordeo.tilewindow(tilegt, tilecols, tilerows, scenegt(col, row), cols, rows)
+    assert window is not None
+    checkwindow(window, gridvalues(col, row, cols, rows), gridvalues(0, 0, tilecols, tilerows))
+
+@pytest.mark.parametrize('col, row, cols, rows, expected', [
+    (99, 0, 50, 80, ((0, 0, 1, 80), (slice(0, 80), slice(99, 100)))), # last tile column only
+    (-49, 79, 50, 10, ((49, 0, 1, 1), (slice(79, 80), slice(0, 1)))), # lower left corner pixel only
+])
+def test_tilewindow_edge_overlap(ifordeo, col, row, cols, rows, expected):
+    assert ifordeo.tilewindow(tilegt, tilecols, tilerows, scenegt(col, row), cols, rows) == expected
+
+@pytest.mark.parametrize('col, row, cols, rows', [
+    (100, 0, 50, 80), # touches the right edge
+    (-50, 0, 50, 80), # touches the left edge
+    (0, 80, 100, 10), # touches the bottom edge
+    (0, -10, 100, 10), # touches the top edge
+    (200, 200, 10, 10), # far away
+])
+def test_tilewindow_no_overlap(ifordeo, col, row, cols, rows):
+    assert ifordeo.tilewindow(tilegt, tilecols, tilerows, scenegt(col, row), cols, rows) is None
+
+def test_tilewindow_subpixel_shift(ifordeo):
+    # Origins within rounding error of the shared grid snap to it.
+    gt = scenegt(10, 10)
+    gt = (gt[0] + 1e-7, gt[1], gt[2], gt[3] - 1e-7, gt[4], gt[5])
+    assert ifordeo.tilewindow(tilegt, tilecols, tilerows, gt, 5, 5) == ((0, 0, 5, 5), (slice(10, 15), slice(10, 15)))
+
+@pytest.mark.parametrize('pixelsize', [(15.0, -15.0), (30.0, -15.0), (60.0, -60.0)])
+def test_tilewindow_pixel_size_mismatch(ifordeo, pixelsize):
+    gt = (tilegt[0], pixelsize[0], 0.0, tilegt[3], 0.0, pixelsize[1])
+    with pytest.raises(ValueError):
+        ifordeo.tilewindow(tilegt, tilecols, tilerows, gt, 50, 50)